@@ -0,0 +1,1283 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for the table parsers, using the bundled test pages.
+
+Run from the scrapyproject directory:
+
+    python -m gosduma7.benchmark [benchmark ...]
+
+To catch parser slowdowns, save the throughput on your machine as a
+baseline, and check against it after making changes:
+
+    python -m gosduma7.benchmark throughput --save-baseline baseline.json
+    python -m gosduma7.benchmark throughput --baseline baseline.json
+
+The second command exits with a non-zero status if the throughput of any
+page dropped by more than the tolerance (default: 20%).
+"""
+import argparse
+import collections
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import os.path as P
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import scrapy.http
+from lxml import etree
+
+from gosduma7 import database
+from gosduma7 import dataset
+from gosduma7 import fetcher
+from gosduma7 import hierarchy
+from gosduma7 import htmlcache
+from gosduma7 import mockserver
+from gosduma7 import parsing
+from gosduma7 import pipelines
+from gosduma7 import sharding
+from gosduma7 import stations
+from gosduma7.spiders import myspider
+
+FIXTURES = [
+    ("test_parse.html", "federal"),
+    ("test_parse_single.html", "single"),
+    ("test_parse_federal_uik.html", "federal_uik"),
+]
+"""The summary table pages, along with their data_type."""
+
+TURNOUT_FIXTURES = [
+    ("test_parse_turnout.html", "turnout"),
+    ("test_parse_turnout_uik.html", "turnout_uik"),
+    ("test_parse_turnout_uik2.html", "turnout_uik"),
+]
+"""The turnout table pages, along with their data_type."""
+
+WIDE_UIKS = 400
+"""How many UIK columns (or rows) to widen the UIK-level pages to.  This is
+in the region of the biggest TIKs, the slowest pages of a real crawl."""
+
+
+def myfloat(value):
+    """Decode a cell the way the parsers used to: everything is a float, and
+    blank cells raise and catch an exception."""
+    try:
+        return float(value)
+    except ValueError:
+        return parsing.BAD_COLUMN
+
+
+def legacy_extract_cells(root, data_type, row_numbers, num_columns):
+    """Extract the totals and cells with one absolute xpath query per cell.
+
+    This is how parse_voting_summary_table used to work.  We keep it here
+    as a reference point for the benchmarks."""
+    xpaths = parsing.XPATHS[data_type]
+    rows = []
+    for row_number in row_numbers:
+        columns = [
+            parsing.join(
+                root.xpath(xpaths["total"], row=row_number + 1).extract()
+            )
+        ]
+        for col_number in range(1, num_columns + 1):
+            columns.append(
+                parsing.join(
+                    root.xpath(
+                        xpaths["cell"], row=row_number + 1, col=col_number
+                    ).extract()
+                )
+            )
+        rows.append(columns)
+    return rows
+
+
+def single_pass_extract_cells(root, data_type, row_numbers, num_columns):
+    """Extract the totals and cells the way parse_voting_summary_table does."""
+    xpaths = parsing.COMPILED_XPATHS[data_type]
+    totals = parsing.extract_cells(
+        xpaths["total_table"](root.root), row_numbers, [2]
+    )
+    cells = parsing.extract_cells(
+        xpaths["cell_table"](root.root), row_numbers, range(num_columns)
+    )
+    return [t + c for (t, c) in zip(totals, cells)]
+
+
+def legacy_parse(response, data_type):
+    """Parse a page by evaluating string xpath expressions on the Selector.
+
+    Returns the names, headers and cell values, but not the metadata."""
+    root = response.selector
+    xpaths = parsing.XPATHS[data_type]
+    level = "uik" if data_type.endswith("_uik") else "oik"
+    names = parsing.NAME_XPATHS[level]
+    result = {
+        key: parsing.join(root.xpath(xpath).extract())
+        for (key, xpath) in names.items()
+    }
+    row_headers = [
+        parsing.join(td.xpath(".//text()").extract())
+        for td in root.xpath(xpaths["row_header"])
+    ]
+
+    if data_type.startswith("turnout"):
+        result["data"] = [
+            [
+                myfloat(
+                    parsing.join(
+                        root.xpath(
+                            xpaths["cell"], row=row + 1, col=col + 1
+                        ).extract()
+                    ).rstrip("%")
+                )
+                for col in [2, 3, 4, 5]
+            ]
+            for row in range(2, len(row_headers))
+        ]
+        return result
+
+    column_headers = [
+        parsing.join(td.xpath(".//text()").extract())
+        for td in root.xpath(xpaths["col_header"])
+    ]
+    row_numbers = (
+        list(range(parsing.FIRST_STAT, parsing.LAST_STAT)) +
+        list(range(parsing.FIRST_CANDIDATE, len(row_headers)))
+    )
+    result["data"] = [
+        [myfloat(value) for value in row]
+        for row in legacy_extract_cells(
+            root, data_type, row_numbers, len(column_headers)
+        )
+    ]
+    return result
+
+
+def parse(response, data_type):
+    """Parse the page with the current parser."""
+    if data_type.startswith("turnout"):
+        return parsing.parse_turnout_table(response, data_type)
+    return parsing.parse_voting_summary_table(response, data_type)
+
+
+def best_of(function, number, repeat):
+    """Return the best time per call of function, in seconds."""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def timed(function):
+    """Return the wall-clock time it takes to call function once."""
+    start = time.time()
+    function()
+    return time.time() - start
+
+
+def synthetic_tables(num_regions=85, oik_per_region=225 // 85 + 1,
+                     tik_per_oik=2820 // 225 + 1, uik_per_tik=34, seed=0):
+    """Yield tables that look like the ones from the 2016 crawl.
+
+    The defaults give roughly as many tables, of roughly the same sizes, as
+    the real dataset.  The headers come from the test pages, and the values
+    are random."""
+    rng = random.Random(seed)
+    templates = {
+        data_type: parse(myspider.mock_response(filename), data_type)
+        for (filename, data_type) in FIXTURES + TURNOUT_FIXTURES
+    }
+
+    def table(data_type, names, column_headers=None, row_headers=None):
+        template = templates[data_type]
+        row_headers = row_headers or template["row_headers"]
+        column_headers = column_headers or template["column_headers"]
+        if data_type.startswith("turnout"):
+            data = [
+                [round(rng.uniform(0, 100), 2) for _ in column_headers]
+                for _ in row_headers
+            ]
+        else:
+            data = []
+            for _ in row_headers:
+                row = [float(rng.randint(0, 3000)) for _ in column_headers[1:]]
+                data.append([float(sum(row))] + row)
+        result = dict(
+            template, row_headers=row_headers, column_headers=column_headers,
+            data=data, url="http://localhost/%d" % rng.getrandbits(64),
+            md5="%032x" % rng.getrandbits(128)
+        )
+        result.update(names)
+        return result
+
+    for region_number in range(num_regions):
+        region = "Регион №%d" % region_number
+        for oik_number in range(oik_per_region):
+            area_ik = "ОИК №%d" % (region_number * oik_per_region + oik_number)
+            names = {
+                "region": region, "area_ik": area_ik, "area_ik_long": area_ik
+            }
+            tiks = ["ТИК №%d" % i for i in range(tik_per_oik)]
+            yield table("federal", names, ["Сумма"] + tiks)
+            yield table("single", names, ["Сумма"] + tiks)
+            yield table("turnout", names, row_headers=tiks)
+
+            for tik in tiks:
+                names = {
+                    "region": region, "area_ik": area_ik, "territory_ik": tik
+                }
+                uiks = ["УИК №%d" % i for i in range(uik_per_tik)]
+                yield table("federal_uik", names, ["Сумма"] + uiks)
+                yield table("turnout_uik", names, row_headers=uiks)
+
+
+def write_synthetic_dataset(path, **kwargs):
+    """Write synthetic tables as results.json and results.npz under path.
+
+    Returns the paths to the two files."""
+    json_path = P.join(path, "results.json")
+    npz_path = P.join(path, "results.npz")
+    with open(json_path, "wb") as json_out, open(npz_path, "wb") as npz_out:
+        exporter = pipelines.ColumnarExporter(npz_out)
+        exporter.start_exporting()
+        for table in synthetic_tables(**kwargs):
+            data = json.dumps(table, ensure_ascii=False) + "\n"
+            json_out.write(data.encode("utf-8"))
+            exporter.export_item(table)
+        exporter.finish_exporting()
+    return json_path, npz_path
+
+
+def widen_page(body, data_type, num_uiks=WIDE_UIKS):
+    """Return a copy of a UIK-level test page, with num_uiks polling
+    stations.
+
+    The federal_uik tables have a column per UIK, and the turnout_uik
+    tables a row per UIK.  We make copies of the existing ones."""
+    root = etree.fromstring(body, etree.HTMLParser(encoding="utf-8"))
+    if data_type == "federal_uik":
+        mockserver.resize_columns(root, data_type, num_uiks)
+    elif data_type == "turnout_uik":
+        mockserver.resize_rows(root, data_type, num_uiks)
+    else:
+        raise ValueError("can't widen %r pages" % data_type)
+    return etree.tostring(root, method="html", encoding="utf-8")
+
+
+def throughput_pages():
+    """Return (name, data_type, body) for the pages to measure throughput
+    on: the bundled test pages, and widened copies of the UIK-level ones."""
+    pages = []
+    for filename, data_type in FIXTURES + TURNOUT_FIXTURES:
+        with open(P.join(myspider.CURR_DIR, filename), "rb") as fin:
+            body = fin.read()
+        pages.append((filename, data_type, body))
+        if filename in ("test_parse_federal_uik.html",
+                        "test_parse_turnout_uik.html"):
+            pages.append((
+                "%s x%d" % (filename, WIDE_UIKS), data_type,
+                widen_page(body, data_type)
+            ))
+    return pages
+
+
+def bench_throughput(number, repeat):
+    """Measure pages/s, cells/s and peak memory of parsing each page.
+
+    This includes building the tree from the raw HTML, like the crawl does.
+    Returns the results by page name, for comparing against a baseline."""
+    print("%-36s %-12s %6s %10s %12s %8s" % (
+        "page", "data_type", "cells", "pages/s", "cells/s", "peak MB"
+    ))
+    results = {}
+    for name, data_type, body in throughput_pages():
+        def parse_body():
+            return parsing.parse_page(
+                "http://localhost/" + name, body, "utf-8", data_type
+            )
+
+        result = parse_body()
+        num_cells = sum(len(row) for row in result["data"])
+        seconds = best_of(parse_body, number, repeat)
+        peak = peak_memory(parse_body)
+        results[name] = {
+            "data_type": data_type, "cells": num_cells,
+            "pages_per_second": 1 / seconds,
+            "cells_per_second": num_cells / seconds,
+            "peak_bytes": peak,
+        }
+        print("%-36s %-12s %6d %10.1f %12.0f %8.2f" % (
+            name, data_type, num_cells, 1 / seconds, num_cells / seconds,
+            peak / 1e6
+        ))
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Return a message for each page whose throughput dropped by more than
+    the tolerance (a fraction) compared to the baseline."""
+    messages = []
+    for name, expected in sorted(baseline.items()):
+        if name not in results:
+            continue
+        actual = results[name]["pages_per_second"]
+        minimum = expected["pages_per_second"] * (1 - tolerance)
+        if actual < minimum:
+            messages.append(
+                "%s: %.1f pages/s, down from %.1f" % (
+                    name, actual, expected["pages_per_second"]
+                )
+            )
+    return messages
+
+
+def crawl(top_url, expected_counts, settings):
+    """Crawl the site in a scrapy subprocess.
+
+    Returns the elapsed seconds, the peak memory of the subprocess in bytes,
+    and the number of tables scraped."""
+    output = tempfile.mktemp(suffix=".json")
+    command = [
+        sys.executable, "-m", "scrapy", "runspider",
+        P.join("gosduma7", "spiders", "myspider.py"),
+        "-o", output + ":lines", "-s", "LOG_LEVEL=WARNING",
+        "-s", "IZBIRKOM_TOP_URL=" + top_url,
+        "-s", "PROGRESS_EXPECTED_COUNTS=" + json.dumps(expected_counts),
+    ]
+    for name, value in settings.items():
+        command.extend(["-s", "%s=%s" % (name, value)])
+    return run_crawl(command, output)
+
+
+def fetch(top_url, concurrency):
+    """Crawl the site with the asyncio engine in a subprocess, with
+    concurrency requests in flight per level.  Returns the same as crawl."""
+    output = tempfile.mktemp(suffix=".json")
+    command = [
+        sys.executable, "-m", "gosduma7.fetcher", "-o", output,
+        "--top-url", top_url, "--concurrency", str(concurrency),
+    ]
+    return run_crawl(command, output)
+
+
+PEAK_RSS_SCRIPT = """
+import os, subprocess, sys
+process = subprocess.Popen(sys.argv[1:])
+_, status, rusage = os.wait4(process.pid, 0)
+print(rusage.ru_maxrss)
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+"""Run a command, and print its peak memory.  A forked child counts the
+memory of its parent towards its peak until it execs, so we fork the
+command from this small script rather than from the benchmark."""
+
+
+def run_crawl(command, output):
+    """Run the crawl command in the project directory, and count the tables
+    that it wrote to output.  Returns as for crawl."""
+    project_dir = P.dirname(P.dirname(P.abspath(__file__)))
+    start = time.time()
+    process = subprocess.run(
+        [sys.executable, "-c", PEAK_RSS_SCRIPT] + command, cwd=project_dir,
+        stdout=subprocess.PIPE, check=True
+    )
+    elapsed = time.time() - start
+
+    with open(output, "rb") as fin:
+        num_tables = sum(1 for _ in fin)
+    os.unlink(output)
+    #
+    # ru_maxrss is in kilobytes on Linux.
+    #
+    return elapsed, int(process.stdout.split()[-1]) * 1024, num_tables
+
+
+def bench_crawl(number, repeat):
+    """Crawl a mock izbirkom server with different concurrency budgets.
+
+    Each request to the server takes about 200ms, and 1% of them fail.  The
+    crawl time is from the first request to the server to the last, which
+    leaves out the startup time of scrapy."""
+    print("%12s %10s %10s %10s %10s %10s" % (
+        "concurrency", "seconds", "pages", "pages/s", "tables", "peak MB"
+    ))
+    for concurrency in [1, 4, 8, 16]:
+        server = mockserver.MockServer(
+            latency=0.2, error_rate=0.01, regions=2, oiks=2
+        )
+        with server:
+            _, peak, num_tables = crawl(
+                server.top_url, server.site.expected_counts(),
+                {"ADAPTIVE_MAX_CONCURRENCY": concurrency}
+            )
+        pages = sum(server.counts.values())
+        elapsed = server.last_request - server.first_request
+        print("%12d %10.2f %10d %10.1f %10d %10.1f" % (
+            concurrency, elapsed, pages, pages / elapsed, num_tables,
+            peak / 1e6
+        ))
+
+
+def bench_engines(number, repeat):
+    """Crawl a mock izbirkom server with scrapy and with the asyncio engine
+    (gosduma7.fetcher), at the default concurrency of each.
+
+    The server is as for bench_crawl.  connections is the number of
+    connections that the engine opened: the server closes the connection
+    after each failed request."""
+    print("%-10s %10s %10s %10s %12s %10s %10s" % (
+        "engine", "seconds", "pages", "pages/s", "connections", "tables",
+        "peak MB"
+    ))
+    for engine in ["scrapy", "asyncio"]:
+        server = mockserver.MockServer(
+            latency=0.2, error_rate=0.01, regions=2, oiks=2
+        )
+        with server:
+            if engine == "scrapy":
+                _, peak, num_tables = crawl(
+                    server.top_url, server.site.expected_counts(), {}
+                )
+            else:
+                _, peak, num_tables = fetch(
+                    server.top_url, fetcher.CONCURRENCY
+                )
+        pages = sum(server.counts.values())
+        elapsed = server.last_request - server.first_request
+        print("%-10s %10.2f %10d %10.1f %12d %10d %10.1f" % (
+            engine, elapsed, pages, pages / elapsed, server.connections,
+            num_tables, peak / 1e6
+        ))
+
+
+def bench_shards(number, repeat):
+    """Crawl a mock izbirkom server with 1, 2 and 4 workers sharing the
+    work by region (see gosduma7.sharding).
+
+    The server is as for bench_crawl, with 4 regions, so that there is a
+    region for each worker.  The time is from the first request to the
+    server to the last."""
+    print("%8s %10s %10s %10s %10s %8s" % (
+        "workers", "seconds", "pages", "pages/s", "tables", "speedup"
+    ))
+    baseline = None
+    for workers in [1, 2, 4]:
+        server = mockserver.MockServer(
+            latency=0.2, error_rate=0.01, regions=4, oiks=2
+        )
+        path = tempfile.mkdtemp()
+        try:
+            with server:
+                shards = sharding.run(
+                    P.join(path, "shards.sqlite"), workers, path, {
+                        "IZBIRKOM_TOP_URL": server.top_url,
+                        "LOG_LEVEL": "WARNING",
+                        "PROGRESS_INTERVAL": 0,
+                    }
+                )
+            with open(os.devnull, "wb") as fout:
+                num_tables, _ = sharding.merge(shards, fout)
+        finally:
+            shutil.rmtree(path)
+        pages = sum(server.counts.values())
+        elapsed = server.last_request - server.first_request
+        baseline = baseline or elapsed
+        print("%8d %10.2f %10d %10.1f %10d %7.1fx" % (
+            workers, elapsed, pages, pages / elapsed, num_tables,
+            baseline / elapsed
+        ))
+
+
+def bench_cells(number, repeat):
+    """Compare per-cell xpath queries against the single-pass extractor."""
+    print("%-30s %6s %12s %12s %8s" % (
+        "page", "cells", "per-cell ms", "1-pass ms", "speedup"
+    ))
+    for filename, data_type in FIXTURES:
+        response = myspider.mock_response(filename)
+        root = response.selector
+        result = parsing.parse_voting_summary_table(response, data_type)
+        num_rows = len(root.xpath(parsing.XPATHS[data_type]["row_header"]))
+        row_numbers = (
+            list(range(parsing.FIRST_STAT, parsing.LAST_STAT)) +
+            list(range(parsing.FIRST_CANDIDATE, num_rows))
+        )
+        num_columns = len(result["column_headers"]) - 1
+
+        legacy = legacy_extract_cells(
+            root, data_type, row_numbers, num_columns
+        )
+        single_pass = single_pass_extract_cells(
+            root, data_type, row_numbers, num_columns
+        )
+        assert legacy == single_pass, "extractors disagree on %s" % filename
+
+        before = best_of(
+            lambda: legacy_extract_cells(
+                root, data_type, row_numbers, num_columns
+            ),
+            number, repeat
+        )
+        after = best_of(
+            lambda: single_pass_extract_cells(
+                root, data_type, row_numbers, num_columns
+            ),
+            number, repeat
+        )
+        print("%-30s %6d %12.3f %12.3f %7.1fx" % (
+            filename, len(row_numbers) * (num_columns + 1),
+            before * 1000, after * 1000, before / after
+        ))
+
+
+def walk_extract_cells(tables, row_numbers, column_numbers, path, decode):
+    """Extract the cells the way extract_cells used to: by walking the tree
+    from Python, one element at a time."""
+    tr_elements = []
+    if tables:
+        tr_elements = parsing.child_elements(tables[0], "tr")
+
+    matrix = []
+    for row_number in row_numbers:
+        td_elements = []
+        if row_number < len(tr_elements):
+            td_elements = parsing.child_elements(
+                tr_elements[row_number], "td"
+            )
+
+        matrix.append(
+            [
+                decode(
+                    list(td_elements[col_number].itertext()) if path is None
+                    else parsing.text_nodes(td_elements[col_number], path)
+                )
+                if col_number < len(td_elements) else decode([])
+                for col_number in column_numbers
+            ]
+        )
+    return matrix
+
+
+def summary_rows(response, data_type):
+    """Return the numbers of the rows that parse_voting_summary_table
+    extracts from the page."""
+    xpaths = parsing.COMPILED_XPATHS[data_type]
+    num_rows = len(xpaths["row_header"](response.selector.root))
+    return (
+        list(range(parsing.FIRST_STAT, parsing.LAST_STAT)) +
+        list(range(parsing.FIRST_CANDIDATE, num_rows))
+    )
+
+
+def bench_decode(number, repeat):
+    """Compare extracting and decoding the cells of each table the old way
+    (walking the tree from Python, joining, float() with try/except) against
+    extract_cells with the decoders."""
+    print("%-30s %6s %12s %12s %8s" % (
+        "page", "cells", "walk ms", "decode ms", "speedup"
+    ))
+    for filename, data_type in FIXTURES + TURNOUT_FIXTURES:
+        response = myspider.mock_response(filename)
+        root = response.selector.root
+        xpaths = parsing.COMPILED_XPATHS[data_type]
+        if data_type.startswith("turnout"):
+            num_rows = len(xpaths["row_header"](root))
+            kwargs = {
+                "tables": xpaths["table"](root),
+                "row_numbers": range(2, num_rows),
+                "column_numbers": [2, 3, 4, 5], "path": None
+            }
+            decode = parsing.decode_percentage
+
+            def legacy_decode(texts):
+                return myfloat(parsing.join(texts).rstrip("%"))
+        else:
+            num_columns = len(xpaths["col_header"](root))
+            kwargs = {
+                "tables": xpaths["cell_table"](root),
+                "row_numbers": summary_rows(response, data_type),
+                "column_numbers": range(num_columns), "path": ("nobr", "b")
+            }
+            decode = parsing.decode_count
+
+            def legacy_decode(texts):
+                return myfloat(parsing.join(texts))
+
+        def before():
+            return walk_extract_cells(decode=legacy_decode, **kwargs)
+
+        def after():
+            return parsing.extract_cells(decode=decode, **kwargs)
+
+        assert before() == after(), "decoders disagree on %s" % filename
+        num_cells = sum(len(row) for row in after())
+        before_seconds = best_of(before, number, repeat)
+        after_seconds = best_of(after, number, repeat)
+        print("%-30s %6d %12.3f %12.3f %7.1fx" % (
+            filename, num_cells, before_seconds * 1000,
+            after_seconds * 1000, before_seconds / after_seconds
+        ))
+
+
+def bench_pages(number, repeat):
+    """Compare string xpath expressions against the compiled ones, per page.
+
+    The string expressions run on a Selector that is already parsed, while
+    the parsers stream the page themselves (see parsing.parse_tree), so
+    the compiled timings include building the tree."""
+    print("%-30s %12s %12s %12s %8s" % (
+        "page", "data_type", "string ms", "compiled ms", "speedup"
+    ))
+    for filename, data_type in FIXTURES + TURNOUT_FIXTURES:
+        response = myspider.mock_response(filename)
+
+        expected = legacy_parse(response, data_type)
+        actual = parse(response, data_type)
+        for key, value in expected.items():
+            assert actual[key] == value, "%s: %s mismatch" % (filename, key)
+
+        before = best_of(
+            lambda: legacy_parse(response, data_type), number, repeat
+        )
+        after = best_of(lambda: parse(response, data_type), number, repeat)
+        print("%-30s %12s %12.3f %12.3f %7.1fx" % (
+            filename, data_type, before * 1000, after * 1000, before / after
+        ))
+
+
+def bench_replay(number, repeat):
+    """Measure how replaying a cached crawl scales with worker processes.
+
+    The cache contains number copies of each test page, under different
+    URLs."""
+    path = tempfile.mkdtemp()
+    try:
+        cache = htmlcache.HtmlCache(path)
+        for copy in range(number):
+            for filename, data_type in FIXTURES + TURNOUT_FIXTURES:
+                response = myspider.mock_response(filename)
+                cache.put(
+                    "%s?copy=%d" % (response.url, copy), response.body,
+                    hashlib.md5(response.body).hexdigest(), data_type,
+                    "utf-8", "",
+                )
+        num_pages = len(cache.entries())
+
+        print("%10s %10s %10s" % ("processes", "seconds", "pages/s"))
+        cpu_count = multiprocessing.cpu_count()
+        for processes in sorted({0, 1, 2, cpu_count}):
+            elapsed = min(
+                timed(lambda: htmlcache.replay(cache, io.BytesIO(), processes))
+                for _ in range(repeat)
+            )
+            print("%10d %10.2f %10.1f" % (
+                processes, elapsed, num_pages / elapsed
+            ))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_columnar(number, repeat):
+    """Compare loading the federal_uik tables from JSON and from columns."""
+    path = tempfile.mkdtemp()
+    try:
+        json_path, npz_path = write_synthetic_dataset(path)
+
+        def load_json():
+            with open(json_path, "rb") as fin:
+                tables = [json.loads(line.decode("utf-8")) for line in fin]
+            return [t for t in tables if t["data_type"] == "federal_uik"]
+
+        def load_columnar():
+            arrays = dataset.load_columnar(npz_path, data_type="federal_uik")
+            return arrays["value"].sum()
+
+        print("%-30s %10s %10s" % ("loader", "MB", "seconds"))
+        for name, function, file_path in [
+            ("json.loads, all tables", load_json, json_path),
+            ("load_columnar, memory-map", load_columnar, npz_path),
+        ]:
+            elapsed = min(timed(function) for _ in range(repeat))
+            print("%-30s %10.1f %10.3f" % (
+                name, P.getsize(file_path) / 1e6, elapsed
+            ))
+    finally:
+        shutil.rmtree(path)
+
+
+def peak_memory(function):
+    """Return the peak memory allocated while calling function, in bytes."""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def peak_rss(function):
+    """Return how much the peak resident memory grows while calling function
+    in a forked process, in bytes.  Unlike peak_memory, this includes what
+    libxml2 allocates."""
+    def measure(connection):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        function()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        connection.send((after - before) * 1024)
+
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=measure, args=(sender,))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def selector_cells(body, encoding, data_type):
+    """Decode the cells the way the parsers did before parse_tree: build a
+    Selector for the whole page, then extract the data tables from it."""
+    response = scrapy.http.HtmlResponse(
+        "http://localhost/", body=body, encoding=encoding
+    )
+    root = response.selector.root
+    xpaths = parsing.COMPILED_XPATHS[data_type]
+    if data_type.startswith("turnout"):
+        num_rows = len(xpaths["row_header"](root))
+        return [parsing.extract_cells(
+            xpaths["table"](root), range(1, num_rows), [2, 3, 4, 5],
+            path=None, decode=parsing.decode_percentage
+        )]
+    num_rows = len(xpaths["row_header"](root))
+    num_columns = len(xpaths["col_header"](root))
+    return [
+        parsing.extract_cells(
+            xpaths["total_table"](root), range(1, num_rows), [2],
+            decode=parsing.decode_count
+        ),
+        parsing.extract_cells(
+            xpaths["cell_table"](root), range(1, num_rows),
+            range(num_columns), decode=parsing.decode_count
+        ),
+    ]
+
+
+def streamed_cells(body, encoding, data_type):
+    """Decode the same cells as selector_cells with parse_tree."""
+    xpaths = parsing.COMPILED_XPATHS[data_type]
+    if data_type.startswith("turnout"):
+        tables = [parsing.StreamedTable(
+            xpaths["table"], [2, 3, 4, 5], None, parsing.decode_percentage
+        )]
+    else:
+        tables = [
+            parsing.StreamedTable(
+                xpaths["total_table"], [2], ("nobr", "b"),
+                parsing.decode_count
+            ),
+            parsing.StreamedTable(
+                xpaths["cell_table"], None, ("nobr", "b"),
+                parsing.decode_count
+            ),
+        ]
+    root, decoded = parsing.parse_tree(body, encoding, tables)
+    num_rows = len(xpaths["row_header"](root))
+    return [
+        parsing.decoded_rows(rows, range(1, num_rows), len(table.columns))
+        if table.columns else
+        parsing.decoded_rows(
+            rows, range(1, num_rows), len(xpaths["col_header"](root))
+        )
+        for (table, rows) in zip(tables, decoded)
+    ]
+
+
+def bench_tree(number, repeat):
+    """Compare building a Selector and then extracting the tables against
+    parse_tree, which streams the pages over STREAM_THRESHOLD bytes.
+
+    The pages come from the mock server, in windows-1251 like the real
+    ones, at the usual size and widened to WIDE_UIKS polling stations."""
+    print("%-24s %8s %12s %12s %8s %10s %10s" % (
+        "page", "KB", "selector ms", "stream ms", "speedup", "sel. MB",
+        "stream MB"
+    ))
+    for uiks in [34, WIDE_UIKS]:
+        site = mockserver.MockSite("http://localhost", tiks=9, uiks=uiks)
+        for data_type in ["federal", "turnout", "federal_uik",
+                          "turnout_uik"]:
+            if uiks != 34 and not data_type.endswith("_uik"):
+                continue
+            body = site.page(data_type, "0.0.0")
+            args = (body, mockserver.ENCODING, data_type)
+            assert selector_cells(*args) == streamed_cells(*args), \
+                "parsers disagree on %s" % data_type
+
+            before = best_of(lambda: selector_cells(*args), number, repeat)
+            after = best_of(lambda: streamed_cells(*args), number, repeat)
+            print("%-24s %8d %12.2f %12.2f %7.1fx %10.1f %10.1f" % (
+                "%s x%d" % (data_type, uiks), len(body) // 1024,
+                before * 1000, after * 1000, before / after,
+                peak_rss(lambda: selector_cells(*args)) / 1e6,
+                peak_rss(lambda: streamed_cells(*args)) / 1e6
+            ))
+
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import %s
+from gosduma7.parsing import parse_page
+imported = time.perf_counter()
+with open(%r, "rb") as fin:
+    parse_page("file:///", fin.read(), "utf-8", "federal")
+print(imported - start, time.perf_counter() - start)
+"""
+
+
+def bench_startup(number, repeat):
+    """Compare the time to import the parsers, and to get the first result
+    out of them, from the spider module against gosduma7.parsing, each in a
+    fresh interpreter."""
+    project_dir = P.dirname(P.dirname(P.abspath(__file__)))
+    page = P.join(myspider.CURR_DIR, "test_parse.html")
+    print("%-28s %10s %16s" % ("module", "import ms", "first result ms"))
+    for module in ["gosduma7.spiders.myspider", "gosduma7.parsing"]:
+        timings = []
+        for _ in range(repeat):
+            output = subprocess.check_output(
+                [sys.executable, "-c", STARTUP_SCRIPT % (module, page)],
+                cwd=project_dir
+            )
+            timings.append([float(value) for value in output.split()])
+        imported, first_result = min(timings, key=lambda t: t[1])
+        print("%-28s %10.1f %16.1f" % (
+            module, imported * 1000, first_result * 1000
+        ))
+
+
+def bench_loader(number, repeat):
+    """Compare loading all of results.json against streaming it."""
+    path = tempfile.mkdtemp()
+    try:
+        json_path, _ = write_synthetic_dataset(path)
+
+        def load_all(data_type, region):
+            with open(json_path, "rb") as fin:
+                tables = [json.loads(line.decode("utf-8")) for line in fin]
+            tables = [t for t in tables if t["data_type"] == data_type]
+            if region:
+                tables = list(dataset.filter_region(tables, region))
+            return len(tables)
+
+        def stream(data_type, region):
+            return sum(
+                1 for _ in dataset.iter_tables(json_path, data_type, region)
+            )
+
+        print("%-12s %-12s %-10s %8s %10s %10s" % (
+            "data_type", "region", "loader", "tables", "seconds", "peak MB"
+        ))
+        for data_type, region in [
+            ("federal_uik", None), ("federal", None), ("federal_uik", "№7$")
+        ]:
+            for name, function in [("load all", load_all), ("stream", stream)]:
+                count = function(data_type, region)
+                elapsed = min(
+                    timed(lambda: function(data_type, region))
+                    for _ in range(repeat)
+                )
+                peak = peak_memory(lambda: function(data_type, region))
+                print("%-12s %-12s %-10s %8d %10.3f %10.1f" % (
+                    data_type, region, name, count, elapsed, peak / 1e6
+                ))
+    finally:
+        shutil.rmtree(path)
+
+
+def notebook_station_generator(tables):
+    """Yield the polling stations, the way Graphs.ipynb does."""
+    headers = None
+    for table in [t for t in tables if t["data_type"] == "federal_uik"]:
+        headers = headers or table["row_headers"]
+        party_idx = range(stations.FIRST_PARTY, len(headers))
+        data = table["data"]
+        eligible_voters = data[headers.index(stations.ELIGIBLE_VOTERS)]
+        valid_ballots = data[headers.index(stations.VALID_BALLOTS)]
+        for st_idx, st_name in enumerate(table["column_headers"]):
+            if st_idx == 0:
+                continue
+            try:
+                station = {
+                    "region": table["region"],
+                    "local_ik": st_name,
+                    "fraction": [],
+                    "votes": [],
+                    "turnout": valid_ballots[st_idx] / eligible_voters[st_idx]
+                }
+                for i in party_idx:
+                    raw_votes = table["data"][i][st_idx]
+                    station["votes"].append(raw_votes)
+                    station["fraction"].append(
+                        raw_votes / valid_ballots[st_idx]
+                    )
+                yield station
+            except ZeroDivisionError:
+                pass
+
+
+def notebook_bin_by(station_list, key_function, a=stations.BIN_WIDTH):
+    """Bin each polling station, the way Graphs.ipynb does."""
+    bins = collections.defaultdict(list)
+    for station in station_list:
+        bins[round(key_function(station) / a) * a].append(station)
+    return sorted(bins.items())
+
+
+def bench_stations(number, repeat):
+    """Compare the Graphs.ipynb station dicts against the station arrays."""
+    tables = list(
+        t for t in synthetic_tables() if t["data_type"] == "federal_uik"
+    )
+    party = 3
+
+    def notebook():
+        station_list = list(notebook_station_generator(tables))
+        bins = notebook_bin_by(
+            station_list, lambda st: st["fraction"][party]
+        )
+        return (
+            [x for (x, _) in bins],
+            [sum(st["votes"][party] for st in sts) for (_, sts) in bins]
+        )
+
+    def build():
+        return stations.station_matrix(tables)
+
+    matrix = build()
+
+    def vectorized():
+        return stations.votes_by_share(matrix, party)
+
+    expected_x, expected_y = notebook()
+    actual_x, actual_y = vectorized()
+    assert len(expected_x) == len(actual_x), "different number of bins"
+    assert max(abs(e - a) for (e, a) in zip(expected_y, actual_y)) < 1e-6
+
+    print("%d stations" % len(matrix.names))
+    print("%-40s %10s" % ("step", "seconds"))
+    for name, function in [
+        ("notebook: station dicts + bin_by", notebook),
+        ("station_matrix", build),
+        ("votes_by_share (bincount)", vectorized),
+    ]:
+        elapsed = min(timed(function) for _ in range(repeat))
+        print("%-40s %10.4f" % (name, elapsed))
+
+
+def bench_database(number, repeat):
+    """Compare the ER share per UIK in a region, the way Graphs.ipynb gets
+    it, against a query of the SQLite database."""
+    path = tempfile.mkdtemp()
+    try:
+        json_path, _ = write_synthetic_dataset(path)
+        database_path = P.join(path, "results.sqlite")
+        import_seconds = timed(
+            lambda: database.import_tables(json_path, database_path)
+        )
+        start = time.time()
+        with open(json_path, "rb") as fin:
+            tables = [json.loads(line.decode("utf-8")) for line in fin]
+        load_seconds = time.time() - start
+        region = "регион №42$"
+        party = stations.EDINAYA_ROSSIYA
+
+        def notebook():
+            selected = list(
+                dataset.filter_region(
+                    dataset.filter_type(tables, "federal_uik"), region
+                )
+            )
+            headers = selected[0]["row_headers"]
+            party_row = headers.index(party)
+            valid_row = headers.index(stations.VALID_BALLOTS)
+            return [
+                table["data"][party_row][i] / table["data"][valid_row][i]
+                for table in selected
+                for i in range(1, len(table["column_headers"]))
+                if table["data"][valid_row][i] > 0
+            ]
+
+        db = database.Database(database_path)
+
+        def query():
+            return [
+                share for (_, _, _, _, share) in db.shares(
+                    "federal_uik", party, stations.VALID_BALLOTS, region
+                )
+            ]
+
+        expected, actual = notebook(), query()
+        assert len(expected) == len(actual) and max(
+            abs(e - a) for (e, a) in zip(expected, actual)
+        ) < 1e-9, "the query and the notebook disagree"
+
+        print("%d tables, %d stations in the region, database %.1f MB" % (
+            len(tables), len(actual), P.getsize(database_path) / 1e6
+        ))
+        print("%-40s %10s" % ("step", "seconds"))
+        for name, elapsed in [
+            ("import into SQLite", import_seconds),
+            ("notebook: load results.json", load_seconds),
+            ("notebook: filter + station loop", best_of(
+                notebook, number, repeat
+            )),
+            ("SQLite: indexed query", best_of(query, number, repeat)),
+        ]:
+            print("%-40s %10.4f" % (name, elapsed))
+        db.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_export(number, repeat):
+    """Compare writing results.json a line at a time with json.dumps (the
+    way LineExporter used to) against the buffered exporters."""
+    tables = list(synthetic_tables())
+    path = tempfile.mkdtemp()
+
+    def legacy(fout):
+        for table in tables:
+            data = json.dumps(table, ensure_ascii=False) + "\n"
+            fout.write(data.encode("utf-8"))
+
+    def exporter(cls, **kwargs):
+        def export(fout):
+            exporter = cls(fout, **kwargs)
+            exporter.start_exporting()
+            for table in tables:
+                exporter.export_item(table)
+            exporter.finish_exporting()
+        return export
+
+    candidates = [
+        ("json.dumps, a line at a time", legacy, "results.json"),
+        ("LineExporter", exporter(pipelines.LineExporter), "results.json"),
+        ("LineExporter, gzip", exporter(
+            pipelines.LineExporter, compression="gzip"
+        ), "results.json.gz"),
+        ("CompactLineExporter", exporter(
+            pipelines.CompactLineExporter
+        ), "results.json"),
+        ("CompactLineExporter, gzip", exporter(
+            pipelines.CompactLineExporter, compression="gzip"
+        ), "results.json.gz"),
+    ]
+    if pipelines.zstandard is not None:
+        candidates.append(("LineExporter, zstd", exporter(
+            pipelines.LineExporter, compression="zstd"
+        ), "results.json.zst"))
+
+    print("%d tables, JSON encoder: %s" % (
+        len(tables), "orjson" if dataset.orjson is not None else "json"
+    ))
+    print("%-40s %10s %10s" % ("exporter", "MB", "seconds"))
+    try:
+        for name, function, filename in candidates:
+            file_path = P.join(path, filename)
+
+            def write():
+                with open(file_path, "wb") as fout:
+                    function(fout)
+
+            elapsed = min(timed(write) for _ in range(repeat))
+            print("%-40s %10.1f %10.3f" % (
+                name, P.getsize(file_path) / 1e6, elapsed
+            ))
+    finally:
+        shutil.rmtree(path)
+
+
+def notebook_region_summary(tables):
+    """Check the row totals and count the OIKs, TIKs and UIKs of each
+    region, the way Introduction.ipynb does."""
+    summary_types = ("federal", "single")
+    for table in [t for t in tables if t["data_type"] in summary_types]:
+        for i, _ in enumerate(table["row_headers"]):
+            assert table["data"][i][0] == sum(table["data"][i][1:])
+
+    federal = [t for t in tables if t["data_type"] == "federal"]
+    federal_uik = [t for t in tables if t["data_type"] == "federal_uik"]
+    oik_counter = collections.Counter(t["region"] for t in federal)
+    rows = []
+    for region, num_oik in sorted(oik_counter.items()):
+        region_tables = [t for t in federal if t["region"] == region]
+        num_tik = sum([(len(t["column_headers"]) - 1) for t in region_tables])
+        region_tables_uik = [t for t in federal_uik if t["region"] == region]
+        num_uik = sum(
+            [(len(t["column_headers"]) - 1) for t in region_tables_uik]
+        )
+        rows.append([region, num_oik, num_tik, num_uik])
+    return rows
+
+
+def index_region_summary(index):
+    """Do the same as notebook_region_summary with the hierarchy index."""
+    #
+    # The synthetic federal_uik tables don't add up to their OIK tables, so
+    # only check the row totals, like the notebook does.
+    #
+    assert not index.row_mismatches
+    rows = []
+    for region in index.child_names():
+        counts = index.counts(region)
+        rows.append([region, counts["oik"], counts["tik"], counts["uik"]])
+    return rows
+
+
+def bench_hierarchy(number, repeat):
+    """Compare the Introduction.ipynb checks against the hierarchy index,
+    built from scratch, loaded from disk and updated with new tables."""
+    path = tempfile.mkdtemp()
+    try:
+        json_path, _ = write_synthetic_dataset(path)
+        index_path = P.join(path, "results.index")
+        with open(json_path, "rb") as fin:
+            tables = [json.loads(line.decode("utf-8")) for line in fin]
+        index = hierarchy.build(json_path, index_path)
+        assert notebook_region_summary(tables) == index_region_summary(index)
+
+        #
+        # Republish 1% of the federal tables, as an incremental crawl would.
+        #
+        republished = [t for t in tables if t["data_type"] == "federal"]
+        republished = republished[::100]
+
+        size = P.getsize(json_path)
+
+        def update():
+            shutil.copy(index_path, index_path + ".bak")
+            with open(json_path, "ab") as fout:
+                for table in republished:
+                    data = json.dumps(table, ensure_ascii=False) + "\n"
+                    fout.write(data.encode("utf-8"))
+            try:
+                return timed(lambda: hierarchy.build(json_path, index_path))
+            finally:
+                os.replace(index_path + ".bak", index_path)
+                os.truncate(json_path, size)
+
+        print("%d tables" % len(tables))
+        print("%-40s %10s" % ("step", "seconds"))
+        def load_json():
+            with open(json_path, "rb") as fin:
+                return [json.loads(line.decode("utf-8")) for line in fin]
+
+        for name, elapsed in [
+            ("notebook: load results.json", min(
+                timed(load_json) for _ in range(repeat)
+            )),
+            ("notebook: checks + region summary", min(
+                timed(lambda: notebook_region_summary(tables))
+                for _ in range(repeat)
+            )),
+            ("index: build from scratch", min(
+                timed(lambda: hierarchy.build(json_path))
+                for _ in range(repeat)
+            )),
+            ("index: load, nothing new", min(
+                timed(lambda: hierarchy.build(json_path, index_path))
+                for _ in range(repeat)
+            )),
+            ("index: load, %d new tables" % len(republished), min(
+                update() for _ in range(repeat)
+            )),
+            ("index: checks + region summary", min(
+                timed(lambda: index_region_summary(index))
+                for _ in range(repeat)
+            )),
+        ]:
+            print("%-40s %10.4f" % (name, elapsed))
+    finally:
+        shutil.rmtree(path)
+
+
+BENCHMARKS = {
+    "cells": bench_cells,
+    "columnar": bench_columnar,
+    "crawl": bench_crawl,
+    "database": bench_database,
+    "decode": bench_decode,
+    "engines": bench_engines,
+    "export": bench_export,
+    "hierarchy": bench_hierarchy,
+    "loader": bench_loader,
+    "pages": bench_pages,
+    "replay": bench_replay,
+    "shards": bench_shards,
+    "startup": bench_startup,
+    "stations": bench_stations,
+    "throughput": bench_throughput,
+    "tree": bench_tree,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "benchmarks", nargs="*",
+        help="benchmarks to run: %s (default: all)" % ", ".join(
+            sorted(BENCHMARKS)
+        )
+    )
+    parser.add_argument(
+        "--number", type=int, default=20, help="calls per timing run"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="number of timing runs"
+    )
+    parser.add_argument(
+        "--baseline", help="fail if throughput is worse than in this file"
+    )
+    parser.add_argument(
+        "--save-baseline", help="save the throughput results to this file"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="how much slower than the baseline is acceptable (default: 0.2)"
+    )
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+
+    throughput = None
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        results = BENCHMARKS[name](args.number, args.repeat)
+        if name == "throughput":
+            throughput = results
+        print()
+
+    if throughput is None:
+        return
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fout:
+            json.dump(throughput, fout, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        messages = regressions(throughput, baseline, args.tolerance)
+        for message in messages:
+            print("REGRESSION: %s" % message)
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
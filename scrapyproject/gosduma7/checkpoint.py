@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""An on-disk record of the crawl, so that a crawl can resume where it died.
+
+The frontier table holds every request the spider has made, along with the
+name of its callback, its priority and its meta, and whether its response
+has been handled yet.  The items table holds the url and md5 of every table
+that has been written out.
+
+The shards table holds the regions of a crawl that is split between
+several workers, along with the worker that claimed each of them and
+whether it is done.  Several processes can share it: claiming a shard is
+a single statement, so no two workers get the same one.
+
+See CheckpointMiddleware and ShardMiddleware for how the crawl uses it.
+"""
+import json
+import os.path as P
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frontier (
+    url TEXT PRIMARY KEY,
+    callback TEXT,
+    priority INTEGER,
+    meta TEXT,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS frontier_status ON frontier (status);
+CREATE TABLE IF NOT EXISTS items (
+    url TEXT,
+    md5 TEXT,
+    PRIMARY KEY (url, md5)
+);
+CREATE TABLE IF NOT EXISTS shards (
+    url TEXT PRIMARY KEY,
+    callback TEXT,
+    priority INTEGER,
+    worker TEXT,
+    status TEXT
+);
+"""
+
+
+class Checkpoint(object):
+    """A SQLite database of the requests and items of a crawl."""
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        #
+        # Workers that share the database wait up to timeout seconds for
+        # each other's writes.
+        #
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        #
+        # We commit after every response, so make commits cheap.  We may
+        # lose the last few commits if the machine crashes, which only
+        # means fetching a few pages again.
+        #
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def is_empty(self):
+        cursor = self.connection.execute("SELECT 1 FROM frontier LIMIT 1")
+        return cursor.fetchone() is None
+
+    def add_request(self, url, callback, priority, meta):
+        """Add the request to the frontier, unless it's already there.
+
+        Returns False if the request has already been handled."""
+        status = self.status(url)
+        if status == DONE:
+            return False
+        if status is None:
+            self.connection.execute(
+                "INSERT INTO frontier VALUES (?, ?, ?, ?, ?)",
+                (url, callback, priority, json.dumps(meta), PENDING)
+            )
+        return True
+
+    def status(self, url):
+        row = self.connection.execute(
+            "SELECT status FROM frontier WHERE url = ?", (url,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_status(self, url, status):
+        self.connection.execute(
+            "UPDATE frontier SET status = ? WHERE url = ?", (status, url)
+        )
+
+    def outstanding(self):
+        """Return (url, callback, priority, meta) for the requests that
+        still need handling, highest priority first."""
+        cursor = self.connection.execute(
+            "SELECT url, callback, priority, meta FROM frontier "
+            "WHERE status != ? ORDER BY priority DESC", (DONE,)
+        )
+        return [
+            (url, callback, priority, json.loads(meta))
+            for (url, callback, priority, meta) in cursor
+        ]
+
+    def add_item(self, url, md5):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO items VALUES (?, ?)", (url, md5)
+        )
+
+    def has_item(self, url, md5):
+        row = self.connection.execute(
+            "SELECT 1 FROM items WHERE url = ? AND md5 = ?", (url, md5)
+        ).fetchone()
+        return row is not None
+
+    def counts(self):
+        """Return the number of requests with each status."""
+        return dict(self.connection.execute(
+            "SELECT status, COUNT(*) FROM frontier GROUP BY status"
+        ))
+
+    def add_shard(self, url, callback, priority):
+        """Add the request that starts a shard, unless it's already
+        there."""
+        self.connection.execute(
+            "INSERT OR IGNORE INTO shards VALUES (?, ?, ?, NULL, ?)",
+            (url, callback, priority, PENDING)
+        )
+
+    def claim_shard(self, worker):
+        """Claim a pending shard for the worker, or one that the worker
+        claimed before and didn't finish, e.g. because it died.
+
+        Returns (url, callback, priority), or None if there are no shards
+        left."""
+        row = self.connection.execute(
+            "UPDATE shards SET worker = ?, status = ? WHERE url = ("
+            "  SELECT url FROM shards"
+            "  WHERE status = ? OR (status = ? AND worker = ?)"
+            "  ORDER BY status = ? DESC, priority DESC, rowid LIMIT 1"
+            ") RETURNING url, callback, priority",
+            (worker, CLAIMED, PENDING, CLAIMED, worker, CLAIMED)
+        ).fetchone()
+        self.connection.commit()
+        return row
+
+    def finish_shard(self, url, status):
+        self.connection.execute(
+            "UPDATE shards SET status = ? WHERE url = ?", (status, url)
+        )
+        self.connection.commit()
+
+    def retry_failed_shards(self):
+        """Make the failed shards pending again.  Returns how many there
+        were."""
+        cursor = self.connection.execute(
+            "UPDATE shards SET status = ?, worker = NULL WHERE status = ?",
+            (PENDING, FAILED)
+        )
+        self.connection.commit()
+        return cursor.rowcount
+
+    def shards(self):
+        """Return (url, worker, status) for each shard."""
+        return self.connection.execute(
+            "SELECT url, worker, status FROM shards ORDER BY rowid"
+        ).fetchall()
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.checkpoint = Checkpoint(P.join(self.path, "crawl.sqlite"))
+
+    def tearDown(self):
+        self.checkpoint.close()
+        shutil.rmtree(self.path)
+
+    def test_frontier(self):
+        self.assertTrue(self.checkpoint.is_empty())
+        self.assertTrue(self.checkpoint.add_request("a", "parse", 0, {}))
+        self.assertTrue(
+            self.checkpoint.add_request("b", "cb", 5, {"conditional": True})
+        )
+        self.checkpoint.set_status("a", DONE)
+        self.checkpoint.commit()
+
+        checkpoint = Checkpoint(self.checkpoint.path)
+        self.assertFalse(checkpoint.add_request("a", "parse", 0, {}))
+        self.assertEqual(
+            checkpoint.outstanding(), [("b", "cb", 5, {"conditional": True})]
+        )
+        self.assertEqual(checkpoint.counts(), {DONE: 1, PENDING: 1})
+        checkpoint.close()
+
+    def test_items(self):
+        self.checkpoint.add_item("a", "1")
+        self.checkpoint.add_item("a", "1")
+        self.assertTrue(self.checkpoint.has_item("a", "1"))
+        self.assertFalse(self.checkpoint.has_item("a", "2"))
+
+    def test_shards(self):
+        for url in ["a", "b", "c"]:
+            self.checkpoint.add_shard(url, "parse_level1", 50)
+        self.checkpoint.add_shard("a", "parse_level1", 50)
+        self.checkpoint.commit()
+
+        other = Checkpoint(self.checkpoint.path)
+        self.assertEqual(
+            self.checkpoint.claim_shard("w1"), ("a", "parse_level1", 50)
+        )
+        self.assertEqual(other.claim_shard("w2")[0], "b")
+        self.checkpoint.finish_shard("a", FAILED)
+        #
+        # A worker that restarts gets its unfinished shard back first.
+        #
+        self.assertEqual(other.claim_shard("w2")[0], "b")
+        other.finish_shard("b", DONE)
+        self.assertEqual(other.claim_shard("w2")[0], "c")
+        self.assertIsNone(self.checkpoint.claim_shard("w1"))
+
+        self.assertEqual(other.retry_failed_shards(), 1)
+        self.assertEqual(self.checkpoint.claim_shard("w1")[0], "a")
+        self.assertEqual(other.shards(), [
+            ("a", "w1", CLAIMED), ("b", "w2", DONE), ("c", "w2", CLAIMED),
+        ])
+        other.close()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""A compact representation of the scraped tables.
+
+Most of results.json is the same few dozen row headers (ballot statistics
+and party names), repeated in every table, and the numbers in the data
+matrix written out as text.  In the compact representation:
+
+  - The headers are interned.  Whenever a table refers to headers that
+    haven't been seen before, a header record precedes it:
+
+        {"record": "headers", "first_id": 32, "headers": ["...", ...]}
+
+    The row_headers and column_headers of the table are then lists of ids.
+    The ids count from zero, in the order that the headers were first seen.
+    A header record with first_id 0 starts over with a new dictionary, which
+    is what a resumed crawl appending to the same file writes.
+
+  - The data is a flat array of little-endian int32 (if all the values are
+    ints) or float32 values, encoded in base64:
+
+        {"type": "i", "shape": [32, 7], "values": "..."}
+
+Everything else in the table stays the same.  See CompactLineExporter for
+writing, and gosduma7.dataset.iter_tables for reading.
+"""
+import array
+import base64
+import sys
+import unittest
+
+HEADERS_RECORD = "headers"
+
+HEADERS_PREFIX = b'{"record":'
+"""How header records start, so that readers can spot them cheaply.  Tables
+don't have a record field."""
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+class HeaderDictionary(object):
+    """Assigns ids to headers, in the order they are first seen."""
+
+    def __init__(self):
+        self.ids = {}
+        self.headers = []
+
+    def intern(self, headers):
+        """Return the ids of the headers, adding the unseen ones."""
+        ids = []
+        for header in headers:
+            if header not in self.ids:
+                self.ids[header] = len(self.headers)
+                self.headers.append(header)
+            ids.append(self.ids[header])
+        return ids
+
+    def update(self, record):
+        """Add the headers from a header record.
+
+        A record that starts at 0 replaces the headers seen so far."""
+        if record["first_id"] == 0:
+            self.ids = {}
+            self.headers = []
+        elif record["first_id"] != len(self.headers):
+            raise ValueError("missing headers: expected first_id %d, got %d"
+                             % (len(self.headers), record["first_id"]))
+        for header in record["headers"]:
+            self.ids[header] = len(self.headers)
+            self.headers.append(header)
+
+    def lookup(self, ids):
+        """Return the headers for the ids."""
+        return [self.headers[i] for i in ids]
+
+
+def _to_little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def encode_data(data):
+    """Encode the data matrix (a list of lists of numbers)."""
+    flat = [value for row in data for value in row]
+    if all(
+        type(value) is int and INT32_MIN <= value <= INT32_MAX
+        for value in flat
+    ):
+        values = array.array("i", [int(value) for value in flat])
+    else:
+        values = array.array("f", flat)
+
+    num_columns = len(data[0]) if data else 0
+    return {
+        "type": values.typecode,
+        "shape": [len(data), num_columns],
+        "values": base64.b64encode(
+            _to_little_endian(values).tobytes()
+        ).decode("ascii")
+    }
+
+
+def decode_data(encoded):
+    """Decode the data matrix back into a list of lists of numbers.
+
+    Integer matrices come back as ints, like the counts the spider scrapes.
+    The float32 values are rounded to the shortest decimal that rounds back
+    to the same float32, so the turnout percentages come back as written."""
+    values = array.array(encoded["type"])
+    values.frombytes(base64.b64decode(encoded["values"]))
+    _to_little_endian(values)
+
+    if encoded["type"] == "f":
+        values = [float("%.7g" % value) for value in values]
+    else:
+        values = values.tolist()
+
+    num_rows, num_columns = encoded["shape"]
+    return [
+        values[row * num_columns:(row + 1) * num_columns]
+        for row in range(num_rows)
+    ]
+
+
+def compact_table(table, dictionary):
+    """Return the header record (or None) and the compact table."""
+    num_headers = len(dictionary.headers)
+    compact = dict(table)
+    compact["row_headers"] = dictionary.intern(table["row_headers"])
+    compact["column_headers"] = dictionary.intern(table["column_headers"])
+    compact["data"] = encode_data(table["data"])
+
+    header_record = None
+    if len(dictionary.headers) > num_headers:
+        header_record = {
+            "record": HEADERS_RECORD,
+            "first_id": num_headers,
+            "headers": dictionary.headers[num_headers:]
+        }
+    return header_record, compact
+
+
+def is_compact(table):
+    return isinstance(table.get("data"), dict)
+
+
+def expand_table(table, dictionary):
+    """Expand a compact table back into the usual representation."""
+    table["row_headers"] = dictionary.lookup(table["row_headers"])
+    table["column_headers"] = dictionary.lookup(table["column_headers"])
+    table["data"] = decode_data(table["data"])
+    return table
+
+
+class CompactTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        tables = [
+            {
+                "region": "a", "row_headers": ["x", "y"],
+                "column_headers": ["Сумма", "1"],
+                "data": [[3, 3], [-1, 4]],
+            },
+            {
+                "region": "b", "row_headers": ["x", "z"],
+                "column_headers": ["10:00", "12:00"],
+                "data": [[7.04, 16.64], [29.56, 100.0]],
+            },
+        ]
+        writer = HeaderDictionary()
+        reader = HeaderDictionary()
+        for table in tables:
+            header_record, compact = compact_table(table, writer)
+            reader.update(header_record)
+            self.assertEqual(expand_table(compact, reader), table)
+
+        self.assertEqual(
+            writer.headers, ["x", "y", "Сумма", "1", "z", "10:00", "12:00"]
+        )
+
+    def test_no_new_headers(self):
+        dictionary = HeaderDictionary()
+        table = {"row_headers": ["x"], "column_headers": [], "data": [[1]]}
+        compact_table(table, dictionary)
+        header_record, compact = compact_table(table, dictionary)
+        self.assertIsNone(header_record)
+        self.assertEqual(compact["data"]["type"], "i")
+
+    def test_whole_floats(self):
+        data = [[50.0, 100.0], [0.0, 25.0]]
+        encoded = encode_data(data)
+        self.assertEqual(encoded["type"], "f")
+        decoded = decode_data(encoded)
+        self.assertEqual(decoded, data)
+        self.assertIsInstance(decoded[0][0], float)
+
+    def test_restart(self):
+        tables = [
+            {"row_headers": ["x"], "column_headers": ["y"], "data": [[1]]},
+            {"row_headers": ["z"], "column_headers": ["y"], "data": [[2]]},
+        ]
+        reader = HeaderDictionary()
+        for table in tables:
+            # A fresh writer each time, like a crawl resumed on the same file.
+            header_record, compact = compact_table(table, HeaderDictionary())
+            self.assertEqual(header_record["first_id"], 0)
+            reader.update(header_record)
+            self.assertEqual(expand_table(compact, reader), table)
+        self.assertEqual(reader.headers, ["z", "y"])
+
+    def test_missing_headers(self):
+        dictionary = HeaderDictionary()
+        with self.assertRaises(ValueError):
+            dictionary.update({
+                "record": HEADERS_RECORD, "first_id": 2, "headers": ["x"]
+            })
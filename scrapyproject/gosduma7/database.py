@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""The scraped tables in a SQLite database, for indexed queries.
+
+The tables table holds one row per scraped table, the headers table holds
+each distinct row and column header once, and the cells table holds one row
+per cell of each table.  Write the database during the crawl with
+SQLitePipeline, or import an existing results.json:
+
+    python -m gosduma7.database results.json results.sqlite
+
+Then, for example, for the share of the vote for United Russia at each
+polling station in Saratov:
+
+    db = database.Database("results.sqlite")
+    db.shares("federal_uik", stations.EDINAYA_ROSSIYA,
+              stations.VALID_BALLOTS, region="саратов")
+"""
+import argparse
+import json
+import logging
+import os.path as P
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from gosduma7 import dataset
+
+LOGGER = logging.getLogger(__name__)
+
+TABLE_FIELDS = [
+    "url", "md5", "timestamp", "data_type", "region", "area_ik",
+    "area_ik_long", "territory_ik"
+]
+"""The fields of a scraped table that go into the tables table."""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tables (
+    id INTEGER PRIMARY KEY,
+    url TEXT UNIQUE,
+    md5 TEXT,
+    timestamp TEXT,
+    data_type TEXT,
+    region TEXT,
+    area_ik TEXT,
+    area_ik_long TEXT,
+    territory_ik TEXT
+);
+CREATE INDEX IF NOT EXISTS tables_region ON tables (region);
+CREATE INDEX IF NOT EXISTS tables_area_ik ON tables (area_ik);
+CREATE INDEX IF NOT EXISTS tables_territory_ik ON tables (territory_ik);
+CREATE INDEX IF NOT EXISTS tables_data_type ON tables (data_type, region);
+CREATE TABLE IF NOT EXISTS headers (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS row_headers (
+    table_id INTEGER REFERENCES tables (id),
+    number INTEGER,
+    header_id INTEGER REFERENCES headers (id),
+    PRIMARY KEY (table_id, number)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS row_headers_header
+    ON row_headers (header_id, table_id);
+CREATE TABLE IF NOT EXISTS column_headers (
+    table_id INTEGER REFERENCES tables (id),
+    number INTEGER,
+    header_id INTEGER REFERENCES headers (id),
+    PRIMARY KEY (table_id, number)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS column_headers_header
+    ON column_headers (header_id, table_id);
+CREATE TABLE IF NOT EXISTS cells (
+    table_id INTEGER REFERENCES tables (id),
+    row_number INTEGER,
+    column_number INTEGER,
+    value NUMERIC,
+    PRIMARY KEY (table_id, row_number, column_number)
+) WITHOUT ROWID;
+"""
+"""The cells are clustered by table, row and column, so the cells of a row
+of a table are next to each other on disk, and there are no other indexes
+on the cells to keep up to date.  Queries by header go through the much
+smaller row_headers and column_headers tables."""
+
+SHARES_QUERY = """
+SELECT t.region, t.area_ik, t.territory_ik, h.name,
+       1.0 * part.value / whole.value
+FROM tables t
+CROSS JOIN row_headers part_row
+    ON part_row.table_id = t.id AND part_row.header_id = ?
+CROSS JOIN row_headers whole_row
+    ON whole_row.table_id = t.id AND whole_row.header_id = ?
+CROSS JOIN cells part
+    ON part.table_id = t.id AND part.row_number = part_row.number
+CROSS JOIN cells whole
+    ON whole.table_id = t.id AND whole.row_number = whole_row.number
+    AND whole.column_number = part.column_number
+CROSS JOIN column_headers c
+    ON c.table_id = t.id AND c.number = part.column_number
+CROSS JOIN headers h ON h.id = c.header_id
+WHERE t.data_type = ? AND t.region IN (%s)
+    AND part.column_number > 0 AND whole.value > 0 AND part.value >= 0
+ORDER BY t.id, part.column_number
+"""
+"""SQLite joins CROSS JOINs in the order they're written, so that the
+query starts from the few tables of the region, instead of the rows of
+every table in the country."""
+
+
+class Database(object):
+    """A SQLite database of scraped tables."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.header_ids = dict(
+            self.connection.execute("SELECT name, id FROM headers")
+        )
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def analyze(self):
+        """Gather the statistics that the query planner uses.  Run this
+        after adding lots of tables."""
+        self.connection.execute("ANALYZE")
+
+    def _header_ids(self, names):
+        new_names = [
+            name for name in dict.fromkeys(names)
+            if name not in self.header_ids
+        ]
+        for name in new_names:
+            cursor = self.connection.execute(
+                "INSERT INTO headers (name) VALUES (?)", (name,)
+            )
+            self.header_ids[name] = cursor.lastrowid
+        return [self.header_ids[name] for name in names]
+
+    def add_tables(self, tables):
+        """Insert the tables in a single transaction.
+
+        A table with the same url as one that is already in the database
+        replaces it."""
+        try:
+            with self.connection:
+                for table in tables:
+                    self._add_table(table)
+        except Exception:
+            #
+            # The new headers got rolled back along with everything else.
+            #
+            self.header_ids = dict(
+                self.connection.execute("SELECT name, id FROM headers")
+            )
+            raise
+
+    def _add_table(self, table):
+        row = self.connection.execute(
+            "SELECT id FROM tables WHERE url = ?", (table["url"],)
+        ).fetchone()
+        if row is not None:
+            for name in ["cells", "row_headers", "column_headers"]:
+                self.connection.execute(
+                    "DELETE FROM %s WHERE table_id = ?" % name, row
+                )
+            self.connection.execute("DELETE FROM tables WHERE id = ?", row)
+
+        table_id = self.connection.execute(
+            "INSERT INTO tables (%s) VALUES (%s)" % (
+                ", ".join(TABLE_FIELDS), ", ".join("?" * len(TABLE_FIELDS))
+            ),
+            [table.get(field) for field in TABLE_FIELDS]
+        ).lastrowid
+        for name in ["row_headers", "column_headers"]:
+            self.connection.executemany(
+                "INSERT INTO %s VALUES (?, ?, ?)" % name,
+                [
+                    (table_id, number, header_id)
+                    for (number, header_id) in enumerate(
+                        self._header_ids(table[name])
+                    )
+                ]
+            )
+        self.connection.executemany(
+            "INSERT INTO cells VALUES (?, ?, ?, ?)",
+            [
+                (table_id, row_number, column_number, value)
+                for (row_number, values) in enumerate(table["data"])
+                for (column_number, value) in enumerate(values)
+            ]
+        )
+
+    def count(self, data_type=None):
+        """Return the number of tables, optionally of the data_type only."""
+        if data_type is None:
+            query, args = "SELECT COUNT(*) FROM tables", ()
+        else:
+            query = "SELECT COUNT(*) FROM tables WHERE data_type = ?"
+            args = (data_type,)
+        return self.connection.execute(query, args).fetchone()[0]
+
+    def regions(self, region_regex=None):
+        """Return the regions that match the regular expression
+        (case-insensitive), sorted."""
+        regions = [
+            region for (region,) in self.connection.execute(
+                "SELECT DISTINCT region FROM tables ORDER BY region"
+            )
+        ]
+        if region_regex is None:
+            return regions
+        regex = re.compile(region_regex, re.IGNORECASE | re.UNICODE)
+        return [region for region in regions if regex.search(region)]
+
+    def table(self, url):
+        """Return the table with the url, as it was scraped, or None."""
+        cursor = self.connection.execute(
+            "SELECT id, %s FROM tables WHERE url = ?" % ", ".join(
+                TABLE_FIELDS
+            ), (url,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        table = {
+            field: value for (field, value) in zip(TABLE_FIELDS, row[1:])
+            if value is not None
+        }
+        for name in ["row_headers", "column_headers"]:
+            table[name] = [
+                header for (header,) in self.connection.execute(
+                    "SELECT name FROM %s JOIN headers ON id = header_id "
+                    "WHERE table_id = ? ORDER BY number" % name, (row[0],)
+                )
+            ]
+        table["data"] = [[] for _ in table["row_headers"]]
+        for row_number, value in self.connection.execute(
+                "SELECT row_number, value FROM cells WHERE table_id = ? "
+                "ORDER BY row_number, column_number", (row[0],)):
+            table["data"][row_number].append(value)
+        return table
+
+    def shares(self, data_type, row_header, total_header, region=None):
+        """Return the value of one row as a proportion of another, for each
+        column (except the zeroth, the total) of the data_type's tables.
+
+        For the federal_uik tables, this is a share of the vote at each
+        polling station.  Returns a list of (region, area_ik,
+        territory_ik, column_header, share).  Columns where the total is
+        zero, and missing cells, are left out.  region is a regular
+        expression, as for the regions method."""
+        regions = self.regions(region)
+        row_id = self.header_ids.get(row_header)
+        total_id = self.header_ids.get(total_header)
+        if not regions or row_id is None or total_id is None:
+            return []
+        return self.connection.execute(
+            SHARES_QUERY % ", ".join("?" * len(regions)),
+            [row_id, total_id, data_type] + regions
+        ).fetchall()
+
+
+def import_tables(results_path, database_path, batch_size=100):
+    """Import results.json into the database.  Returns the number of
+    tables imported."""
+    database = Database(database_path)
+    batch = []
+    num_tables = 0
+    try:
+        for table in dataset.iter_tables(results_path):
+            batch.append(table)
+            if len(batch) >= batch_size:
+                database.add_tables(batch)
+                num_tables += len(batch)
+                batch = []
+        database.add_tables(batch)
+        num_tables += len(batch)
+        database.analyze()
+    finally:
+        database.close()
+    return num_tables
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("results", help="the results.json to import")
+    parser.add_argument("database", help="the SQLite database to write")
+    parser.add_argument(
+        "--batch-size", type=int, default=100,
+        help="tables per transaction (default: 100)"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    num_tables = import_tables(args.results, args.database, args.batch_size)
+    LOGGER.info("imported %d tables into %r", num_tables, args.database)
+
+
+class DatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.database = Database(P.join(self.path, "results.sqlite"))
+        self.tables = [
+            {
+                "url": "a", "md5": "1", "data_type": "federal_uik",
+                "region": "Саратовская область", "area_ik": "ОИК №1",
+                "territory_ik": "Балашовская", "row_headers": ["valid", "ER"],
+                "column_headers": ["Сумма", "УИК №1", "УИК №2", "УИК №3"],
+                "data": [[30, 10, 20, 0], [15, 5, 10, 0]],
+            },
+            {
+                "url": "b", "md5": "2", "data_type": "federal_uik",
+                "region": "город Москва", "area_ik": "ОИК №196",
+                "territory_ik": "Богородское", "row_headers": ["valid", "ER"],
+                "column_headers": ["Сумма", "УИК №1"],
+                "data": [[10, 10], [2, 2]],
+            },
+        ]
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.path)
+
+    def test_roundtrip(self):
+        self.database.add_tables(self.tables)
+        self.assertEqual(self.database.table("a"), self.tables[0])
+        self.assertIsNone(self.database.table("c"))
+
+        replacement = dict(self.tables[1], md5="3", data=[[10, 10], [3, 3]])
+        self.database.add_tables([replacement])
+        self.assertEqual(self.database.count(), 2)
+        self.assertEqual(self.database.table("b"), replacement)
+
+    def test_shares(self):
+        self.database.add_tables(self.tables)
+        self.assertEqual(
+            self.database.shares("federal_uik", "ER", "valid", "САРАТОВ"),
+            [
+                ("Саратовская область", "ОИК №1", "Балашовская", "УИК №1",
+                 0.5),
+                ("Саратовская область", "ОИК №1", "Балашовская", "УИК №2",
+                 0.5),
+            ]
+        )
+        self.assertEqual(
+            len(self.database.shares("federal_uik", "ER", "valid")), 3
+        )
+        self.assertEqual(
+            self.database.shares("federal_uik", "ER", "valid", "тверь"), []
+        )
+
+    def test_pipeline(self):
+        from gosduma7.pipelines import SQLitePipeline
+
+        pipeline = SQLitePipeline(P.join(self.path, "crawl.sqlite"), 2)
+        pipeline.open_spider(None)
+        for table in self.tables + [self.tables[0]]:
+            self.assertIs(pipeline.process_item(table, None), table)
+        self.assertEqual(pipeline.database.count(), 2)
+        pipeline.close_spider(None)
+
+        database = Database(pipeline.path)
+        self.assertEqual(database.count(), 2)
+        database.close()
+
+    def test_import(self):
+        results_path = P.join(self.path, "results.json")
+        with open(results_path, "w") as fout:
+            for table in self.tables:
+                fout.write(json.dumps(table, ensure_ascii=False) + "\n")
+        database_path = P.join(self.path, "imported.sqlite")
+        self.assertEqual(import_tables(results_path, database_path), 2)
+        database = Database(database_path)
+        self.assertEqual(database.regions(), [
+            "Саратовская область", "город Москва"
+        ])
+        self.assertEqual(database.count("federal_uik"), 2)
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""Load the scraped tables for analysis.
+
+To go through the federal_uik tables of a region without loading the whole
+of results.json into memory:
+
+    for table in iter_tables("results.json", "federal_uik", "саратов"):
+        ...
+"""
+import gzip
+import io
+import json
+import mmap
+import os
+import os.path as P
+import re
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+
+from gosduma7 import compact
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def loads(line):
+    """Decode a line of results.json, using orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line.decode("utf-8"))
+
+
+def dumps(record):
+    """Encode the record as a line of JSON, using orjson if it is installed.
+
+    Returns UTF-8 bytes, with the non-ASCII characters as they are."""
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def open_results(path):
+    """Open results.json for reading, as bytes.
+
+    Files ending in .gz and .zst (see LineExporter) get decompressed on the
+    fly."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("reading %r needs the zstandard package" % path)
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        )
+    return open(path, "rb")
+
+
+def iter_lines(fin):
+    """Yield the lines of the file, stopping quietly at the end of a
+    compressed stream that was never finished.
+
+    That's what a crawl that died leaves behind.  LineExporter flushes the
+    compressor after complete lines, so everything up to there is intact."""
+    try:
+        for line in fin:
+            yield line
+    except EOFError:
+        return
+
+
+REGION_FIELD = re.compile(br'"region": ?("(?:[^"\\]|\\.)*")')
+"""Find the region in a line of results.json without decoding the line."""
+
+
+def iter_tables(path, data_type=None, region=None):
+    """Yield the tables from results.json, one at a time.
+
+    If data_type is specified, only yield tables of that data_type.  If
+    region is specified, only yield tables whose region matches that
+    regular expression (case-insensitive).  Lines that cannot possibly
+    match are skipped before they get decoded, which is where most of the
+    time goes.  Output of CompactLineExporter is expanded back into the
+    usual representation."""
+    data_type_needle = None
+    if data_type is not None:
+        data_type_needle = json.dumps(data_type).encode("utf-8")
+
+    region_regex = None
+    if region is not None:
+        region_regex = re.compile(region, re.IGNORECASE | re.UNICODE)
+
+    dictionary = compact.HeaderDictionary()
+    with open_results(path) as fin:
+        for line in iter_lines(fin):
+            if line.startswith(compact.HEADERS_PREFIX):
+                dictionary.update(loads(line))
+                continue
+            if data_type_needle is not None and data_type_needle not in line:
+                continue
+            if region_regex is not None:
+                match = REGION_FIELD.search(line)
+                if match and not region_regex.search(
+                        json.loads(match.group(1).decode("utf-8"))):
+                    continue
+
+            table = loads(line)
+            if data_type is not None and table["data_type"] != data_type:
+                continue
+            if region_regex is not None and \
+                    not region_regex.search(table["region"]):
+                continue
+            if compact.is_compact(table):
+                compact.expand_table(table, dictionary)
+            yield table
+
+
+def filter_type(tables, data_type):
+    """Lazily filter the tables by data_type."""
+    return (t for t in tables if t["data_type"] == data_type)
+
+
+def filter_region(tables, region_regex):
+    """Lazily filter the tables by region (case-insensitive regex)."""
+    regex = re.compile(region_regex, re.IGNORECASE | re.UNICODE)
+    return (t for t in tables if regex.search(t["region"]))
+
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+"""The fixed part of a ZIP local file header: signature, then the lengths of
+the file name and extra field that follow it."""
+
+
+def _member_offset(fin, info):
+    """Return the offset of the data of the ZIP member within the file."""
+    fin.seek(info.header_offset)
+    signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(
+        fin.read(ZIP_LOCAL_HEADER.size)
+    )
+    assert signature == b"PK\x03\x04", "bad local header for %r" % info
+    return info.header_offset + ZIP_LOCAL_HEADER.size + name_length + \
+        extra_length
+
+
+def load_columnar(path, data_type=None):
+    """Load the dataset written by ColumnarExporter.
+
+    The arrays are memory-mapped, so loading is almost instantaneous and
+    only the parts that are accessed get read from disk.  If data_type is
+    specified, only the rows of that data_type are returned (this copies
+    them out of the memory map).  Returns a dictionary of arrays.  Decode
+    the dictionary-encoded columns like this:
+
+        arrays["region_categories"][arrays["region"]]
+    """
+    import numpy
+
+    arrays = {}
+    with open(path, "rb") as fin:
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        with zipfile.ZipFile(fin) as archive:
+            for info in archive.infolist():
+                name = P.splitext(info.filename)[0]
+                if info.compress_type != zipfile.ZIP_STORED:
+                    arrays[name] = numpy.load(archive.open(info))
+                    continue
+
+                fin.seek(_member_offset(fin, info))
+                version = numpy.lib.format.read_magic(fin)
+                if version == (1, 0):
+                    header = numpy.lib.format.read_array_header_1_0(fin)
+                else:
+                    header = numpy.lib.format.read_array_header_2_0(fin)
+                shape, fortran_order, dtype = header
+                arrays[name] = numpy.ndarray(
+                    shape, dtype=dtype, buffer=buf, offset=fin.tell(),
+                    order="F" if fortran_order else "C"
+                )
+
+    if data_type is not None:
+        code = numpy.flatnonzero(arrays["data_type_categories"] == data_type)
+        mask = numpy.isin(arrays["data_type"], code)
+        for name, value in list(arrays.items()):
+            if not name.endswith("_categories"):
+                arrays[name] = value[mask]
+    return arrays
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_roundtrip(self):
+        from gosduma7.pipelines import ColumnarExporter
+
+        tables = [
+            {
+                "region": "a", "area_ik": "1", "data_type": "federal",
+                "row_headers": ["x", "y"], "column_headers": ["s", "u"],
+                "data": [[3.0, 3.0], [4.0, 4.0]],
+            },
+            {
+                "region": "b", "area_ik": "2", "territory_ik": "t",
+                "data_type": "federal_uik", "row_headers": ["x"],
+                "column_headers": ["s", "u1", "u2"], "data": [[5.0, 2.0, 3.0]],
+            },
+        ]
+        fout = io.BytesIO()
+        exporter = ColumnarExporter(fout)
+        exporter.start_exporting()
+        for table in tables:
+            exporter.export_item(table)
+        exporter.finish_exporting()
+
+        path = os.path.join(self.path, "results.npz")
+        with open(path, "wb") as f:
+            f.write(fout.getvalue())
+
+        arrays = load_columnar(path)
+        self.assertEqual(list(arrays["value"]), [3, 3, 4, 4, 5, 2, 3])
+        self.assertEqual(arrays["row_header"].dtype, "int32")
+        self.assertEqual(
+            list(arrays["column_header_categories"][arrays["column_header"]]),
+            ["s", "u", "s", "u", "s", "u1", "u2"]
+        )
+        self.assertEqual(
+            list(arrays["territory_ik_categories"][arrays["territory_ik"]]),
+            [""] * 4 + ["t"] * 3
+        )
+
+        uik = load_columnar(path, data_type="federal_uik")
+        self.assertEqual(list(uik["value"]), [5, 2, 3])
+        self.assertEqual(
+            list(uik["region_categories"][uik["region"]]), ["b"] * 3
+        )
+
+    def test_short_row(self):
+        from gosduma7.pipelines import ColumnarExporter
+
+        fout = io.BytesIO()
+        exporter = ColumnarExporter(fout)
+        exporter.start_exporting()
+        exporter.export_item({
+            "region": "a", "data_type": "federal",
+            "row_headers": ["x", "y"], "column_headers": ["s", "u"],
+            "data": [[3.0, 3.0], [4.0]],
+        })
+        exporter.finish_exporting()
+
+        path = os.path.join(self.path, "results.npz")
+        with open(path, "wb") as f:
+            f.write(fout.getvalue())
+
+        arrays = load_columnar(path)
+        self.assertEqual(list(arrays["value"]), [3, 3, 4])
+        for column in ["region", "area_ik", "row_header", "column_header"]:
+            self.assertEqual(len(arrays[column]), 3)
+        self.assertEqual(
+            list(arrays["row_header_categories"][arrays["row_header"]]),
+            ["x", "x", "y"]
+        )
+        self.assertEqual(
+            list(arrays["column_header_categories"][arrays["column_header"]]),
+            ["s", "u", "s"]
+        )
+
+
+class IterTablesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.tables = [
+            {"region": "Саратовская область", "data_type": "federal"},
+            {"region": "Саратовская область", "data_type": "federal_uik"},
+            {"region": "город Москва", "data_type": "federal_uik"},
+            {"region": "Республика Адыгея", "data_type": "turnout"},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, ensure_ascii):
+        path = os.path.join(self.path, "results.json")
+        with open(path, "wb") as fout:
+            for table in self.tables:
+                data = json.dumps(table, ensure_ascii=ensure_ascii) + "\n"
+                fout.write(data.encode("utf-8"))
+        return path
+
+    def test_filter(self):
+        for ensure_ascii in [False, True]:
+            path = self.write(ensure_ascii)
+            self.assertEqual(list(iter_tables(path)), self.tables)
+            self.assertEqual(
+                list(iter_tables(path, "federal_uik")), self.tables[1:3]
+            )
+            self.assertEqual(
+                list(iter_tables(path, "federal")), [self.tables[0]]
+            )
+            self.assertEqual(
+                list(iter_tables(path, "federal_uik", "САРАТОВ")),
+                [self.tables[1]]
+            )
+            self.assertEqual(
+                list(iter_tables(path, region="адыг")), [self.tables[3]]
+            )
+            self.assertEqual(
+                list(iter_tables(path, region="москва$")), [self.tables[2]]
+            )
+
+    def test_compact(self):
+        from gosduma7.pipelines import CompactLineExporter
+
+        tables = [
+            {
+                "region": "Саратовская область", "data_type": "federal_uik",
+                "row_headers": ["x", "y"], "column_headers": ["Сумма", "1"],
+                "data": [[3.0, 3.0], [4.0, 4.0]],
+            },
+            {
+                "region": "город Москва", "data_type": "turnout_uik",
+                "row_headers": ["1"], "column_headers": ["10:00", "12:00"],
+                "data": [[7.04, 16.64]],
+            },
+        ]
+        path = os.path.join(self.path, "results.json")
+        # The second export appends, like a resumed crawl, and its header
+        # ids start over from zero.
+        for mode, exported in [("wb", tables[:1]), ("ab", tables[1:])]:
+            with open(path, mode) as fout:
+                exporter = CompactLineExporter(fout)
+                exporter.start_exporting()
+                for table in exported:
+                    exporter.export_item(table)
+                exporter.finish_exporting()
+
+        self.assertEqual(list(iter_tables(path)), tables)
+        self.assertEqual(list(iter_tables(path, "turnout_uik")), tables[1:])
+
+
+class LineExporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.tables = [
+            {"region": "Саратовская область", "data_type": "federal",
+             "data": [[1, 2.5]]},
+            {"region": "город Москва", "data_type": "turnout", "data": []},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_buffering(self):
+        from gosduma7.pipelines import LineExporter
+
+        self.now = 0.0
+        fout = io.BytesIO()
+        exporter = LineExporter(
+            fout, buffer_size=1000, flush_interval=5.0,
+            clock=lambda: self.now
+        )
+        exporter.start_exporting()
+        exporter.export_item(self.tables[0])
+        self.assertEqual(fout.getvalue(), b"")
+
+        self.now = 5.0
+        exporter.export_item(self.tables[1])
+        lines = fout.getvalue().splitlines()
+        self.assertEqual([loads(line) for line in lines], self.tables)
+
+        exporter.buffer_size = 1
+        exporter.export_item(self.tables[0])
+        self.assertEqual(len(fout.getvalue().splitlines()), 3)
+
+    def test_checkpoint(self):
+        """With a checkpoint, tables should not wait in the buffer."""
+        import mock
+        import scrapy.settings
+        from gosduma7.pipelines import LineExporter
+
+        for name, interval in [("CHECKPOINT_PATH", 5), ("SHARD_PATH", None)]:
+            settings = scrapy.settings.Settings({name: "crawl.sqlite"})
+            if interval is not None:
+                settings.set("EXPORT_FLUSH_INTERVAL", interval)
+            fout = io.BytesIO()
+            with mock.patch("gosduma7.pipelines.LOGGER") as logger:
+                exporter = LineExporter.from_crawler(
+                    mock.Mock(settings=settings), fout
+                )
+            #
+            # Only an interval that was asked for is worth a warning.
+            #
+            self.assertEqual(logger.warning.called, interval is not None)
+            exporter.start_exporting()
+            exporter.export_item(self.tables[0])
+            self.assertEqual(loads(fout.getvalue()), self.tables[0])
+
+    def export(self, filename, compression, finish=True):
+        from gosduma7.pipelines import LineExporter
+
+        path = os.path.join(self.path, filename)
+        with open(path, "wb") as fout:
+            exporter = LineExporter(fout, compression=compression)
+            exporter.start_exporting()
+            for table in self.tables:
+                exporter.export_item(table)
+            if finish:
+                exporter.finish_exporting()
+            else:
+                exporter.flush()
+        return path
+
+    def test_gzip(self):
+        path = self.export("results.json.gz", "gzip")
+        self.assertEqual(list(iter_tables(path)), self.tables)
+        self.assertEqual(
+            list(iter_tables(path, "turnout")), self.tables[1:]
+        )
+
+    def test_unfinished_gzip(self):
+        path = self.export("results.json.gz", "gzip", finish=False)
+        self.assertEqual(list(iter_tables(path)), self.tables)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        path = self.export("results.json.zst", "zstd")
+        self.assertEqual(list(iter_tables(path)), self.tables)
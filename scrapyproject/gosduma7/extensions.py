@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/extensions.html
+import cProfile
+import heapq
+import itertools
+import json
+import logging
+import os
+import os.path as P
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+import scrapy.exceptions
+import scrapy.http
+import scrapy.settings
+import scrapy.signals
+from twisted.internet import task
+
+from gosduma7 import instrumentation
+from gosduma7.middlewares import callback_level
+
+LOGGER = logging.getLogger(__name__)
+
+EXPECTED_COUNTS = {
+    "federal": 225,
+    "single": 225,
+    "turnout": 225,
+    "federal_uik": 2820,
+    "turnout_uik": 2820,
+}
+"""How many tables of each data_type a full crawl scrapes: one per OIK for
+the OIK-level tables, and one per TIK for the UIK-level tables."""
+
+NATIONAL_DATA_TYPES = ("federal", "single", "turnout")
+"""The data_types that add up to the national picture."""
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress(object):
+    """Log the progress of the crawl against the expected counts, with an ETA.
+
+    Also measures how long it takes to scrape all the OIK-level tables, i.e.
+    to have the complete national picture, and keeps it in the
+    progress/national_seconds stat.  PROGRESS_EXPECTED_COUNTS overrides
+    EXPECTED_COUNTS.  In incremental mode, the unchanged tables don't get
+    scraped, so the counts fall short."""
+
+    def __init__(self, stats, expected, interval, clock=time.monotonic):
+        self.stats = stats
+        self.expected = expected
+        self.interval = interval
+        self.clock = clock
+        self.counts = dict.fromkeys(expected, 0)
+        self.start_time = None
+        self.national_seconds = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        interval = crawler.settings.getfloat("PROGRESS_INTERVAL", 60.0)
+        if not interval:
+            raise scrapy.exceptions.NotConfigured
+        expected = dict(EXPECTED_COUNTS)
+        expected.update(crawler.settings.getdict("PROGRESS_EXPECTED_COUNTS"))
+        extension = cls(crawler.stats, expected, interval)
+        crawler.signals.connect(
+            extension.spider_opened, signal=scrapy.signals.spider_opened
+        )
+        crawler.signals.connect(
+            extension.spider_closed, signal=scrapy.signals.spider_closed
+        )
+        crawler.signals.connect(
+            extension.item_scraped, signal=scrapy.signals.item_scraped
+        )
+        return extension
+
+    def spider_opened(self, spider):
+        self.start_time = self.clock()
+        self.task = task.LoopingCall(self.log)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.log()
+
+    def item_scraped(self, item, spider):
+        data_type = item.get("data_type")
+        self.counts[data_type] = self.counts.get(data_type, 0) + 1
+        self.stats.inc_value("progress/%s" % data_type)
+
+        if self.national_seconds is None and all(
+            self.counts[t] >= self.expected[t] for t in NATIONAL_DATA_TYPES
+        ):
+            self.national_seconds = self.elapsed()
+            self.stats.set_value(
+                "progress/national_seconds", round(self.national_seconds, 1)
+            )
+            LOGGER.info(
+                "national picture complete after %s",
+                format_duration(self.national_seconds)
+            )
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def fraction_done(self):
+        done = sum(
+            min(self.counts[t], expected)
+            for (t, expected) in self.expected.items()
+        )
+        return done / float(sum(self.expected.values()) or 1)
+
+    def eta(self):
+        """Return the estimated seconds to go, or None if we can't tell."""
+        fraction = self.fraction_done()
+        if not fraction:
+            return None
+        return self.elapsed() * (1 - fraction) / fraction
+
+    def log(self):
+        eta = self.eta()
+        LOGGER.info(
+            "%.1f%% done (%s), ETA %s", 100 * self.fraction_done(),
+            ", ".join(
+                "%s %d/%d" % (t, self.counts[t], self.expected[t])
+                for t in sorted(self.expected)
+            ),
+            "unknown" if eta is None else format_duration(eta)
+        )
+
+
+class Instrumentation(object):
+    """Record where the time goes, and write a report when the crawl ends.
+
+    Records the download latency and the wall time, CPU time and bytes of
+    each callback, by level of the hierarchy, as well as the phases that
+    the code marks with gosduma7.instrumentation.phase (parsing, caching,
+    exporting).  At the end of the crawl, writes report.json (with
+    histograms) and report.csv to INSTRUMENT_DIR.  If
+    INSTRUMENT_PROFILE_SLOWEST is non-zero, also profiles every callback,
+    and keeps cProfile dumps of that many of the slowest ones in
+    INSTRUMENT_DIR/profiles.
+
+    It is a spider middleware as well as an extension, because it has to
+    wrap the callbacks: enable it in SPIDER_MIDDLEWARES, closest to the
+    spider, and not in EXTENSIONS."""
+
+    def __init__(self, path, profile_slowest=0):
+        self.path = path
+        self.profile_slowest = profile_slowest
+        self.recorder = instrumentation.Recorder()
+        self.slowest = []
+        self.counter = itertools.count()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("INSTRUMENT_DIR")
+        if not path:
+            raise scrapy.exceptions.NotConfigured
+        extension = cls(
+            path, crawler.settings.getint("INSTRUMENT_PROFILE_SLOWEST")
+        )
+        crawler.signals.connect(
+            extension.spider_opened, signal=scrapy.signals.spider_opened
+        )
+        crawler.signals.connect(
+            extension.spider_closed, signal=scrapy.signals.spider_closed
+        )
+        crawler.signals.connect(
+            extension.response_received,
+            signal=scrapy.signals.response_received
+        )
+        return extension
+
+    def spider_opened(self, spider):
+        instrumentation.RECORDER = self.recorder
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            self.recorder.add(
+                "download/%s" % callback_level(request), latency,
+                nbytes=len(response.body)
+            )
+
+    def process_spider_output(self, response, result, spider=None):
+        timer = CallbackTimer(profile=bool(self.profile_slowest))
+        iterator = iter(result)
+        try:
+            while True:
+                with timer:
+                    element = next(iterator, StopIteration)
+                if element is StopIteration:
+                    break
+                yield element
+        finally:
+            self._record(response, timer)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        timer = CallbackTimer(profile=bool(self.profile_slowest))
+        iterator = result.__aiter__()
+        try:
+            while True:
+                with timer:
+                    try:
+                        element = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                yield element
+        finally:
+            self._record(response, timer)
+
+    def _record(self, response, timer):
+        self.recorder.add(
+            "callback/%s" % callback_level(response.request), timer.wall,
+            timer.cpu, len(response.body)
+        )
+        if timer.profile is not None:
+            heapq.heappush(
+                self.slowest,
+                (timer.wall, next(self.counter), response.url, timer.profile)
+            )
+            if len(self.slowest) > self.profile_slowest:
+                heapq.heappop(self.slowest)
+
+    def spider_closed(self, spider):
+        instrumentation.RECORDER = None
+        os.makedirs(self.path, exist_ok=True)
+        with open(P.join(self.path, "report.json"), "w") as fout:
+            self.recorder.write_json(fout)
+        with open(P.join(self.path, "report.csv"), "w") as fout:
+            self.recorder.write_csv(fout)
+
+        if self.slowest:
+            profiles = P.join(self.path, "profiles")
+            os.makedirs(profiles, exist_ok=True)
+            index = []
+            slowest = sorted(self.slowest, reverse=True)
+            for rank, (wall, _, url, profile) in enumerate(slowest):
+                filename = "%02d.prof" % rank
+                profile.dump_stats(P.join(profiles, filename))
+                index.append({"file": filename, "url": url, "wall": wall})
+            with open(P.join(profiles, "index.json"), "w") as fout:
+                json.dump(index, fout, indent=2)
+
+        LOGGER.info("wrote the instrumentation report to %r", self.path)
+
+
+class CallbackTimer(object):
+    """Accumulates the time spent in a callback across its iterations."""
+
+    def __init__(self, profile=False):
+        self.wall = self.cpu = 0.0
+        self.profile = cProfile.Profile() if profile else None
+
+    def __enter__(self):
+        self.start = time.perf_counter(), time.process_time()
+        if self.profile is not None:
+            self.profile.enable()
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.disable()
+        wall, cpu = self.start
+        self.wall += time.perf_counter() - wall
+        self.cpu += time.process_time() - cpu
+
+
+class ProgressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.stats = mock.Mock()
+        self.progress = Progress(
+            self.stats, {"federal": 2, "single": 1, "turnout": 1,
+                         "federal_uik": 4},
+            60.0, clock=lambda: self.now
+        )
+        self.progress.start_time = 0.0
+
+    def test_eta(self):
+        self.assertIsNone(self.progress.eta())
+        self.now = 10.0
+        for data_type in ["federal", "single"]:
+            self.progress.item_scraped({"data_type": data_type}, None)
+        self.assertEqual(self.progress.fraction_done(), 0.25)
+        self.assertEqual(self.progress.eta(), 30.0)
+
+    def test_national_picture(self):
+        for data_type in ["federal", "single", "turnout", "federal_uik"]:
+            self.now += 1.0
+            self.progress.item_scraped({"data_type": data_type}, None)
+        self.assertIsNone(self.progress.national_seconds)
+
+        self.now += 1.0
+        self.progress.item_scraped({"data_type": "federal"}, None)
+        self.assertEqual(self.progress.national_seconds, 5.0)
+        self.stats.set_value.assert_called_once_with(
+            "progress/national_seconds", 5.0
+        )
+
+    def test_from_crawler(self):
+        crawler = mock.Mock()
+        crawler.settings = scrapy.settings.Settings(
+            {"PROGRESS_EXPECTED_COUNTS": {"federal": 1}}
+        )
+        progress = Progress.from_crawler(crawler)
+        self.assertEqual(progress.expected["federal"], 1)
+        self.assertEqual(progress.expected["single"], 225)
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        instrumentation.RECORDER = None
+        shutil.rmtree(self.path)
+
+    def callback(self, response):
+        with instrumentation.phase("parse/rows"):
+            time.sleep(0.01)
+        yield {"data_type": "federal"}
+
+    def test_report(self):
+        extension = Instrumentation(self.path, profile_slowest=1)
+        extension.spider_opened(None)
+        for url in ["http://a", "http://b"]:
+            request = scrapy.Request(url, callback=self.callback)
+            response = scrapy.http.HtmlResponse(
+                url, body=b"<html/>", request=request
+            )
+            output = extension.process_spider_output(
+                response, self.callback(response), None
+            )
+            self.assertEqual(list(output), [{"data_type": "federal"}])
+        extension.spider_closed(None)
+
+        with open(P.join(self.path, "report.json")) as fin:
+            report = json.load(fin)
+        self.assertEqual(
+            sorted(report), ["callback/callback", "parse/rows"]
+        )
+        self.assertEqual(report["callback/callback"]["count"], 2)
+        self.assertEqual(report["callback/callback"]["bytes_total"], 14)
+        self.assertGreaterEqual(report["parse/rows"]["wall_total"], 0.02)
+        self.assertEqual(
+            os.listdir(P.join(self.path, "profiles")),
+            ["00.prof", "index.json"]
+        )
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""An asyncio crawl engine, as an alternative to scrapy's.
+
+Crawls the same hierarchy as the spider, with the same parsers, and writes
+the same lines as the "lines" exporter, without importing scrapy:
+
+    python -m gosduma7.fetcher -o results.json \\
+        --top-url http://127.0.0.1:8000/region/izbirkom
+
+All the requests go to the one host, over a pool of keep-alive
+connections.  Each level of the hierarchy gets its own concurrency limit,
+so that the thousands of UIK tables can't hold up the TIK pages that lead
+to them, and failed requests are retried with exponential backoff.  Needs
+the aiohttp package.
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import random
+import resource
+import sys
+import time
+import unittest
+import urllib.parse
+
+import w3lib.url
+
+from gosduma7 import parsing
+from gosduma7.dataset import dumps, loads
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOGGER = logging.getLogger(__name__)
+
+LEVELS = ("region", "area", "table", "ik", "uik")
+"""The levels of the hierarchy: the region and OIK menus, the OIK-level
+tables, the TIK pages and the UIK tables."""
+
+CONCURRENCY = 8
+"""The default number of requests of each level in flight, as for
+ADAPTIVE_MAX_CONCURRENCY."""
+
+CONNECTIONS = 16
+"""The default size of the connection pool, as for CONCURRENT_REQUESTS."""
+
+RETRY_STATUSES = frozenset([500, 502, 503, 504, 522, 524, 408, 429])
+"""The statuses to retry on, as for scrapy's RETRY_HTTP_CODES."""
+
+
+class Fetcher(object):
+    """Crawl the site from top_url, passing each parsed table to write.
+
+    concurrency maps each of LEVELS to the number of its requests that may
+    be in flight at once, and connections limits the pool of keep-alive
+    connections that the levels share.  A request that fails with a
+    connection error, a timeout or one of RETRY_STATUSES is retried up to
+    retries times, after backoff seconds, doubling each time, give or take
+    half.  Pages are parsed in the event loop, or in a pool of that many
+    processes (see PARSE_PROCESSES).  Links to other hosts, and to pages
+    that have been fetched already, are not followed.  stats counts what
+    happened."""
+
+    def __init__(self, top_url, write, concurrency=None,
+                 connections=CONNECTIONS, retries=5, backoff=0.5,
+                 timeout=30.0, processes=0):
+        self.top_url = top_url
+        self.write = write
+        self.concurrency = dict.fromkeys(LEVELS, CONCURRENCY)
+        self.concurrency.update(concurrency or {})
+        self.connections = connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.processes = processes
+        self.host = urllib.parse.urlsplit(top_url).hostname
+        self.seen = set()
+        self.stats = collections.Counter()
+        self.semaphores = None
+        self.session = None
+        self.pool = None
+
+    async def crawl(self):
+        self.semaphores = {
+            level: asyncio.Semaphore(limit)
+            for (level, limit) in self.concurrency.items()
+        }
+        if self.processes:
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.processes
+            )
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        try:
+            async with aiohttp.ClientSession(
+                    connector=connector, timeout=timeout) as self.session:
+                await self.crawl_top(self.top_url)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+                self.pool = None
+
+    async def fetch(self, url, level):
+        """Return the page at url, or None if it is offsite, has been
+        fetched already, or keeps failing."""
+        if urllib.parse.urlsplit(url).hostname != self.host:
+            self.stats["fetch/offsite"] += 1
+            return None
+        key = w3lib.url.canonicalize_url(url)
+        if key in self.seen:
+            self.stats["fetch/duplicate"] += 1
+            return None
+        self.seen.add(key)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats["fetch/retries"] += 1
+                delay = self.backoff * 2 ** (attempt - 1)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            async with self.semaphores[level]:
+                try:
+                    async with self.session.get(url) as response:
+                        status = response.status
+                        body = await response.read()
+                        charset = response.charset
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    reason = repr(error)
+                    continue
+            if status == 200:
+                self.stats["fetch/%s" % level] += 1
+                self.stats["fetch/bytes"] += len(body)
+                return parsing.Page(
+                    url, body, charset or parsing.sniff_encoding(body)
+                )
+            reason = "status %d" % status
+            if status not in RETRY_STATUSES:
+                break
+
+        LOGGER.error("giving up on %r: %s", url, reason)
+        self.stats["fetch/failed"] += 1
+        return None
+
+    async def follow(self, requests):
+        """Crawl each (crawl, url) pair at once, logging the errors."""
+        requests = list(requests)
+        results = await asyncio.gather(
+            *(crawl(url) for (crawl, url) in requests),
+            return_exceptions=True
+        )
+        for (crawl, url), result in zip(requests, results):
+            if isinstance(result, Exception):
+                LOGGER.error(
+                    "error crawling %r", url, exc_info=(
+                        type(result), result, result.__traceback__
+                    )
+                )
+                self.stats["crawl/errors"] += 1
+
+    async def parse(self, page, data_type):
+        if self.pool is None:
+            table = parsing.parse_table(page, data_type)
+        else:
+            table = await asyncio.get_running_loop().run_in_executor(
+                self.pool, parsing.parse_page, page.url, page.body,
+                page.encoding, data_type
+            )
+        self.write(table)
+        self.stats["tables/%s" % data_type] += 1
+
+    def links(self, page, hrefs):
+        return [urllib.parse.urljoin(page.url, href) for href in hrefs]
+
+    async def crawl_top(self, url):
+        page = await self.fetch(url, "region")
+        if page is None:
+            return
+        options = parsing.COMPILED_LINK_XPATHS["option"]
+        await self.follow(
+            (self.crawl_region, href)
+            for href in self.links(page, options(parsing.page_root(page)))
+        )
+
+    async def crawl_region(self, url):
+        page = await self.fetch(url, "region")
+        if page is None:
+            return
+        options = parsing.COMPILED_LINK_XPATHS["option"]
+        await self.follow(
+            (self.crawl_area, href)
+            for href in self.links(page, options(parsing.page_root(page)))
+        )
+
+    async def crawl_area(self, url):
+        page = await self.fetch(url, "area")
+        if page is None:
+            return
+        crawls = {
+            "federal": self.crawl_federal,
+            "single": self.crawl_single,
+            "turnout": self.crawl_turnout,
+        }
+        links = list(parsing.table_links(parsing.page_root(page)))
+        if len(set(data_type for (_, data_type) in links)) != len(crawls):
+            LOGGER.warning("missing table links on %r", url)
+        await self.follow(
+            (crawls[data_type], urllib.parse.urljoin(url, href))
+            for (href, data_type) in links
+        )
+
+    async def crawl_table(self, url, data_type, tik_xpath=None):
+        """Parse the OIK-level table, while crawling the TIKs that it links
+        to, if any."""
+        page = await self.fetch(url, "table")
+        if page is None:
+            return
+        tiks = None
+        if tik_xpath is not None:
+            hrefs = parsing.COMPILED_LINK_XPATHS[tik_xpath](
+                parsing.page_root(page)
+            )
+            tiks = asyncio.ensure_future(self.follow(
+                (lambda href: self.crawl_ik(href, data_type), href)
+                for href in self.links(page, hrefs)
+            ))
+        await self.parse(page, data_type)
+        if tiks is not None:
+            await tiks
+
+    async def crawl_federal(self, url):
+        await self.crawl_table(url, "federal", "tik")
+
+    async def crawl_single(self, url):
+        await self.crawl_table(url, "single")
+
+    async def crawl_turnout(self, url):
+        await self.crawl_table(url, "turnout", "turnout_tik")
+
+    async def crawl_ik(self, url, data_type):
+        page = await self.fetch(url, "ik")
+        if page is None:
+            return
+        uik_link = parsing.get_uik_link(parsing.page_root(page))
+        if uik_link is None:
+            if data_type == "federal":
+                LOGGER.warning("no UIK link on %r", url)
+            return
+        uik_page = await self.fetch(
+            urllib.parse.urljoin(url, uik_link), "uik"
+        )
+        if uik_page is not None:
+            await self.parse(uik_page, data_type + "_uik")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "-o", "--output", default="-", help="where to write the JSON lines"
+    )
+    parser.add_argument("--top-url", default=parsing.TOP_URL)
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=CONCURRENCY,
+        help="requests in flight per level of the hierarchy (default: %d)"
+             % CONCURRENCY
+    )
+    parser.add_argument(
+        "--connections", type=int, default=CONNECTIONS,
+        help="keep-alive connections to the site (default: %d)" % CONNECTIONS
+    )
+    parser.add_argument(
+        "--retries", type=int, default=5, help="retries per request"
+    )
+    parser.add_argument(
+        "--backoff", type=float, default=0.5,
+        help="seconds before the first retry, doubling after that"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=30.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "-p", "--processes", type=int, default=0,
+        help="parse in this many worker processes (default: 0, no workers)"
+    )
+    args = parser.parse_args()
+    if aiohttp is None:
+        parser.error("the asyncio engine needs the aiohttp package")
+
+    logging.basicConfig(level=logging.INFO)
+    fout = sys.stdout.buffer if args.output == "-" else \
+        open(args.output, "wb", buffering=1 << 20)
+    fetcher = Fetcher(
+        args.top_url, lambda table: fout.write(dumps(table)),
+        dict.fromkeys(LEVELS, args.concurrency), args.connections,
+        args.retries, args.backoff, args.timeout, args.processes
+    )
+    start = time.time()
+    try:
+        asyncio.run(fetcher.crawl())
+    finally:
+        if fout is not sys.stdout.buffer:
+            fout.close()
+    elapsed = time.time() - start
+
+    pages = sum(fetcher.stats["fetch/%s" % level] for level in LEVELS)
+    LOGGER.info(
+        "fetched %d pages in %.1fs (%.1f pages/s), peak memory %.1f MB",
+        pages, elapsed, pages / elapsed if elapsed else 0,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    )
+    LOGGER.info("stats: %r", dict(sorted(fetcher.stats.items())))
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+class FetcherTest(unittest.TestCase):
+
+    def crawl(self, server, **kwargs):
+        tables = []
+        fetcher = Fetcher(
+            server.top_url, lambda table: tables.append(loads(dumps(table))),
+            backoff=0.01, **kwargs
+        )
+        asyncio.run(fetcher.crawl())
+        return fetcher, tables
+
+    def test_crawl(self):
+        from gosduma7 import mockserver
+
+        server = mockserver.MockServer(
+            regions=2, oiks=1, tiks=2, uiks=3, error_rate=0.1, seed=1,
+            duplicates=True
+        )
+        with server:
+            fetcher, tables = self.crawl(server, connections=4)
+        counts = collections.Counter(table["data_type"] for table in tables)
+        self.assertEqual(dict(counts), server.site.expected_counts())
+        self.assertGreater(fetcher.stats["fetch/retries"], 0)
+        self.assertGreater(fetcher.stats["fetch/duplicate"], 0)
+        self.assertEqual(fetcher.stats["fetch/failed"], 0)
+        #
+        # The server closes the connection after an error response.
+        #
+        self.assertLessEqual(
+            server.connections, 4 + fetcher.stats["fetch/retries"]
+        )
+
+    def test_give_up(self):
+        from gosduma7 import mockserver
+
+        server = mockserver.MockServer(regions=1, error_rate=1.0)
+        with server:
+            fetcher, tables = self.crawl(server, retries=2)
+        self.assertEqual(tables, [])
+        self.assertEqual(fetcher.stats["fetch/retries"], 2)
+        self.assertEqual(fetcher.stats["fetch/failed"], 1)
+
+
+if __name__ == "__main__":
+    main()
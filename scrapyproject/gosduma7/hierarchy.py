@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""An index of the scraped tables by region, OIK, TIK and UIK.
+
+Instead of scanning all the tables for every question, index results.json
+once, and then look up totals, counts and inconsistencies directly:
+
+    index = hierarchy.build("results.json", "results.index")
+    index.totals(("город Москва", "ОИК №196"))
+    index.counts("город Москва")
+    index.inconsistencies()
+
+Nodes are identified by their path, a tuple of names: (region, area_ik,
+territory_ik, UIK).  The empty path is the whole country.  Each table
+reports the totals of one node in its zeroth column (an OIK for federal and
+single tables, a TIK for federal_uik tables), and the totals of its
+children in the other columns.  Regions and the whole country don't have
+tables of their own, so their totals are rolled up from the OIKs.  Turnout
+percentages don't add up, so turnout tables are not indexed.
+
+build keeps the index on disk, and only reads the tables that have been
+appended to results.json since the index was last saved.  A table with the
+same url as an indexed table replaces it, so the output of incremental
+crawls can be appended to the same file.  A table with another url for a
+node that already has one is left out, and reported as a conflict.
+"""
+import argparse
+import array
+import collections
+import csv
+import gzip
+import json
+import os
+import os.path as P
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+from gosduma7 import compact
+from gosduma7 import dataset
+
+FAMILIES = {"federal": "federal", "federal_uik": "federal", "single": "single"}
+"""The data_types that get indexed, and which tree each goes into.  The
+federal and federal_uik tables describe the same votes at different levels,
+so they share a tree."""
+
+LEVELS = ("region", "oik", "tik", "uik")
+"""The name of each level of the hierarchy, by the length of the path."""
+
+
+def table_path(table):
+    """Return the path of the node whose totals the table reports."""
+    if table["data_type"] == "federal_uik":
+        return (table["region"], table["area_ik"], table["territory_ik"])
+    return (table["region"], table["area_ik"])
+
+
+def row_total_mismatches(table):
+    """Return the row headers of the rows whose zeroth column isn't the sum
+    of the other columns.  Rows with missing cells are not checked."""
+    return [
+        header
+        for (header, row) in zip(table["row_headers"], table["data"])
+        if row and row[0] != sum(row[1:]) and min(row) >= 0
+    ]
+
+
+def pack(data):
+    """Pack the data matrix into a flat array: int64 if all the values are
+    ints, float64 otherwise.  Arrays take a fraction of the memory of lists
+    of numbers, and get pickled as a single block of bytes."""
+    flat = [value for row in data for value in row]
+    try:
+        return array.array("q", flat)
+    except TypeError:
+        return array.array("d", flat)
+
+
+class Table(object):
+    """What the index keeps of a table."""
+
+    __slots__ = ("family", "path", "row_headers", "child_names", "values")
+
+    def __init__(self, family, path, row_headers, child_names, values):
+        self.family = family
+        self.path = path
+        self.row_headers = row_headers
+        self.child_names = child_names
+        self.values = values
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def column(self, index):
+        """Return the values of a column: 0 for the totals of the table's
+        own node, or 1 + the index of a child in child_names."""
+        return self.values[index::len(self.child_names) + 1].tolist()
+
+
+class Hierarchy(object):
+    """Totals, counts and consistency checks for every node, kept up to date
+    as tables get added."""
+
+    def __init__(self):
+        self.tables = {}
+        """url: Table."""
+        self.own = {}
+        """(family, path): the url of the table that reports the node's
+        totals in its zeroth column."""
+        self.rollups = {}
+        """(family, path): {row header: value} for regions and the country."""
+        self.children = collections.defaultdict(collections.Counter)
+        """(family, path): how many tables mention each child of the node."""
+        self.level_counts = collections.defaultdict(collections.Counter)
+        """(family, region): the number of nodes at each level."""
+        self.row_mismatches = {}
+        """url: the row headers that fail the row total check."""
+        self.level_mismatches = set()
+        """(family, path) of the nodes whose own and listed totals differ."""
+        self.conflicts = {}
+        """url: (family, path) of the tables left out because another table
+        already reports the node's totals."""
+        self.interned = {}
+
+        self.offset = 0
+        """How far into results.json the index has read, decompressed."""
+        self.size = 0
+        """The size of results.json on disk when the index last read it."""
+        self.dictionary = compact.HeaderDictionary()
+
+    def __setstate__(self, state):
+        #
+        # Indexes saved before an attribute was added get its initial value.
+        #
+        self.__init__()
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self.tables)
+
+    def _intern(self, row_headers):
+        #
+        # Share one tuple between all the tables with the same row headers,
+        # so that thousands of tables don't hold copies of the same headers.
+        #
+        row_headers = tuple(row_headers)
+        return self.interned.setdefault(row_headers, row_headers)
+
+    def add(self, table):
+        """Index the table, replacing any table with the same url."""
+        family = FAMILIES.get(table["data_type"])
+        if family is None:
+            return
+        url = table["url"]
+        if url in self.tables:
+            self.remove(url)
+
+        path = table_path(table)
+        if (family, path) in self.own:
+            self.conflicts[url] = family, path
+            return
+        self.conflicts.pop(url, None)
+        entry = self.tables[url] = Table(
+            family, path, self._intern(table["row_headers"]),
+            tuple(table["column_headers"][1:]), pack(table["data"])
+        )
+        self.own[family, path] = url
+
+        self._count(family, path[:1], 1)
+        self._count(family, path, 1)
+        for name in entry.child_names:
+            self._count(family, path + (name,), 1)
+        if len(path) == 2:
+            self._roll_up(entry, 1)
+        self._check_levels(entry)
+
+        mismatches = row_total_mismatches(table)
+        if mismatches:
+            self.row_mismatches[url] = mismatches
+
+    def remove(self, url):
+        """Remove the table with the url from the index."""
+        entry = self.tables.pop(url)
+        family, path = entry.family, entry.path
+        del self.own[family, path]
+
+        self._count(family, path[:1], -1)
+        self._count(family, path, -1)
+        for name in entry.child_names:
+            self._count(family, path + (name,), -1)
+        if len(path) == 2:
+            self._roll_up(entry, -1)
+        self._check_levels(entry)
+        self.row_mismatches.pop(url, None)
+
+    def _count(self, family, path, delta):
+        """Keep track of how many tables mention the node, and of the
+        number of nodes at each level of each region."""
+        children = self.children[family, path[:-1]]
+        children[path[-1]] += delta
+        if not children[path[-1]]:
+            del children[path[-1]]
+            if len(path) > 1:
+                self.level_counts[family, path[0]][LEVELS[len(path) - 1]] -= 1
+        elif children[path[-1]] == 1 and delta == 1 and len(path) > 1:
+            self.level_counts[family, path[0]][LEVELS[len(path) - 1]] += 1
+
+    def _roll_up(self, entry, sign):
+        for ancestor in [(), entry.path[:1]]:
+            rollup = self.rollups.setdefault((entry.family, ancestor), {})
+            for header, value in zip(entry.row_headers, entry.column(0)):
+                if value >= 0:
+                    rollup[header] = rollup.get(header, 0) + sign * value
+
+    def _check_levels(self, entry):
+        """Re-check the nodes whose own or listed totals the table has
+        changed: its own node, and its children."""
+        paths = [entry.path] + [
+            entry.path + (name,) for name in entry.child_names
+        ]
+        for path in paths:
+            key = entry.family, path
+            own = self._own(key)
+            if own is not None and own != (self._listed(key) or own):
+                self.level_mismatches.add(key)
+            else:
+                self.level_mismatches.discard(key)
+
+    def _own(self, key):
+        """Return {row header: value} from the node's own table, or None."""
+        url = self.own.get(key)
+        if url is None:
+            return None
+        entry = self.tables[url]
+        return dict(zip(entry.row_headers, entry.column(0)))
+
+    def _listed(self, key):
+        """Return {row header: value} from the parent's table, or None."""
+        family, path = key
+        url = self.own.get((family, path[:-1]))
+        if url is None:
+            return None
+        entry = self.tables[url]
+        try:
+            index = entry.child_names.index(path[-1])
+        except ValueError:
+            return None
+        return dict(zip(entry.row_headers, entry.column(index + 1)))
+
+    def totals(self, path=(), family="federal"):
+        """Return {row header: value} for the node, or None if no table
+        mentions it.  Nodes below regions prefer the totals from their own
+        table over those listed in their parent's table."""
+        path = tuple(path)
+        if len(path) < 2:
+            return self.rollups.get((family, path))
+        own = self._own((family, path))
+        return own if own is not None else self._listed((family, path))
+
+    def counts(self, region, family="federal"):
+        """Return the number of OIKs, TIKs and UIKs in the region."""
+        counts = self.level_counts.get((family, region), {})
+        return {level: counts.get(level, 0) for level in LEVELS[1:]}
+
+    def child_names(self, path=(), family="federal"):
+        """Return the names of the children of the node, sorted."""
+        return sorted(self.children.get((family, tuple(path)), ()))
+
+    def inconsistencies(self):
+        """Return a sorted list of (check, family, path, detail) for the
+        failed checks.  The row_total check compares the zeroth column of a
+        table with the sum of the other columns, and detail is the list of
+        offending row headers.  The level check compares the totals of a
+        node from its own table against those listed in its parent's table,
+        and detail is the list of row headers that differ.  The conflict
+        check reports a table left out for a node that already had one, and
+        detail is its url and that of the indexed table, if it's still
+        there."""
+        result = []
+        for url, row_headers in self.row_mismatches.items():
+            entry = self.tables[url]
+            result.append(("row_total", entry.family, entry.path, row_headers))
+        for key in self.level_mismatches:
+            own, listed = self._own(key), self._listed(key)
+            result.append((
+                "level", key[0], key[1],
+                sorted(h for h in own.keys() | listed.keys()
+                       if own.get(h) != listed.get(h))
+            ))
+        for url, (family, path) in self.conflicts.items():
+            other = self.own.get((family, path))
+            result.append((
+                "conflict", family, path, [url] + ([other] if other else [])
+            ))
+        return sorted(result)
+
+    def update(self, results_path):
+        """Index the tables appended to results.json since the last update.
+
+        results.json may be compressed (see dataset.open_results).  Returns
+        the number of tables read.  If the file is smaller than at the last
+        update, it has been overwritten, so start over.  An incomplete last
+        line is left for the next update."""
+        size = os.path.getsize(results_path)
+        if size < self.size:
+            self.__init__()
+        self.size = size
+
+        num_tables = 0
+        with dataset.open_results(results_path) as fin:
+            fin.seek(self.offset)
+            for line in dataset.iter_lines(fin):
+                if not line.endswith(b"\n"):
+                    break
+                self.offset += len(line)
+                if line.startswith(compact.HEADERS_PREFIX):
+                    self.dictionary.update(dataset.loads(line))
+                    continue
+                table = dataset.loads(line)
+                if compact.is_compact(table):
+                    compact.expand_table(table, self.dictionary)
+                self.add(table)
+                num_tables += 1
+        return num_tables
+
+    def save(self, path):
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as fout:
+            pickle.dump(self, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fin:
+            return pickle.load(fin)
+
+
+def build(results_path, index_path=None):
+    """Return the index of results.json, updated with any new tables.
+
+    If index_path is specified, the index is loaded from there if it
+    exists, and saved back after the update."""
+    if index_path and P.isfile(index_path):
+        index = Hierarchy.load(index_path)
+    else:
+        index = Hierarchy()
+    num_tables = index.update(results_path)
+    if index_path and (num_tables or not P.isfile(index_path)):
+        index.save(index_path)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("results", help="the results.json to index")
+    parser.add_argument(
+        "--index", help="where to keep the index between runs"
+    )
+    parser.add_argument(
+        "--family", default="federal", choices=sorted(set(FAMILIES.values()))
+    )
+    args = parser.parse_args()
+
+    index = build(args.results, args.index)
+    writer = csv.writer(sys.stdout, delimiter="|", lineterminator="\n")
+    writer.writerow(["region"] + list(LEVELS[1:]))
+    for region in index.child_names((), args.family):
+        counts = index.counts(region, args.family)
+        writer.writerow([region] + [counts[level] for level in LEVELS[1:]])
+
+    for check, family, path, detail in index.inconsistencies():
+        print("%s: %s %s: %s" % (
+            check, family, " / ".join(path), ", ".join(detail)
+        ), file=sys.stderr)
+
+
+class HierarchyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.federal = {
+            "url": "oik1", "data_type": "federal", "region": "r",
+            "area_ik": "o1", "row_headers": ["voters", "party"],
+            "column_headers": ["Сумма", "t1", "t2"],
+            "data": [[10, 4, 6], [5, 2, 3]],
+        }
+        self.federal2 = dict(
+            self.federal, url="oik2", area_ik="o2",
+            column_headers=["Сумма", "t3"], data=[[1, 1], [1, 1]]
+        )
+        self.federal_uik = {
+            "url": "tik1", "data_type": "federal_uik", "region": "r",
+            "area_ik": "o1", "territory_ik": "t1",
+            "row_headers": ["voters", "party"],
+            "column_headers": ["Сумма", "u1", "u2"],
+            "data": [[4, 3, 1], [2, 2, 0]],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_totals(self):
+        index = Hierarchy()
+        for table in [self.federal, self.federal2, self.federal_uik]:
+            index.add(table)
+        self.assertEqual(index.totals(), {"voters": 11, "party": 6})
+        self.assertEqual(index.totals(("r",)), {"voters": 11, "party": 6})
+        self.assertEqual(index.totals(("r", "o1", "t2")), {"voters": 6,
+                                                           "party": 3})
+        self.assertEqual(
+            index.totals(("r", "o1", "t1", "u1")), {"voters": 3, "party": 2}
+        )
+        self.assertIsNone(index.totals(("r", "o3")))
+        self.assertEqual(index.child_names(), ["r"])
+        self.assertEqual(index.child_names(("r", "o1")), ["t1", "t2"])
+        self.assertEqual(index.counts("r"), {"oik": 2, "tik": 3, "uik": 2})
+        self.assertEqual(index.inconsistencies(), [])
+
+    def test_replace(self):
+        index = Hierarchy()
+        index.add(self.federal)
+        index.add(self.federal_uik)
+        index.add(dict(self.federal, data=[[11, 4, 6], [6, 3, 3]]))
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.totals(("r",)), {"voters": 11, "party": 6})
+        self.assertEqual(index.counts("r"), {"oik": 1, "tik": 2, "uik": 2})
+        self.assertEqual(
+            index.inconsistencies(),
+            [
+                ("level", "federal", ("r", "o1", "t1"), ["party"]),
+                ("row_total", "federal", ("r", "o1"), ["voters"]),
+            ]
+        )
+
+        index.add(self.federal)
+        self.assertEqual(index.inconsistencies(), [])
+        index.remove("tik1")
+        self.assertEqual(index.counts("r"), {"oik": 1, "tik": 2, "uik": 0})
+        index.remove("oik1")
+        self.assertEqual(index.child_names(), [])
+
+    def test_build(self):
+        results_path = P.join(self.path, "results.json")
+        index_path = P.join(self.path, "results.index")
+        with open(results_path, "w") as fout:
+            fout.write(json.dumps(self.federal) + "\n")
+            fout.write(json.dumps({"url": "x", "data_type": "turnout"}))
+        self.assertEqual(len(build(results_path, index_path)), 1)
+
+        with open(results_path, "a") as fout:
+            fout.write("\n" + json.dumps(self.federal_uik) + "\n")
+        index = build(results_path, index_path)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.offset, os.path.getsize(results_path))
+        self.assertEqual(index.counts("r")["uik"], 2)
+
+    def test_conflict(self):
+        index = Hierarchy()
+        index.add(self.federal)
+        index.add(dict(self.federal, url="oik1b", data=[[1, 1, 0]]))
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.totals(("r",)), {"voters": 10, "party": 5})
+        self.assertEqual(
+            index.inconsistencies(),
+            [("conflict", "federal", ("r", "o1"), ["oik1b", "oik1"])]
+        )
+        index.remove("oik1")
+        self.assertEqual(
+            index.inconsistencies(),
+            [("conflict", "federal", ("r", "o1"), ["oik1b"])]
+        )
+
+    def test_gzip(self):
+        results_path = P.join(self.path, "results.json.gz")
+        with gzip.open(results_path, "wt") as fout:
+            fout.write(json.dumps(self.federal) + "\n")
+        index = build(results_path)
+        self.assertEqual(len(index), 1)
+
+        with gzip.open(results_path, "at") as fout:
+            fout.write(json.dumps(self.federal_uik) + "\n")
+        self.assertEqual(index.update(results_path), 1)
+        self.assertEqual(len(index), 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""A content-addressed store for the raw HTML of the scraped tables.
+
+Each page is stored gzipped under the md5 of its body, which is the same md5
+that ends up in the scraped record.  An append-only index maps each URL to
+the md5 of its most recent body, along with the data_type, encoding and
+timestamp that we need to parse it again.
+
+To re-parse everything in the cache without touching the network:
+
+    python -m gosduma7.htmlcache replay htmlcache -o results.json
+"""
+import argparse
+import concurrent.futures
+import gzip
+import json
+import logging
+import os
+import os.path as P
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from gosduma7.dataset import dumps
+from gosduma7.parsing import parse_page
+
+LOGGER = logging.getLogger(__name__)
+
+INDEX = "index.jsonl"
+
+
+class HtmlCache(object):
+    """A directory of gzipped HTML pages, keyed by the md5 of the page."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _object_path(self, md5):
+        return P.join(self.path, md5[:2], md5 + ".html.gz")
+
+    def __contains__(self, md5):
+        return P.isfile(self._object_path(md5))
+
+    def put(self, url, body, md5, data_type, encoding, timestamp):
+        """Store the page body and point the URL at it."""
+        path = self._object_path(md5)
+        if not P.isfile(path):
+            os.makedirs(P.dirname(path), exist_ok=True)
+            #
+            # Write to a temporary file first, so that a crash never leaves
+            # a truncated page behind under a valid md5.
+            #
+            with gzip.open(path + ".tmp", "wb") as fout:
+                fout.write(body)
+            os.rename(path + ".tmp", path)
+
+        entry = {
+            "url": url, "md5": md5, "data_type": data_type,
+            "encoding": encoding, "timestamp": timestamp
+        }
+        with open(P.join(self.path, INDEX), "a") as fout:
+            fout.write(json.dumps(entry) + "\n")
+
+    def get(self, md5):
+        """Return the page body stored under the md5."""
+        with gzip.open(self._object_path(md5), "rb") as fin:
+            return fin.read()
+
+    def entries(self):
+        """Return the most recent index entry for each URL, in crawl order."""
+        index_path = P.join(self.path, INDEX)
+        if not P.isfile(index_path):
+            return []
+
+        latest = {}
+        with open(index_path) as fin:
+            for line in fin:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #
+                    # The last line may be incomplete if the crawl died
+                    # while we were writing it.
+                    #
+                    LOGGER.warning("skipping bad index line: %r", line)
+                    continue
+                latest.pop(entry["url"], None)
+                latest[entry["url"]] = entry
+        return list(latest.values())
+
+
+def parse_entry(cache_path, entry):
+    """Parse the page that the index entry points to.  Returns None if it
+    has no data table."""
+    body = HtmlCache(cache_path).get(entry["md5"])
+    try:
+        result = parse_page(
+            entry["url"], body, entry["encoding"], entry["data_type"]
+        )
+    except ValueError as error:
+        LOGGER.warning("skipping %r: %s", entry["url"], error)
+        return None
+    #
+    # Keep the time the page was fetched, not the time we parsed it.
+    #
+    result["timestamp"] = entry["timestamp"]
+    return result
+
+
+def replay(cache, fout, processes=0):
+    """Parse all the pages in the cache again, writing records to fout.
+
+    If processes is non-zero, parse in that many worker processes.  The
+    records are written in the same format as LineExporter, in crawl order.
+    Pages without a data table are skipped.  Returns the number of pages
+    parsed."""
+    entries = cache.entries()
+    paths = [cache.path] * len(entries)
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(processes)
+        results = executor.map(parse_entry, paths, entries, chunksize=16)
+    else:
+        executor = None
+        results = map(parse_entry, paths, entries)
+
+    count = 0
+    for result in results:
+        if result is None:
+            continue
+        fout.write(dumps(result))
+        count += 1
+
+    if executor is not None:
+        executor.shutdown()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="re-parse the cached pages without any network access"
+    )
+    replay_parser.add_argument("cache_dir")
+    replay_parser.add_argument(
+        "-o", "--output", default="-", help="where to write the JSON lines"
+    )
+    replay_parser.add_argument(
+        "-p", "--processes", type=int, default=0,
+        help="parse in this many worker processes (default: 0, no workers)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    cache = HtmlCache(args.cache_dir)
+    start = time.time()
+    if args.output == "-":
+        count = replay(cache, sys.stdout.buffer, args.processes)
+    else:
+        with open(args.output, "wb") as fout:
+            count = replay(cache, fout, args.processes)
+    elapsed = time.time() - start
+    LOGGER.info(
+        "parsed %d pages in %.1fs (%.1f pages/s)",
+        count, elapsed, count / elapsed if elapsed else 0
+    )
+
+
+class HtmlCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = HtmlCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_latest_entry_wins(self):
+        self.cache.put("http://a", b"old", "1" * 32, "federal", "utf-8", "t1")
+        self.cache.put("http://b", b"b", "2" * 32, "single", "utf-8", "t2")
+        self.cache.put("http://a", b"new", "3" * 32, "federal", "utf-8", "t3")
+
+        entries = self.cache.entries()
+        self.assertEqual([e["url"] for e in entries], ["http://b", "http://a"])
+        self.assertEqual(self.cache.get(entries[1]["md5"]), b"new")
+
+    def test_replay(self):
+        """Replayed pages should parse the same as the original responses."""
+        import io
+        from gosduma7 import parsing
+        from gosduma7.spiders import myspider
+
+        response = myspider.mock_response("test_parse_turnout.html")
+        expected = parsing.parse_table(response, "turnout")
+        self.cache.put(
+            response.url, response.body, expected["md5"], "turnout", "utf-8",
+            expected["timestamp"]
+        )
+
+        self.cache.put(
+            "http://empty", b"<html><body><p>No data</p></body></html>",
+            "0" * 32, "turnout", "utf-8", expected["timestamp"]
+        )
+
+        with self.assertLogs(LOGGER, logging.WARNING):
+            self.assertEqual(replay(self.cache, io.BytesIO()), 1)
+        for processes in [0, 2]:
+            fout = io.BytesIO()
+            self.assertEqual(replay(self.cache, fout, processes), 1)
+            actual = json.loads(fout.getvalue().decode("utf-8"))
+            self.assertEqual(actual, expected)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Wall time, CPU time and bytes for the parts of the crawl.
+
+Timings are recorded only while a Recorder is active, so that the phases
+cost next to nothing otherwise:
+
+    with instrumentation.phase("parse/rows"):
+        ...
+
+The Instrumentation extension activates a Recorder for the duration of the
+crawl.  Phases that run in worker processes (see PARSE_PROCESSES) don't get
+recorded.
+"""
+import collections
+import contextlib
+import csv
+import json
+import time
+import unittest
+
+HISTOGRAM_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1,
+                    2, 5, 10)
+"""The upper bounds of the wall time histogram buckets, in seconds."""
+
+SUMMARY_FIELDS = [
+    "name", "count", "wall_total", "wall_mean", "wall_p50", "wall_p90",
+    "wall_p99", "wall_max", "cpu_total", "bytes_total"
+]
+
+RECORDER = None
+"""The active Recorder, if any."""
+
+_NOT_RECORDING = contextlib.nullcontext()
+
+
+def phase(name, nbytes=0):
+    """Time the with block under name, if a Recorder is active."""
+    if RECORDER is None:
+        return _NOT_RECORDING
+    return RECORDER.timer(name, nbytes)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def histogram(values):
+    """Count the values in each of the HISTOGRAM_BOUNDS buckets."""
+    counts = collections.OrderedDict(
+        ("<=%gs" % bound, 0) for bound in HISTOGRAM_BOUNDS
+    )
+    counts[">%gs" % HISTOGRAM_BOUNDS[-1]] = 0
+    keys = list(counts)
+    for value in values:
+        for key, bound in zip(keys, HISTOGRAM_BOUNDS):
+            if value <= bound:
+                counts[key] += 1
+                break
+        else:
+            counts[keys[-1]] += 1
+    return counts
+
+
+class Recorder(object):
+    """Collects (wall, cpu, bytes) samples under names."""
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+
+    def add(self, name, wall, cpu=0.0, nbytes=0):
+        self.samples[name].append((wall, cpu, nbytes))
+
+    @contextlib.contextmanager
+    def timer(self, name, nbytes=0):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(
+                name, time.perf_counter() - wall,
+                time.process_time() - cpu, nbytes
+            )
+
+    def summary(self):
+        """Return the statistics and wall time histogram of each name."""
+        summary = collections.OrderedDict()
+        for name, samples in sorted(self.samples.items()):
+            walls = sorted(wall for (wall, _, _) in samples)
+            summary[name] = {
+                "count": len(samples),
+                "wall_total": sum(walls),
+                "wall_mean": sum(walls) / len(walls),
+                "wall_p50": percentile(walls, 0.5),
+                "wall_p90": percentile(walls, 0.9),
+                "wall_p99": percentile(walls, 0.99),
+                "wall_max": walls[-1],
+                "cpu_total": sum(cpu for (_, cpu, _) in samples),
+                "bytes_total": sum(nbytes for (_, _, nbytes) in samples),
+                "histogram": histogram(walls),
+            }
+        return summary
+
+    def write_json(self, fout):
+        json.dump(self.summary(), fout, indent=2)
+
+    def write_csv(self, fout):
+        writer = csv.DictWriter(
+            fout, SUMMARY_FIELDS, extrasaction="ignore", lineterminator="\n"
+        )
+        writer.writeheader()
+        for name, statistics in self.summary().items():
+            writer.writerow(dict(statistics, name=name))
+
+
+class RecorderTest(unittest.TestCase):
+
+    def tearDown(self):
+        global RECORDER
+        RECORDER = None
+
+    def test_phase(self):
+        global RECORDER
+        with phase("nothing"):
+            pass
+        RECORDER = Recorder()
+        with phase("something", nbytes=10):
+            pass
+        self.assertEqual(list(RECORDER.samples), ["something"])
+
+    def test_summary(self):
+        import io
+
+        recorder = Recorder()
+        for wall in [0.0005, 0.003, 0.003, 20]:
+            recorder.add("page", wall, 0.001, 100)
+        summary = recorder.summary()["page"]
+        self.assertEqual(summary["count"], 4)
+        self.assertEqual(summary["wall_p50"], 0.003)
+        self.assertEqual(summary["wall_max"], 20)
+        self.assertEqual(summary["bytes_total"], 400)
+        self.assertEqual(summary["histogram"]["<=0.001s"], 1)
+        self.assertEqual(summary["histogram"]["<=0.005s"], 2)
+        self.assertEqual(summary["histogram"][">10s"], 1)
+
+        fout = io.StringIO()
+        recorder.write_csv(fout)
+        self.assertEqual(
+            fout.getvalue().splitlines()[0], ",".join(SUMMARY_FIELDS)
+        )
@@ -12,3 +12,15 @@ class Gosduma7Item(scrapy.Item):
     # define the fields for your item here like:
     # name = scrapy.Field()
     pass
+
+
+class PageItem(scrapy.Item):
+    """A page whose table is yet to be parsed.
+
+    The spider yields these instead of the parsed tables when parsing is
+    done in a process pool.  ParsePoolPipeline replaces them with the
+    parsed tables."""
+    url = scrapy.Field()
+    body = scrapy.Field()
+    encoding = scrapy.Field()
+    data_type = scrapy.Field()
@@ -0,0 +1,1362 @@
+# -*- coding: utf-8 -*-
+
+# Define here the models for your spider and downloader middlewares
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/downloader-middleware.html
+# http://doc.scrapy.org/en/latest/topics/spider-middleware.html
+import collections
+import datetime
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import os.path as P
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import mock
+import scrapy.dupefilters
+import scrapy.exceptions
+import scrapy.http
+import scrapy.settings
+import scrapy.signals
+import scrapy.statscollectors
+import scrapy.utils.defer
+import scrapy.utils.httpobj
+import w3lib.url
+from twisted.internet import defer
+
+from gosduma7 import checkpoint
+from gosduma7 import dataset
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_previous(path):
+    """Load the url, md5 and timestamp of each record from a previous crawl.
+
+    Returns a dictionary keyed by url.  The values are (md5, timestamp)
+    tuples, where timestamp is a datetime."""
+    previous = {}
+    with dataset.open_results(path) as fin:
+        for line in dataset.iter_lines(fin):
+            record = json.loads(line.decode("utf-8"))
+            if "url" not in record:
+                #
+                # A header record written by CompactLineExporter
+                #
+                continue
+            timestamp = datetime.datetime.strptime(
+                record["timestamp"][:19], "%Y-%m-%dT%H:%M:%S"
+            )
+            previous[record["url"]] = (record["md5"], timestamp)
+    return previous
+
+
+class IncrementalMiddleware(object):
+    """Recognize the tables that have not changed since a previous crawl.
+
+    INCREMENTAL_PREVIOUS points to the results of the previous crawl.  For
+    requests that have "conditional" in their meta, we send an
+    If-Modified-Since header with the time the page was previously fetched.
+    If the server answers with 304 Not Modified, or the body hashes to the
+    same md5 as before, we set "unchanged" in the meta, and the spider skips
+    parsing the table.  So only the tables that have changed get written
+    out."""
+
+    def __init__(self, previous, stats):
+        self.previous = previous
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("INCREMENTAL_PREVIOUS")
+        if not path:
+            raise scrapy.exceptions.NotConfigured
+        previous = load_previous(path)
+        LOGGER.info("loaded %d records from %r", len(previous), path)
+        return cls(previous, crawler.stats)
+
+    def process_request(self, request, spider=None):
+        if not request.meta.get("conditional") or \
+                request.url not in self.previous:
+            return None
+
+        _, timestamp = self.previous[request.url]
+        request.headers.setdefault(
+            "If-Modified-Since",
+            email.utils.format_datetime(
+                timestamp.replace(tzinfo=datetime.timezone.utc), usegmt=True
+            )
+        )
+        statuses = request.meta.setdefault("handle_httpstatus_list", [])
+        if 304 not in statuses:
+            statuses.append(304)
+        return None
+
+    def process_response(self, request, response, spider=None):
+        if request.url not in self.previous:
+            return response
+
+        md5, _ = self.previous[request.url]
+        if response.status == 304:
+            request.meta["unchanged"] = True
+            self.stats.inc_value("incremental/not_modified")
+        elif hashlib.md5(response.body).hexdigest() == md5:
+            request.meta["unchanged"] = True
+            self.stats.inc_value("incremental/unchanged")
+        else:
+            self.stats.inc_value("incremental/changed")
+        return response
+
+
+def callback_level(request):
+    """Return the name of the callback of the request, without mangling.
+
+    Each callback handles one level of the hierarchy, e.g. parse_level1 for
+    the OIK pages."""
+    if request.callback is None:
+        return "parse"
+    name = getattr(request.callback, "__name__", str(request.callback))
+    if name.startswith("_") and "__" in name:
+        name = name.split("__", 1)[1]
+    return name
+
+
+class Level(object):
+    """What AdaptiveConcurrencyMiddleware knows about a level."""
+
+    def __init__(self, concurrency):
+        self.concurrency = float(concurrency)
+        self.delay = 0.0
+        self.latency = None
+        self.responses = 0
+        self.errors = 0
+        self.in_flight = 0
+
+
+class AdaptiveConcurrencyMiddleware(object):
+    """Adjust the concurrency of each level of the hierarchy separately.
+
+    Each level (region, OIK, TIK, UIK pages) gets its own download slot,
+    because the levels are served at very different speeds.  Concurrency
+    grows additively while the smoothed latency of a level stays under
+    ADAPTIVE_TARGET_LATENCY, and halves on a 5xx, 429 or download error.  At
+    a concurrency of one, errors double the download delay instead.
+
+    ADAPTIVE_MAX_CONCURRENCY is the politeness budget towards the server:
+    the number of requests in flight across all the levels.  A level can't
+    grow into the share of the budget that the others hold, but each level
+    gets at least one, so requests wait here until both their level and the
+    budget have room for them.  A request stops counting once it leaves the
+    downloader, or comes back without reaching it.
+
+    This replaces AutoThrottle: don't enable both."""
+
+    SMOOTHING = 0.2
+    """The weight of the latest latency in the moving average."""
+
+    MAX_DELAY = 10.0
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_concurrency = settings.getint(
+            "ADAPTIVE_MAX_CONCURRENCY",
+            settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN")
+        )
+        self.start_concurrency = settings.getint(
+            "ADAPTIVE_START_CONCURRENCY", 2
+        )
+        self.target_latency = settings.getfloat(
+            "ADAPTIVE_TARGET_LATENCY", 1.0
+        )
+        self.start_delay = max(settings.getfloat("DOWNLOAD_DELAY"), 0.25)
+        self.levels = {}
+        self.in_flight = {}
+        self.waiting = collections.deque()
+        self.start_time = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("ADAPTIVE_CONCURRENCY_ENABLED"):
+            raise scrapy.exceptions.NotConfigured
+        middleware = cls(crawler)
+        crawler.signals.connect(
+            middleware.spider_opened, signal=scrapy.signals.spider_opened
+        )
+        crawler.signals.connect(
+            middleware.spider_closed, signal=scrapy.signals.spider_closed
+        )
+        crawler.signals.connect(
+            middleware.request_left_downloader,
+            signal=scrapy.signals.request_left_downloader
+        )
+        return middleware
+
+    def spider_opened(self, spider):
+        self.start_time = time.monotonic()
+
+    def spider_closed(self, spider):
+        responses = sum(level.responses for level in self.levels.values())
+        elapsed = time.monotonic() - (self.start_time or time.monotonic())
+        pages_per_second = responses / elapsed if elapsed else 0.0
+        self.stats.set_value(
+            "adaptive/pages_per_second", round(pages_per_second, 2)
+        )
+        LOGGER.info(
+            "%d pages in %.1fs (%.2f pages/s)",
+            responses, elapsed, pages_per_second
+        )
+        for name, level in sorted(self.levels.items()):
+            LOGGER.info(
+                "%s: %d pages, %d errors, latency %.2fs, concurrency %d, "
+                "delay %.2fs", name, level.responses, level.errors,
+                level.latency or 0.0, int(level.concurrency), level.delay
+            )
+
+    def _level(self, request):
+        name = callback_level(request)
+        if name not in self.levels:
+            self.levels[name] = Level(
+                min(self.start_concurrency, self._spare_concurrency(None))
+            )
+        return name, self.levels[name]
+
+    def _spare_concurrency(self, exclude):
+        used = sum(
+            int(level.concurrency) for level in self.levels.values()
+            if level is not exclude
+        )
+        return max(self.max_concurrency - used, 1)
+
+    def _apply(self, request, level):
+        """Set the concurrency and delay of the level's download slot, and
+        of the slot that the downloader creates for it, if it hasn't yet (or
+        has dropped it for being idle)."""
+        key = request.meta.get("download_slot")
+        if key is None:
+            return
+        downloader = self.crawler.engine.downloader
+        downloader.per_slot_settings[key] = {
+            "concurrency": int(level.concurrency), "delay": level.delay
+        }
+        slot = downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = int(level.concurrency)
+            slot.delay = level.delay
+
+    def _has_room(self, level):
+        return len(self.in_flight) < self.max_concurrency and \
+            level.in_flight < int(level.concurrency)
+
+    def _take(self, request, level):
+        self.in_flight[request] = level
+        level.in_flight += 1
+
+    def _release(self, request):
+        """Stop counting the request, if it still counts, and let through
+        the waiting requests that there's room for now."""
+        level = self.in_flight.pop(request, None)
+        if level is not None:
+            level.in_flight -= 1
+        waiting = self.waiting
+        self.waiting = collections.deque()
+        for request, level, waiter in waiting:
+            if self._has_room(level):
+                self._take(request, level)
+                waiter.callback(None)
+            else:
+                self.waiting.append((request, level, waiter))
+
+    async def process_request(self, request, spider=None):
+        name, level = self._level(request)
+        host = scrapy.utils.httpobj.urlparse_cached(request).hostname
+        request.meta.setdefault("download_slot", "%s/%s" % (host, name))
+        self._apply(request, level)
+        if self._has_room(level):
+            self._take(request, level)
+        else:
+            waiter = defer.Deferred()
+            self.waiting.append((request, level, waiter))
+            await scrapy.utils.defer.maybe_deferred_to_future(waiter)
+        return None
+
+    def request_left_downloader(self, request, spider):
+        self._release(request)
+
+    def process_response(self, request, response, spider=None):
+        name, level = self._level(request)
+        if response.status >= 500 or response.status == 429:
+            self._back_off(name, level)
+        else:
+            latency = request.meta.get("download_latency")
+            self._speed_up(name, level, latency)
+        self._apply(request, level)
+        self._release(request)
+        return response
+
+    def process_exception(self, request, exception, spider=None):
+        if not isinstance(exception, scrapy.exceptions.IgnoreRequest):
+            name, level = self._level(request)
+            self._back_off(name, level)
+            self._apply(request, level)
+        self._release(request)
+        return None
+
+    def _speed_up(self, name, level, latency):
+        level.responses += 1
+        if latency is not None:
+            if level.latency is None:
+                level.latency = latency
+            level.latency += self.SMOOTHING * (latency - level.latency)
+
+        if level.latency is not None and level.latency > self.target_latency:
+            level.concurrency = max(level.concurrency - 1, 1.0)
+        elif level.delay:
+            level.delay = level.delay / 2 if level.delay > 0.05 else 0.0
+        else:
+            #
+            # Add one request per round trip, i.e. once every concurrency
+            # responses.
+            #
+            level.concurrency = min(
+                level.concurrency + 1 / level.concurrency,
+                self._spare_concurrency(level) + 0.99
+            )
+        self.stats.set_value(
+            "adaptive/%s/concurrency" % name, int(level.concurrency)
+        )
+
+    def _back_off(self, name, level):
+        level.errors += 1
+        if level.concurrency >= 2:
+            level.concurrency = float(int(level.concurrency) // 2)
+        else:
+            level.delay = min(
+                max(level.delay * 2, self.start_delay), self.MAX_DELAY
+            )
+        self.stats.inc_value("adaptive/%s/errors" % name)
+        LOGGER.debug(
+            "backing off %s: concurrency %d, delay %.2fs",
+            name, int(level.concurrency), level.delay
+        )
+
+
+def callback_name(request):
+    """Return the name of the spider attribute holding the callback."""
+    if request.callback is None:
+        return None
+    name = request.callback.__name__
+    if name.startswith("__") and not name.endswith("__"):
+        #
+        # Private methods are stored under a mangled name.
+        #
+        class_name = request.callback.__qualname__.split(".")[-2]
+        name = "_%s%s" % (class_name.lstrip("_"), name)
+    return name
+
+
+def canonical_url(url):
+    """Return the url in a form that is the same for all the urls of a page.
+
+    izbirkom urls for the same page differ in the order of their query
+    parameters (global, vrn, region, prver, pronetvd, ...), so these get
+    sorted."""
+    return w3lib.url.canonicalize_url(url)
+
+
+class CoalescingDupeFilter(scrapy.dupefilters.BaseDupeFilter):
+    """Filter out repeated requests for the same page and callback.
+
+    Unlike RFPDupeFilter, it lets through a request for a page that has
+    been requested with a different callback, instead of dropping it, and
+    CoalescingMiddleware then serves it without downloading the page
+    again."""
+
+    def __init__(self, stats=None):
+        self.stats = stats
+        self.seen = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def request_seen(self, request):
+        key = (
+            request.method, canonical_url(request.url), request.body,
+            callback_name(request)
+        )
+        if key in self.seen:
+            return True
+        self.seen.add(key)
+        return False
+
+    def log(self, request, spider):
+        LOGGER.debug("filtered duplicate request: %r", request)
+        if self.stats is not None:
+            self.stats.inc_value("coalesce/filtered")
+            self.stats.inc_value("coalesce/saved")
+
+
+class CoalescingMiddleware(object):
+    """Download each page once, however many requests there are for it.
+
+    GET requests are keyed by canonical_url.  While a page is downloading,
+    other requests for it wait for that download instead of starting their
+    own, and once it's downloaded, they're served from a cache of the last
+    COALESCE_CACHE_SIZE pages.  Only 200 responses are shared: if the
+    download fails, the waiting requests go ahead with their own.  The
+    coalesce/saved stat counts the downloads saved, including the requests
+    that CoalescingDupeFilter filtered out.
+
+    Enable it with COALESCE_ENABLED, before RetryMiddleware, so that it only
+    sees the final outcome of a download."""
+
+    def __init__(self, stats, cache_size=100):
+        self.stats = stats
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.waiting = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("COALESCE_ENABLED"):
+            raise scrapy.exceptions.NotConfigured
+        return cls(
+            crawler.stats, crawler.settings.getint("COALESCE_CACHE_SIZE", 100)
+        )
+
+    async def process_request(self, request, spider=None):
+        if request.method != "GET":
+            return None
+        key = canonical_url(request.url)
+        keys = request.meta.setdefault("coalesce_keys", [])
+        if key in keys:
+            #
+            # A retry of our own download
+            #
+            return None
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self._saved("cached")
+            return self._serve(self.cache[key], request)
+        if key in self.waiting:
+            waiter = defer.Deferred()
+            self.waiting[key].append(waiter)
+            response = await scrapy.utils.defer.maybe_deferred_to_future(
+                waiter
+            )
+            if response is None:
+                return None
+            self._saved("joined")
+            return self._serve(response, request)
+        self.waiting[key] = []
+        #
+        # A redirected request keeps the meta, so the keys of the urls it
+        # was redirected from get released along with its own.
+        #
+        keys.append(key)
+        return None
+
+    def process_response(self, request, response, spider=None):
+        if "coalesced" in response.flags:
+            return response
+        ok = response.status == 200
+        for key in request.meta.get("coalesce_keys", ()):
+            if ok and self.cache_size:
+                self.cache[key] = response
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            self._release(key, response if ok else None)
+        return response
+
+    def process_exception(self, request, exception, spider=None):
+        for key in request.meta.get("coalesce_keys", ()):
+            self._release(key, None)
+        return None
+
+    def _release(self, key, response):
+        for waiter in self.waiting.pop(key, ()):
+            waiter.callback(response)
+
+    def _serve(self, response, request):
+        return response.replace(
+            url=request.url, request=request,
+            flags=response.flags + ["coalesced"]
+        )
+
+    def _saved(self, how):
+        self.stats.inc_value("coalesce/%s" % how)
+        self.stats.inc_value("coalesce/saved")
+
+
+def requested_url(response):
+    """Return the URL we requested, not the one we got redirected to."""
+    return response.meta.get("redirect_urls", [response.url])[0]
+
+
+def item_key(item):
+    """Return the url and md5 that identify a scraped table."""
+    md5 = item.get("md5")
+    if md5 is None:
+        md5 = hashlib.md5(item["body"]).hexdigest()
+    return item["url"], md5
+
+
+class CheckpointMiddleware(object):
+    """Keep track of the crawl in CHECKPOINT_PATH, so that it can resume.
+
+    Every request the spider makes goes into the frontier of the checkpoint,
+    keyed by canonical_url like the dupefilter, and gets marked as done once the spider has handled its response, and
+    the tables it yielded have been written out: with PARSE_PROCESSES, they
+    may still be in the pipeline long after the callback returns.  If
+    the checkpoint already has a frontier, we start from the requests that
+    weren't done instead of the start URLs.  Requests for pages that were
+    done before are dropped, and so are tables that have been written out
+    before, so that the results of the restarted crawl can be appended to
+    the previous ones without duplicates.  Requests that the scheduler
+    drops count as done too."""
+
+    def __init__(self, checkpoint, stats, crawler=None):
+        self.checkpoint = checkpoint
+        self.stats = stats
+        self.crawler = crawler
+        #
+        # The requested URLs whose callbacks are still running, the number
+        # of items each has in the pipeline, the running ones that already
+        # lost an item, and the number of scheduled requests for each URL
+        # that haven't been handled yet.
+        #
+        self.scheduled = collections.Counter()
+        self.running = set()
+        self.pending = collections.Counter()
+        self.failed = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("CHECKPOINT_PATH")
+        if not path:
+            raise scrapy.exceptions.NotConfigured
+        middleware = cls(checkpoint.Checkpoint(path), crawler.stats, crawler)
+        crawler.signals.connect(
+            middleware.item_scraped, signal=scrapy.signals.item_scraped
+        )
+        crawler.signals.connect(
+            middleware.item_dropped, signal=scrapy.signals.item_dropped
+        )
+        crawler.signals.connect(
+            middleware.item_error, signal=scrapy.signals.item_error
+        )
+        crawler.signals.connect(
+            middleware.request_scheduled,
+            signal=scrapy.signals.request_scheduled
+        )
+        crawler.signals.connect(
+            middleware.request_dropped, signal=scrapy.signals.request_dropped
+        )
+        crawler.signals.connect(
+            middleware.spider_closed, signal=scrapy.signals.spider_closed
+        )
+        return middleware
+
+    def process_start_requests(self, start_requests, spider):
+        if not self.checkpoint.is_empty():
+            yield from self._resume(spider)
+            return
+        for request in start_requests:
+            if isinstance(request, scrapy.Request):
+                self._add(request)
+            yield request
+        self.checkpoint.commit()
+
+    async def process_start(self, start):
+        #
+        # Newer versions of scrapy call this instead of
+        # process_start_requests.
+        #
+        if not self.checkpoint.is_empty():
+            for request in self._resume(self.crawler.spider):
+                yield request
+            return
+        async for request in start:
+            if isinstance(request, scrapy.Request):
+                self._add(request)
+            yield request
+        self.checkpoint.commit()
+
+    def _resume(self, spider):
+        """Return the requests that weren't done when the crawl stopped."""
+        outstanding = self.checkpoint.outstanding()
+        LOGGER.info(
+            "resuming with %d outstanding requests (%r)",
+            len(outstanding), self.checkpoint.counts()
+        )
+        self.stats.set_value("checkpoint/resumed", len(outstanding))
+        return [
+            scrapy.Request(
+                url, callback=getattr(spider, name) if name else None,
+                priority=priority, meta=meta
+            )
+            for (url, name, priority, meta) in outstanding
+        ]
+
+    def process_spider_output(self, response, result, spider=None):
+        self.running.add(self._url(response))
+        try:
+            for element in result:
+                if self._keep(response, element):
+                    yield element
+        except Exception:
+            self._finish(response, checkpoint.FAILED)
+            raise
+        self._finish(response, checkpoint.DONE)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        #
+        # Newer versions of scrapy call this when the callback is an async
+        # generator, or when another middleware is.
+        #
+        self.running.add(self._url(response))
+        try:
+            async for element in result:
+                if self._keep(response, element):
+                    yield element
+        except Exception:
+            self._finish(response, checkpoint.FAILED)
+            raise
+        self._finish(response, checkpoint.DONE)
+
+    def _keep(self, response, element):
+        """Record the request or item, and decide whether to pass it on."""
+        if isinstance(element, scrapy.Request):
+            if not self._add(element):
+                self.stats.inc_value("checkpoint/skipped_requests")
+                return False
+        elif self.checkpoint.has_item(*item_key(element)):
+            self.stats.inc_value("checkpoint/duplicate_items")
+            return False
+        else:
+            #
+            # Count the item before passing it on: the pipeline may be done
+            # with it before we get control back.
+            #
+            self.pending[self._url(response)] += 1
+        return True
+
+    def _finish(self, response, status):
+        """Mark the page once the callback is done with it.
+
+        A page with items still in the pipeline gets marked by the last of
+        them instead, in _item_done, and one whose items failed stays
+        failed."""
+        url = self._url(response)
+        self.running.discard(url)
+        self.scheduled[url] -= 1
+        if self.scheduled[url] <= 0:
+            del self.scheduled[url]
+        if url in self.failed:
+            self.failed.discard(url)
+        elif status == checkpoint.FAILED:
+            del self.pending[url]
+            self._set_status(url, status)
+        elif not self.pending[url]:
+            self._set_status(url, status)
+
+    def _item_done(self, response, status):
+        url = self._url(response)
+        if url not in self.pending:
+            return
+        self.pending[url] -= 1
+        if status == checkpoint.FAILED:
+            del self.pending[url]
+            if url in self.running:
+                self.failed.add(url)
+        elif self.pending[url]:
+            return
+        else:
+            del self.pending[url]
+            if url in self.running:
+                return
+        self._set_status(url, status)
+
+    def _set_status(self, url, status):
+        self.checkpoint.set_status(url, status)
+        self.checkpoint.commit()
+
+    def _url(self, response):
+        """Return the frontier key of the request for the response."""
+        return canonical_url(requested_url(response))
+
+    def _add(self, request):
+        return self.checkpoint.add_request(
+            canonical_url(request.url), callback_name(request),
+            request.priority, request.meta
+        )
+
+    def item_scraped(self, item, response, spider):
+        self.checkpoint.add_item(*item_key(item))
+        self._item_done(response, checkpoint.DONE)
+
+    def item_dropped(self, item, response, spider):
+        self._item_done(response, checkpoint.DONE)
+
+    def item_error(self, item, response, spider):
+        self._item_done(response, checkpoint.FAILED)
+
+    def request_scheduled(self, request, spider):
+        self.scheduled[canonical_url(request.url)] += 1
+
+    def request_dropped(self, request, spider):
+        #
+        # The dupefilter dropped it because the page was requested before.
+        # Unless that request is yet to be handled (and will mark the page
+        # itself), there's nothing left to do for it.
+        #
+        url = canonical_url(request.url)
+        self.scheduled[url] -= 1
+        if self.scheduled[url] <= 0:
+            del self.scheduled[url]
+            if url not in self.running and url not in self.pending and \
+                    self.checkpoint.status(url) == checkpoint.PENDING:
+                self._set_status(url, checkpoint.DONE)
+
+    def spider_closed(self, spider):
+        LOGGER.info("checkpoint: %r", self.checkpoint.counts())
+        self.checkpoint.close()
+
+
+SHARD_ERROR_STATS = ("retry/max_reached", "httperror/response_ignored_count")
+"""The stats that count the pages that a shard lost to errors, as well as
+the callbacks that raised."""
+
+
+class ShardMiddleware(object):
+    """Split the crawl by region between several workers that share
+    SHARD_PATH.  See gosduma7.sharding.
+
+    The region requests from the top page don't get crawled straight away:
+    they go into the shards table, where each worker claims one region at a
+    time, and crawls it until the spider goes idle.  The region is then
+    done, or failed if any of its pages were lost to errors.  The workers
+    share the items table of SHARD_PATH too, so that no table is written
+    out twice.  SHARD_WORKER names the worker: a worker that restarts under
+    the same name picks up the region that it didn't finish.  Not to be
+    combined with CHECKPOINT_PATH."""
+
+    def __init__(self, checkpoint, worker, stats, crawler=None):
+        self.checkpoint = checkpoint
+        self.worker = worker
+        self.stats = stats
+        self.crawler = crawler
+        self.shard = None
+        self.errors = 0
+        self.shard_errors = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("SHARD_PATH")
+        if not path:
+            raise scrapy.exceptions.NotConfigured
+        worker = crawler.settings.get("SHARD_WORKER") or "%s-%d" % (
+            socket.gethostname(), os.getpid()
+        )
+        middleware = cls(
+            checkpoint.Checkpoint(path), worker, crawler.stats, crawler
+        )
+        for handler, signal in [
+            (middleware.spider_idle, scrapy.signals.spider_idle),
+            (middleware.spider_error, scrapy.signals.spider_error),
+            (middleware.item_scraped, scrapy.signals.item_scraped),
+            (middleware.spider_closed, scrapy.signals.spider_closed),
+        ]:
+            crawler.signals.connect(handler, signal=signal)
+        return middleware
+
+    def process_spider_output(self, response, result, spider=None):
+        top = callback_level(response.request) == "parse"
+        for element in result:
+            if self._keep(element, top):
+                yield element
+        if top:
+            self.checkpoint.commit()
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        top = callback_level(response.request) == "parse"
+        async for element in result:
+            if self._keep(element, top):
+                yield element
+        if top:
+            self.checkpoint.commit()
+
+    def _keep(self, element, top):
+        if isinstance(element, scrapy.Request):
+            if not top:
+                return True
+            #
+            # The menus can list a region twice, with the query parameters
+            # the other way round.
+            #
+            self.checkpoint.add_shard(
+                canonical_url(element.url), callback_name(element),
+                element.priority
+            )
+            return False
+        if self.checkpoint.has_item(*item_key(element)):
+            self.stats.inc_value("shard/duplicate_items")
+            return False
+        return True
+
+    def error_count(self):
+        return self.errors + sum(
+            self.stats.get_value(name, 0) for name in SHARD_ERROR_STATS
+        )
+
+    def spider_idle(self, spider):
+        if self.shard is not None:
+            status = checkpoint.DONE
+            if self.error_count() > self.shard_errors:
+                status = checkpoint.FAILED
+            self.checkpoint.finish_shard(self.shard, status)
+            self.stats.inc_value("shard/%s" % status)
+            LOGGER.info("%s: shard %s: %r", self.worker, status, self.shard)
+            self.shard = None
+
+        claimed = self.checkpoint.claim_shard(self.worker)
+        if claimed is None:
+            return
+        url, name, priority = claimed
+        self.shard = url
+        self.shard_errors = self.error_count()
+        self.stats.inc_value("shard/claimed")
+        LOGGER.info("%s: claimed shard %r", self.worker, url)
+        self.crawler.engine.crawl(scrapy.Request(
+            url, callback=getattr(spider, name) if name else None,
+            priority=priority
+        ))
+        raise scrapy.exceptions.DontCloseSpider
+
+    def spider_error(self, failure, response, spider):
+        self.errors += 1
+
+    def item_scraped(self, item, spider):
+        #
+        # The feed exports connect to item_scraped before the middlewares
+        # do, so the table has been written out by now, as long as the
+        # exporter doesn't buffer it (see gosduma7.sharding.run).
+        #
+        self.checkpoint.add_item(*item_key(item))
+        self.checkpoint.commit()
+
+    def spider_closed(self, spider):
+        LOGGER.info("%s: shards: %r", self.worker, collections.Counter(
+            status for (_, _, status) in self.checkpoint.shards()
+        ))
+        self.checkpoint.close()
+
+
+class IncrementalMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous = {
+            "http://a": (
+                hashlib.md5(b"same").hexdigest(),
+                datetime.datetime(2016, 9, 19, 5, 0)
+            )
+        }
+        self.stats = mock.Mock()
+        self.middleware = IncrementalMiddleware(self.previous, self.stats)
+
+    def test_conditional_request(self):
+        request = scrapy.Request("http://a", meta={"conditional": True})
+        self.middleware.process_request(request, None)
+        self.assertEqual(
+            request.headers["If-Modified-Since"],
+            b"Mon, 19 Sep 2016 05:00:00 GMT"
+        )
+        self.assertEqual(request.meta["handle_httpstatus_list"], [304])
+
+    def test_unchanged(self):
+        for status, body, unchanged in [
+            (304, b"", True), (200, b"same", True), (200, b"changed", False)
+        ]:
+            request = scrapy.Request("http://a")
+            response = scrapy.http.HtmlResponse(
+                "http://a", status=status, body=body, request=request
+            )
+            self.middleware.process_response(request, response, None)
+            self.assertEqual(request.meta.get("unchanged", False), unchanged)
+
+
+class CheckpointMiddlewareTest(unittest.TestCase):
+
+    class Spider(object):
+
+        def parse(self, response):
+            pass
+
+        def __parse_table(self, response):
+            pass
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spider = self.Spider()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def middleware(self):
+        return CheckpointMiddleware(
+            checkpoint.Checkpoint(P.join(self.path, "crawl.sqlite")),
+            mock.Mock()
+        )
+
+    def response(self, url):
+        return scrapy.http.HtmlResponse(url, request=scrapy.Request(url))
+
+    def output(self, middleware, url, result):
+        return list(middleware.process_spider_output(
+            self.response(url), result, self.spider
+        ))
+
+    def crash(self):
+        """Fail like a callback whose assertion doesn't hold."""
+        raise AssertionError
+        yield
+
+    def test_from_crawler(self):
+        crawler = mock.Mock(settings=scrapy.settings.Settings({
+            "CHECKPOINT_PATH": P.join(self.path, "crawl.sqlite")
+        }))
+        middleware = CheckpointMiddleware.from_crawler(crawler)
+        self.assertIs(middleware.crawler, crawler)
+        middleware.spider_closed(self.spider)
+
+    def test_resume(self):
+        table = self.spider._Spider__parse_table
+        middleware = self.middleware()
+        start = list(middleware.process_start_requests(
+            [scrapy.Request("http://top/")], self.spider
+        ))
+        self.assertEqual(len(start), 1)
+
+        item = {"url": "http://top/", "md5": "1"}
+        output = self.output(middleware, "http://top/", [
+            scrapy.Request("http://a/", callback=table, priority=5),
+            scrapy.Request("http://b/", callback=table, priority=5),
+            item
+        ])
+        self.assertEqual(len(output), 3)
+        middleware.item_scraped(item, self.response("http://top/"), self.spider)
+        self.assertEqual(self.output(middleware, "http://a/", []), [])
+        with self.assertRaises(AssertionError):
+            self.output(middleware, "http://b/", self.crash())
+        middleware.spider_closed(self.spider)
+
+        middleware = self.middleware()
+        resumed = list(middleware.process_start_requests(
+            [scrapy.Request("http://top/")], self.spider
+        ))
+        self.assertEqual([r.url for r in resumed], ["http://b/"])
+        self.assertEqual(resumed[0].callback, table)
+        self.assertEqual(resumed[0].priority, 5)
+
+        output = self.output(middleware, "http://b/", [
+            scrapy.Request("http://a/"), scrapy.Request("http://c/"), item
+        ])
+        self.assertEqual([r.url for r in output], ["http://c/"])
+        middleware.spider_closed(self.spider)
+
+    def test_dupefilter(self):
+        """The same page with its query parameters in another order is one
+        request, and one the dupefilter drops is done with the other."""
+        middleware = self.middleware()
+        dupefilter = CoalescingDupeFilter()
+
+        def schedule(requests):
+            for request in requests:
+                middleware.request_scheduled(request, self.spider)
+                if dupefilter.request_seen(request):
+                    middleware.request_dropped(request, self.spider)
+
+        start = list(middleware.process_start_requests([
+            scrapy.Request("http://top/?a=1&b=2"),
+            scrapy.Request("http://top/?b=2&a=1"),
+        ], self.spider))
+        schedule(start)
+        self.assertEqual(
+            middleware.checkpoint.counts(), {checkpoint.PENDING: 1}
+        )
+        output = self.output(middleware, start[0].url, [
+            scrapy.Request("http://top/x?c=3&d=4"),
+            scrapy.Request("http://top/x?d=4&c=3"),
+        ])
+        self.assertEqual(
+            middleware.checkpoint.status("http://top/?a=1&b=2"),
+            checkpoint.DONE
+        )
+        schedule(output)
+        self.assertEqual(
+            middleware.checkpoint.status("http://top/x?c=3&d=4"),
+            checkpoint.PENDING
+        )
+        self.output(middleware, output[0].url, [])
+        self.assertEqual(middleware.checkpoint.counts(), {checkpoint.DONE: 2})
+        middleware.spider_closed(self.spider)
+
+    def test_crawl(self):
+        """A complete crawl should leave nothing outstanding, even when the
+        links to a page differ."""
+        import subprocess
+        import sys
+
+        from gosduma7 import mockserver
+
+        server = mockserver.MockServer(
+            regions=3, oiks=2, tiks=3, uiks=5, duplicates=True
+        )
+        path = P.join(self.path, "crawl.sqlite")
+        with server:
+            subprocess.check_call([
+                sys.executable, "-m", "scrapy", "runspider",
+                P.join("gosduma7", "spiders", "myspider.py"),
+                "-o", P.join(self.path, "results.json") + ":lines",
+                "-s", "LOG_LEVEL=ERROR",
+                "-s", "IZBIRKOM_TOP_URL=" + server.top_url,
+                "-s", "CHECKPOINT_PATH=" + path,
+            ], cwd=P.dirname(P.dirname(P.abspath(__file__))))
+        counts = checkpoint.Checkpoint(path).counts()
+        self.assertEqual(list(counts), [checkpoint.DONE])
+
+    def test_pipeline(self):
+        """Pages should wait for their tables to get out of the pipeline."""
+        middleware = self.middleware()
+        list(middleware.process_start_requests([
+            scrapy.Request("http://a/"), scrapy.Request("http://b/"),
+            scrapy.Request("http://c/"), scrapy.Request("http://d/")
+        ], self.spider))
+        items = {
+            url: {"url": url, "md5": "1"}
+            for url in ["http://a/", "http://b/", "http://c/"]
+        }
+        for url, item in items.items():
+            self.assertEqual(self.output(middleware, url, [item]), [item])
+            self.assertEqual(
+                middleware.checkpoint.status(url), checkpoint.PENDING
+            )
+
+        middleware.item_scraped(
+            items["http://a/"], self.response("http://a/"), self.spider
+        )
+        middleware.item_dropped(
+            items["http://b/"], self.response("http://b/"), self.spider
+        )
+        middleware.item_error(
+            items["http://c/"], self.response("http://c/"), self.spider
+        )
+        self.assertEqual(
+            middleware.checkpoint.status("http://a/"), checkpoint.DONE
+        )
+        self.assertEqual(
+            middleware.checkpoint.status("http://b/"), checkpoint.DONE
+        )
+        self.assertEqual(
+            middleware.checkpoint.status("http://c/"), checkpoint.FAILED
+        )
+
+        def page():
+            """Yield a table that fails in the pipeline straight away."""
+            item = {"url": "http://d/", "md5": "1"}
+            yield item
+            middleware.item_error(
+                item, self.response("http://d/"), self.spider
+            )
+            yield scrapy.Request("http://e/")
+
+        self.assertEqual(len(self.output(middleware, "http://d/", page())), 2)
+        self.assertEqual(
+            middleware.checkpoint.status("http://d/"), checkpoint.FAILED
+        )
+        middleware.spider_closed(self.spider)
+
+
+class ShardMiddlewareTest(unittest.TestCase):
+
+    class Spider(object):
+
+        def parse(self, response):
+            pass
+
+        def __parse_level1(self, response):
+            pass
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spider = self.Spider()
+        self.stats = scrapy.statscollectors.MemoryStatsCollector(mock.Mock())
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def middleware(self, worker):
+        return ShardMiddleware(
+            checkpoint.Checkpoint(P.join(self.path, "shards.sqlite")),
+            worker, self.stats, mock.Mock()
+        )
+
+    def output(self, middleware, request, result):
+        response = scrapy.http.HtmlResponse(request.url, request=request)
+        return list(
+            middleware.process_spider_output(response, result, self.spider)
+        )
+
+    def claim(self, middleware):
+        """Go idle, and return the url of the shard claimed, if any."""
+        try:
+            middleware.spider_idle(self.spider)
+        except scrapy.exceptions.DontCloseSpider:
+            (request,), _ = middleware.crawler.engine.crawl.call_args
+            self.assertEqual(
+                request.callback, self.spider._Spider__parse_level1
+            )
+            return request.url
+        return None
+
+    def test_shards(self):
+        level1 = self.spider._Spider__parse_level1
+        workers = [self.middleware("w1"), self.middleware("w2")]
+        for middleware in workers:
+            self.assertEqual(self.output(
+                middleware, scrapy.Request("http://top/"), [
+                    scrapy.Request("http://top/a", callback=level1),
+                    scrapy.Request("http://top/b", callback=level1),
+                ]
+            ), [])
+        self.assertEqual(self.claim(workers[0]), "http://top/a")
+        self.assertEqual(self.claim(workers[1]), "http://top/b")
+
+        item = {"url": "http://top/a/table", "md5": "1"}
+        request = scrapy.Request("http://top/a", callback=level1)
+        self.assertEqual(len(self.output(workers[0], request, [
+            scrapy.Request("http://top/a/table"), item
+        ])), 2)
+        workers[0].item_scraped(item, self.spider)
+        self.assertEqual(self.output(workers[1], request, [item]), [])
+
+        workers[1].spider_error(None, None, self.spider)
+        self.assertIsNone(self.claim(workers[0]))
+        self.assertIsNone(self.claim(workers[1]))
+        self.assertEqual(workers[0].checkpoint.shards(), [
+            ("http://top/a", "w1", checkpoint.DONE),
+            ("http://top/b", "w2", checkpoint.FAILED),
+        ])
+        for middleware in workers:
+            middleware.spider_closed(self.spider)
+
+
+class AdaptiveConcurrencyMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        crawler = mock.Mock()
+        crawler.settings = scrapy.settings.Settings({
+            "ADAPTIVE_MAX_CONCURRENCY": 6, "ADAPTIVE_TARGET_LATENCY": 1.0
+        })
+        crawler.engine.downloader.slots = {}
+        crawler.engine.downloader.per_slot_settings = {}
+        self.slots = crawler.engine.downloader.slots
+        self.middleware = AdaptiveConcurrencyMiddleware(crawler)
+
+    def request(self, callback=None):
+        request = scrapy.Request("http://a/b", callback=callback)
+        result = defer.ensureDeferred(
+            self.middleware.process_request(request, None)
+        )
+        return request, result
+
+    def fetch(self, callback, status=200, latency=0.1):
+        request, _ = self.request(callback)
+        slot = self.slots.setdefault(
+            request.meta["download_slot"], mock.Mock(concurrency=8, delay=0)
+        )
+        request.meta["download_latency"] = latency
+        response = scrapy.http.HtmlResponse(
+            request.url, status=status, request=request
+        )
+        self.middleware.process_response(request, response, None)
+        return slot
+
+    def test_slot_per_level(self):
+        class Spider(object):
+            def __parse_level1(self, response):
+                pass
+
+        spider = Spider()
+        self.fetch(spider._Spider__parse_level1)
+        self.fetch(None)
+        self.assertEqual(sorted(self.slots), ["a/parse", "a/parse_level1"])
+
+    def test_speed_up_and_back_off(self):
+        for _ in range(20):
+            slot = self.fetch(None)
+        self.assertEqual(slot.concurrency, 6)
+
+        slot = self.fetch(None, status=503)
+        self.assertEqual(slot.concurrency, 3)
+
+        for _ in range(20):
+            slot = self.fetch(None, latency=5.0)
+        self.assertEqual(slot.concurrency, 1)
+
+        slot = self.fetch(None, status=503)
+        self.assertEqual((slot.concurrency, slot.delay), (1, 0.25))
+
+    def test_budget(self):
+        for _ in range(20):
+            self.fetch(None)
+            slot = self.fetch(mock.Mock(__name__="parse_level1"))
+        self.assertEqual(
+            slot.concurrency + self.slots["a/parse"].concurrency, 6
+        )
+
+    def test_new_slot(self):
+        """The downloader should create the slot of a level with the
+        level's concurrency."""
+        self.request()
+        self.assertEqual(
+            self.middleware.crawler.engine.downloader.per_slot_settings,
+            {"a/parse": {"concurrency": 2, "delay": 0.0}}
+        )
+
+    @mock.patch("scrapy.utils.defer.maybe_deferred_to_future", lambda d: d)
+    def test_wait(self):
+        callbacks = [mock.Mock(__name__="parse_level%d" % i) for i in range(5)]
+        requests = [self.request(callback) for callback in callbacks * 2]
+        waiting = [
+            request for (request, result) in requests if not result.called
+        ]
+        #
+        # The levels get 2, 2, 2, 1 and 1, and the budget lets through 6.
+        #
+        self.assertEqual(len(self.middleware.in_flight), 6)
+        self.assertEqual(len(waiting), 4)
+
+        self.middleware.request_left_downloader(requests[0][0], None)
+        self.assertEqual(len(self.middleware.in_flight), 6)
+        self.assertEqual(
+            [result.called for (_, result) in requests[6:]],
+            [True, False, False, False]
+        )
+
+        for request, _ in requests:
+            self.middleware.request_left_downloader(request, None)
+        self.assertEqual(len(self.middleware.in_flight), 0)
+        self.assertTrue(all(result.called for (_, result) in requests))
+
+    def test_server_budget(self):
+        """The server should never see more than the budget in flight."""
+        import subprocess
+        import sys
+
+        from gosduma7 import mockserver
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        server = mockserver.MockServer(
+            latency=0.2, regions=3, oiks=2, tiks=3, uiks=5
+        )
+        with server:
+            subprocess.check_call([
+                sys.executable, "-m", "scrapy", "runspider",
+                P.join("gosduma7", "spiders", "myspider.py"),
+                "-o", P.join(path, "results.json") + ":lines",
+                "-s", "LOG_LEVEL=ERROR",
+                "-s", "IZBIRKOM_TOP_URL=" + server.top_url,
+                "-s", "ADAPTIVE_MAX_CONCURRENCY=4",
+            ], cwd=P.dirname(P.dirname(P.abspath(__file__))))
+        self.assertLessEqual(server.peak_in_flight, 4)
+        self.assertGreater(server.peak_in_flight, 1)
+
+
+class CoalescingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = mock.Mock()
+        self.middleware = CoalescingMiddleware(self.stats, cache_size=1)
+
+    def table(self, response):
+        pass
+
+    def uik_table(self, response):
+        pass
+
+    def request(self, url, callback=None):
+        result = defer.ensureDeferred(self.middleware.process_request(
+            scrapy.Request(url, callback=callback or self.table), None
+        ))
+        return result.result if result.called else result
+
+    def respond(self, url, status=200):
+        request = scrapy.Request(url, meta={"coalesce_keys": [
+            canonical_url(url)
+        ]})
+        response = scrapy.http.HtmlResponse(
+            url, status=status, body=b"<html/>", request=request
+        )
+        return self.middleware.process_response(request, response, None)
+
+    def saved(self):
+        return [
+            c.args[0] for c in self.stats.inc_value.call_args_list
+            if c.args[0] != "coalesce/saved"
+        ]
+
+    def test_canonical_url(self):
+        self.assertEqual(
+            canonical_url("http://a/b?vrn=1&global=1&region=77"),
+            canonical_url("http://a/b?region=77&global=1&vrn=1")
+        )
+
+    @mock.patch("scrapy.utils.defer.maybe_deferred_to_future", lambda d: d)
+    def test_coalesce(self):
+        self.assertIsNone(self.request("http://a/b?x=1&y=2"))
+        waiting = self.request("http://a/b?y=2&x=1")
+        self.assertFalse(waiting.called)
+
+        self.respond("http://a/b?x=1&y=2")
+        self.assertEqual(waiting.result.url, "http://a/b?y=2&x=1")
+        self.assertIn("coalesced", waiting.result.flags)
+
+        served = self.request("http://a/b?x=1&y=2", self.uik_table)
+        self.assertEqual(served.request.callback, self.uik_table)
+        self.assertEqual(self.saved(), ["coalesce/joined", "coalesce/cached"])
+
+        self.assertIsNone(self.request("http://a/c"))
+        self.respond("http://a/c")
+        self.assertIsNone(self.request("http://a/b?x=1&y=2"))
+
+    @mock.patch("scrapy.utils.defer.maybe_deferred_to_future", lambda d: d)
+    def test_failure(self):
+        self.assertIsNone(self.request("http://a/b"))
+        waiting = self.request("http://a/b")
+        self.respond("http://a/b", status=503)
+        self.assertIsNone(waiting.result)
+        self.assertEqual(self.saved(), [])
+
+    def test_dupefilter(self):
+        dupefilter = CoalescingDupeFilter()
+        self.assertFalse(dupefilter.request_seen(
+            scrapy.Request("http://a/b?x=1&y=2", callback=self.table)
+        ))
+        self.assertTrue(dupefilter.request_seen(
+            scrapy.Request("http://a/b?y=2&x=1", callback=self.table)
+        ))
+        self.assertFalse(dupefilter.request_seen(
+            scrapy.Request("http://a/b?y=2&x=1", callback=self.uik_table)
+        ))
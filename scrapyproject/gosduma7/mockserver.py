@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for vybory.izbirkom.ru, for testing the crawl offline.
+
+Serves a synthetic hierarchy of regions, OIKs, TIKs and UIKs, with the
+table pages built from the test pages in gosduma7/spiders.  The fan-out of
+each level, the latency and the proportion of failing requests are
+configurable:
+
+    python -m gosduma7.mockserver --port 8000 --regions 5 --latency 0.05
+    scrapy runspider gosduma7/spiders/myspider.py -o results.json:lines \\
+        -s IZBIRKOM_TOP_URL=http://127.0.0.1:8000/region/izbirkom
+
+All the pages of a kind have the same names and numbers: only the links
+differ.
+"""
+import argparse
+import copy
+import http.server
+import itertools
+import logging
+import os.path as P
+import random
+import threading
+import time
+import unittest
+import urllib.parse
+import urllib.request
+
+from lxml import etree
+
+from gosduma7 import parsing
+
+LOGGER = logging.getLogger(__name__)
+
+ENCODING = "windows-1251"
+"""The encoding of the pages, as on the real site."""
+
+TEMPLATES = {
+    "federal": "test_parse.html",
+    "single": "test_parse_single.html",
+    "turnout": "test_parse_turnout.html",
+    "federal_tik": "test_parse_tik.html",
+    "turnout_tik": "test_parse_tik.html",
+    "federal_uik": "test_parse_federal_uik.html",
+    "turnout_uik": "test_parse_turnout_uik.html",
+}
+"""The test page that each kind of table page is made from."""
+
+TEMPLATE_DIR = P.join(P.dirname(P.abspath(__file__)), "spiders")
+"""Where the test pages are."""
+
+FIRST_TURNOUT_ROW = 3
+"""The first row of a turnout table that holds a TIK or UIK, after the two
+rows of headers and the row of totals."""
+
+ID = "@ID@"
+"""Stands in for the id of the page in the links of the rendered pages."""
+
+TABLE_LINKS = [
+    ("federal", "Сводная таблица предварительных итогов голосования по "
+                "федеральному избирательному округу"),
+    ("single", "Сводная таблица результатов выборов по одномандатному "
+               "избирательному округу"),
+    ("turnout", "Предварительные сведения об участии избирателей в выборах"),
+]
+"""The links to the tables on an OIK page.  The spider picks them out by
+their text."""
+
+
+def load_template(filename):
+    """Parse a test page into an lxml tree."""
+    parser = etree.HTMLParser(encoding="utf-8")
+    with open(P.join(TEMPLATE_DIR, filename), "rb") as fin:
+        return etree.fromstring(fin.read(), parser)
+
+
+def resize(elements, count):
+    """Make it so that there are count of the sibling elements: remove the
+    extra ones, or append copies of them, cycling through them."""
+    for element in elements[count:]:
+        element.getparent().remove(element)
+    for element in itertools.islice(
+            itertools.cycle(elements), max(count - len(elements), 0)):
+        element.getparent().append(copy.deepcopy(element))
+
+
+def resize_columns(root, data_type, count):
+    """Make a federal or single table have count columns, i.e. TIKs or
+    UIKs."""
+    table = parsing.COMPILED_XPATHS[data_type]["cell_table"](root)[0]
+    for tr in table.iterchildren("tr"):
+        resize(list(tr.iterchildren("td")), count)
+
+
+def resize_rows(root, data_type, count):
+    """Make a turnout table have count rows of TIKs or UIKs."""
+    rows = [
+        td.getparent()
+        for td in parsing.COMPILED_XPATHS[data_type]["row_header"](root)
+    ]
+    resize(rows[FIRST_TURNOUT_ROW:], count)
+
+
+def set_link(anchor, href, text=None):
+    anchor.set("href", href)
+    if text is not None:
+        for child in list(anchor):
+            anchor.remove(child)
+        anchor.text = text
+
+
+def menu_page(title, links):
+    """Return a page with a drop-down menu of links, like the top page and
+    the region pages."""
+    html = etree.Element("html")
+    body = etree.SubElement(html, "body")
+    etree.SubElement(body, "h1").text = title
+    select = etree.SubElement(body, "select")
+    for href, text in links:
+        option = etree.SubElement(select, "option", value=href)
+        option.text = text
+    return html
+
+
+def links_page(title, links):
+    """Return a page with a list of hyperlinks, like the OIK pages."""
+    html = etree.Element("html")
+    body = etree.SubElement(html, "body")
+    etree.SubElement(body, "h1").text = title
+    for href, text in links:
+        anchor = etree.SubElement(etree.SubElement(body, "p"), "a")
+        set_link(anchor, href, text)
+    return html
+
+
+class MockSite(object):
+    """Renders the pages of the synthetic hierarchy.
+
+    Pages are addressed by kind and id.  The id is the path to the page in
+    the hierarchy, e.g. "3.1.5" for the fifth TIK of the first OIK of the
+    third region.  Each kind of page is rendered once, with a placeholder
+    for the id in the links, so serving a page is cheap.  With duplicates,
+    the menus list each link a second time, with the query parameters the
+    other way round, as the real site does."""
+
+    def __init__(self, base_url, regions=3, oiks=2, tiks=9, uiks=34,
+                 duplicates=False):
+        self.base_url = base_url
+        self.duplicates = duplicates
+        self.regions = regions
+        self.oiks = oiks
+        self.tiks = tiks
+        self.uiks = uiks
+        self.pages = {
+            kind: etree.tostring(root, method="html", encoding=ENCODING)
+            for (kind, root) in self._render().items()
+        }
+
+    @property
+    def top_url(self):
+        return self.url("top")
+
+    def url(self, kind, id_=None, reverse=False):
+        query = [("page", kind)]
+        if id_ is not None:
+            query.append(("id", id_))
+        if reverse:
+            query.reverse()
+        return "%s/region/izbirkom?%s" % (
+            self.base_url, urllib.parse.urlencode(query, safe="@")
+        )
+
+    def _render(self):
+        orders = [False, True] if self.duplicates else [False]
+        pages = {
+            "top": menu_page("Выборы", [
+                (self.url("region", str(r), reverse), "Регион №%d" % r)
+                for reverse in orders for r in range(self.regions)
+            ]),
+            "region": menu_page("Регион", [
+                (self.url("oik", "%s.%d" % (ID, o), reverse), "ОИК №%d" % o)
+                for reverse in orders for o in range(self.oiks)
+            ]),
+            "oik": links_page("ОИК", [
+                (self.url(kind, ID), text) for (kind, text) in TABLE_LINKS
+            ]),
+        }
+        for kind, filename in TEMPLATES.items():
+            pages[kind] = load_template(filename)
+
+        resize_columns(pages["federal"], "federal", self.tiks)
+        resize_columns(pages["single"], "single", self.tiks)
+        resize_rows(pages["turnout"], "turnout", self.tiks)
+        resize_columns(pages["federal_uik"], "federal_uik", self.uiks)
+        resize_rows(pages["turnout_uik"], "turnout_uik", self.uiks)
+
+        for kind, xpath in [
+            ("federal", parsing.TIK_XPATH),
+            ("turnout", parsing.TURNOUT_TIK_XPATH),
+        ]:
+            anchors = pages[kind].xpath(xpath)
+            for t, anchor in enumerate(anchors):
+                set_link(
+                    anchor, self.url(kind + "_tik", "%s.%d" % (ID, t)),
+                    "ТИК №%d" % t
+                )
+        for kind in ["federal", "turnout"]:
+            anchor = pages[kind + "_tik"].xpath(parsing.UIK_XPATH)[0]
+            set_link(anchor, self.url(kind + "_uik", ID))
+        return pages
+
+    def page(self, kind, id_):
+        """Return the body of the page, or None if there's no such page."""
+        if kind not in self.pages:
+            return None
+        return self.pages[kind].replace(
+            ID.encode("ascii"), (id_ or "").encode("ascii")
+        )
+
+    def expected_counts(self):
+        """Return the number of tables of each data_type in a full crawl,
+        for PROGRESS_EXPECTED_COUNTS."""
+        num_oiks = self.regions * self.oiks
+        return {
+            "federal": num_oiks, "single": num_oiks, "turnout": num_oiks,
+            "federal_uik": num_oiks * self.tiks,
+            "turnout_uik": num_oiks * self.tiks,
+        }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    #
+    # Keep the connections alive between requests, as the real site does.
+    #
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        kind = query.get("page", ["top"])[0]
+        id_ = query.get("id", [None])[0]
+
+        with server.lock:
+            latency = server.rng.uniform(
+                server.latency * (1 - server.jitter),
+                server.latency * (1 + server.jitter)
+            )
+            fail = server.rng.random() < server.error_rate
+            server.counts[kind] = server.counts.get(kind, 0) + 1
+            server.first_request = server.first_request or time.time()
+            server.in_flight += 1
+            server.peak_in_flight = max(
+                server.peak_in_flight, server.in_flight
+            )
+        time.sleep(latency)
+        #
+        # Stop counting the request before answering it, or the client may
+        # send the next one before we do.
+        #
+        with server.lock:
+            server.in_flight -= 1
+
+        body = server.site.page(kind, id_)
+        if fail:
+            self.send_error(503)
+        elif body is None:
+            self.send_error(404)
+        else:
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/html; charset=%s" % ENCODING
+            )
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        server.last_request = time.time()
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    """Serves a MockSite.  Each request takes latency seconds, give or take
+    jitter (a fraction of the latency), and fails with 503 Service
+    Unavailable with probability error_rate.  counts holds the number of
+    requests for each kind of page, first_request and last_request the
+    times of the first and last ones, connections the number of
+    connections that the clients opened, and peak_in_flight the most
+    requests that were being answered at once.
+
+    Use as a context manager to serve in a background thread."""
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.5,
+                 error_rate=0.0, seed=0, **fan_out):
+        http.server.ThreadingHTTPServer.__init__(self, (host, port), Handler)
+        self.site = MockSite(
+            "http://%s:%d" % (host, self.server_address[1]), **fan_out
+        )
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.connections = 0
+        self.in_flight = self.peak_in_flight = 0
+        self.first_request = self.last_request = None
+        self.thread = None
+
+    @property
+    def top_url(self):
+        return self.site.top_url
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--regions", type=int, default=3)
+    parser.add_argument("--oiks", type=int, default=2, help="per region")
+    parser.add_argument("--tiks", type=int, default=9, help="per OIK")
+    parser.add_argument("--uiks", type=int, default=34, help="per TIK")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.5,
+        help="random variation of the latency, as a fraction of it"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0,
+        help="the proportion of requests that fail with a 503"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--duplicates", action="store_true",
+        help="list each link in the menus twice, with the query reordered"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = MockServer(
+        args.host, args.port, args.latency, args.jitter, args.error_rate,
+        args.seed, regions=args.regions, oiks=args.oiks, tiks=args.tiks,
+        uiks=args.uiks, duplicates=args.duplicates
+    )
+    LOGGER.info("serving %s", server.top_url)
+    LOGGER.info(
+        "expected tables: %r (set PROGRESS_EXPECTED_COUNTS to this)",
+        server.site.expected_counts()
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        LOGGER.info("requests served: %r", server.counts)
+
+
+class MockServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer(regions=2, oiks=1, tiks=4, uiks=50)
+
+    def fetch(self, url):
+        with urllib.request.urlopen(url) as response:
+            return response.read()
+
+    def test_hierarchy(self):
+        with self.server:
+            top = self.fetch(self.server.top_url)
+            regions = parsing.COMPILED_LINK_XPATHS["option"](
+                etree.HTML(top)
+            )
+            self.assertEqual(len(regions), 2)
+
+            federal_url = self.server.site.url("federal", "1.0")
+            federal = parsing.parse_page(
+                federal_url, self.fetch(federal_url), ENCODING, "federal"
+            )
+            self.assertEqual(len(federal["column_headers"]), 5)
+            self.assertEqual(federal["region"], "Республика Адыгея (Адыгея)")
+
+            tik_links = parsing.COMPILED_LINK_XPATHS["tik"](
+                etree.HTML(self.fetch(federal_url))
+            )
+            self.assertEqual(
+                tik_links[3], self.server.site.url("federal_tik", "1.0.3")
+            )
+
+            uik_url = self.server.site.url("turnout_uik", "1.0.3")
+            uik = parsing.parse_page(
+                uik_url, self.fetch(uik_url), ENCODING, "turnout_uik"
+            )
+            self.assertEqual(len(uik["row_headers"]), 51)
+
+    def test_errors(self):
+        self.server.error_rate = 1.0
+        with self.server:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                self.fetch(self.server.top_url)
+            self.assertEqual(context.exception.code, 503)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1164 @@
+# -*- coding: utf-8 -*-
+"""The table parsers, without scrapy.
+
+Importing this module costs little more than importing lxml, so that worker
+processes and scripts that only parse pages don't pay for scrapy.  The
+spider imports the parsers from here.
+
+It also parses saved pages in bulk, from a directory or a tarball, into
+JSON lines:
+
+    python -m gosduma7.parsing pages.tar.gz -o results.json -p 4
+
+The data_type of each page is detected from its layout, unless given with
+--data-type.
+"""
+import collections
+import datetime
+import hashlib
+import logging
+import re
+import threading
+import time
+
+STARTED = time.perf_counter()
+"""When this module started importing lxml, for the time to the first
+result."""
+
+from lxml import etree  # noqa: E402
+
+from gosduma7 import instrumentation  # noqa: E402
+
+LOGGER = logging.getLogger(__name__)
+
+
+def compile_xpaths(xpaths):
+    """Compile a (possibly nested) dictionary of xpath expressions.
+
+    Expressions are compiled once, at import time.  Templates refer to row
+    and column numbers as the $row and $col xpath variables, which are
+    passed as keyword arguments when evaluating the compiled expression."""
+    return {
+        key: compile_xpaths(value) if isinstance(value, dict)
+        else etree.XPath(value, smart_strings=False)
+        for (key, value) in xpaths.items()
+    }
+
+
+def lxml_root(root):
+    """Return the lxml element that the scrapy Selector wraps."""
+    return getattr(root, "root", root)
+
+
+def join(list_of_strings):
+    return " ".join(list_of_strings).strip()
+
+#
+# While the content and layouts for the federal and single-mandate pages are
+# approximately the same, the xpath selectors are slightly different.  The
+# parsers find the tables with detect_layout, so these only name the
+# data_type of a page (see known_data_type), and tell the mock server and
+# the benchmarks where the tables are.
+#
+XPATHS = {
+    "federal": {
+        "row_header": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[1]/table/tr/td[2]",  # noqa
+        "col_header": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[1]/td",  # noqa
+        "total_table": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[1]/table",  # noqa
+        "cell_table": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[2]/div/table",  # noqa
+        "total": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[1]/table/tr[$row]/td[3]/nobr/b/text()",  # noqa
+        "cell": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[$row]/td[$col]/nobr/b/text()"  # noqa
+    },
+    "federal_uik": {
+        "row_header": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[1]/table/tr/td[2]",  # noqa
+        "col_header": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[1]/td",  # noqa
+        "total_table": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[1]/table",  # noqa
+        "cell_table": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[2]/div/table",  # noqa
+        "total": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[1]/table/tr[$row]/td[3]/nobr/b/text()",  # noqa
+        "cell": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[$row]/td[$col]/nobr/b/text()"  # noqa
+    },
+    "single": {
+        "row_header": "/html/body/table[2]/tr[4]/td/div/table/tr/td[1]/table/tr/td[2]",  # noqa
+        "col_header": "/html/body/table[2]/tr[4]/td/div/table/tr/td[2]/div/table/tr[1]/td",  # noqa
+        "total_table": "/html/body/table[2]/tr[4]/td/div/table/tr/td[1]/table",  # noqa
+        "cell_table": "/html/body/table[2]/tr[4]/td/div/table/tr/td[2]/div/table",  # noqa
+        "total": "/html/body/table[2]/tr[4]/td/div/table/tr/td[1]/table/tr[$row]/td[3]/nobr/b/text()",  # noqa
+        "cell": "/html/body/table[2]/tr[4]/td/div/table/tr/td[2]/div/table/tr[$row]/td[$col]/nobr/b/text()",  # noqa
+    },
+    "turnout": {
+        "row_header": "/html/body/table[2]/tr[4]/td/table[4]/tr/td[2]",
+        "table": "/html/body/table[2]/tr[4]/td/table[4]",
+        "cell": "/html/body/table[2]/tr[4]/td/table[4]/tr[$row]/td[$col]//text()"  # noqa
+    },
+    "turnout_uik": {
+        "row_header": "/html/body/table[3]/tr[4]/td/table[4]/tr/td[2]",
+        "table": "/html/body/table[3]/tr[4]/td/table[4]",
+        "cell": "/html/body/table[3]/tr[4]/td/table[4]/tr[$row]/td[$col]//text()"  # noqa
+    }
+}
+
+COMPILED_XPATHS = compile_xpaths(XPATHS)
+
+#
+# The 1st row is the header.
+# The next rows are the stats.
+# The 20th row is blank.
+# The remaining rows are the candidates (parties and people in federal and
+# single-mandate elections, respectively).
+#
+# That's usually, anyway: the parsers drop the blank rows wherever they are
+# (see drop_separators).
+#
+FIRST_STAT = 1
+LAST_STAT = 19
+FIRST_CANDIDATE = 20
+
+
+def now():
+    """Return the current UTC datetime (time-zone aware)."""
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+NAME_XPATHS = {
+    "oik": {
+        "region": "/html/body/table[2]/tr[1]/td/a[2]/text()",
+        "area_ik": "/html/body/table[2]/tr[1]/td/a[3]/text()",
+        #
+        # Наименование избирательной комиссии
+        #
+        "area_ik_long":
+            "/html/body/table[2]/tr[4]/td/table[3]/tr[2]/td[2]/text()",
+    },
+    "uik": {
+        "region": "/html/body/table[3]/tr[1]/td/a[1]/text()",
+        "area_ik": "/html/body/table[3]/tr[1]/td/a[2]/text()",
+        "territory_ik": "/html/body/table[3]/tr[1]/td/a[3]/text()",
+    }
+}
+
+COMPILED_NAME_XPATHS = compile_xpaths(NAME_XPATHS)
+
+
+def get_name(root):
+    """Return the electorate region, committee number and name."""
+    root = lxml_root(root)
+    return {
+        key: join(xpath(root))
+        for (key, xpath) in COMPILED_NAME_XPATHS["oik"].items()
+    }
+
+
+def get_name_uik(root):
+    root = lxml_root(root)
+    return {
+        key: join(xpath(root))
+        for (key, xpath) in COMPILED_NAME_XPATHS["uik"].items()
+    }
+
+
+BAD_COLUMN = -1
+"""Sometimes values are just plain missing.  We can't really skip them,
+since our stuff depends on the order of rows and columns, so let's have
+a dummy value that we use to signify something went wrong."""
+#
+# noqa e.g. http://www.vybory.izbirkom.ru/region/izbirkom?action=show&global=true&root=772000043&tvd=27720001659726&vrn=100100067795849&prver=0&pronetvd=0&region=77&sub_region=77&type=453&vibid=27720001659726
+# there's a blank row at the end of the column
+#
+
+
+def is_decimal(text):
+    """Return True if the text is a decimal number, like "12" or "7.04"."""
+    whole, _, fraction = text.partition(".")
+    return whole.isdigit() and whole.isascii() and \
+        (not fraction or (fraction.isdigit() and fraction.isascii()))
+
+
+def decode_count(texts):
+    """Decode the text nodes of a cell that holds a count.
+
+    Counts come back as ints.  Returns BAD_COLUMN for blank cells and
+    anything else that isn't a number.  Cells usually hold a single text
+    node, so we avoid joining in that case, and we check the text instead of
+    catching exceptions, because blank cells are common."""
+    text = texts[0].strip() if len(texts) == 1 else join(texts)
+    if text.isdigit() and text.isascii():
+        return int(text)
+    if is_decimal(text):
+        return float(text)
+    return BAD_COLUMN
+
+
+def decode_percentage(texts):
+    """Decode the text nodes of a cell that holds a percentage, like
+    "7.04%".  Returns a float, or BAD_COLUMN."""
+    text = join(texts).rstrip("%").rstrip()
+    if is_decimal(text):
+        return float(text)
+    return BAD_COLUMN
+
+
+def child_elements(element, tag):
+    """Return the children of the lxml element that have the specified tag."""
+    return list(element.iterchildren(tag))
+
+
+def text_nodes(element, path=("nobr", "b")):
+    """Return the text nodes matched by the relative xpath path/text().
+
+    Equivalent to element.xpath("nobr/b/text()") for the default path, but
+    without compiling and evaluating an xpath expression for each cell."""
+    elements = [element]
+    for tag in path:
+        elements = [
+            child
+            for parent in elements
+            for child in child_elements(parent, tag)
+        ]
+
+    texts = []
+    for element in elements:
+        if element.text:
+            texts.append(element.text)
+        texts.extend(child.tail for child in element if child.tail)
+    return texts
+
+
+_CELL_XPATHS = {}
+
+
+def cell_xpath(path, row=False):
+    """Return a compiled xpath that walks the rows, cells and text nodes of
+    a table in document order.
+
+    path is as for text_nodes, or None for all the text nodes in a cell.
+    Text nodes come back as plain strings, and follow the td element that
+    contains them, which in turn follows its tr element, so a single
+    evaluation gives us the whole table, blank cells included.  If row is
+    True, the xpath walks the cells of a single row instead."""
+    try:
+        return _CELL_XPATHS[path, row]
+    except KeyError:
+        text = "//text()" if path is None else \
+            "".join("/" + tag for tag in path) + "/text()"
+        expression = "td | td%s" if row else "tr | tr/td | tr/td%s"
+        xpath = _CELL_XPATHS[path, row] = etree.XPath(
+            expression % text, smart_strings=False
+        )
+        return xpath
+
+
+def extract_cells(tables, row_numbers, column_numbers, path=("nobr", "b"),
+                  decode=join):
+    """Extract the text of a rectangular region of a table in a single pass.
+
+    tables is the result of an xpath query that locates the table.
+    row_numbers and column_numbers are zero-based indices of the tr and td
+    elements to extract.  decode turns the list of text nodes of each cell
+    (see cell_xpath) into a value.  Returns a list of rows, each a list of
+    values.  Missing rows and cells are decoded from no text nodes at all,
+    just like an xpath query that matches nothing."""
+    #
+    # Walking the tree from Python means creating a proxy object for every
+    # element we pass, which costs more than decoding the cells.  Instead,
+    # let libxml2 walk the table, and only create proxies for tr and td.
+    #
+    rows = []
+    if tables:
+        row = cell = None
+        for node in cell_xpath(path)(tables[0]):
+            if node.__class__ is str:
+                cell.append(node)
+            elif node.tag == "td":
+                cell = []
+                row.append(cell)
+            else:
+                row = []
+                rows.append(row)
+
+    matrix = []
+    for row_number in row_numbers:
+        row = rows[row_number] if row_number < len(rows) else []
+        matrix.append(
+            [
+                decode(row[col_number] if col_number < len(row) else [])
+                for col_number in column_numbers
+            ]
+        )
+    return matrix
+
+
+StreamedTable = collections.namedtuple(
+    "StreamedTable", "xpath columns path decode"
+)
+"""A data table for parse_tree to decode as it goes.  xpath locates the
+table, columns are the zero-based indices of the cells to decode in each
+row (None for as many as the first row has), and path and decode are as for
+extract_cells."""
+
+
+PARSE_CHUNK_SIZE = 1 << 16
+"""How many bytes of the page parse_tree feeds to the parser at a time."""
+
+STREAM_THRESHOLD = 1 << 18
+"""Pages smaller than this many bytes get parsed whole by parse_tree.
+Decoding the rows one by one as they stream in costs more Python calls
+than a single xpath over each table, which only pays off on the big pages
+(see `python -m gosduma7.benchmark tree`)."""
+
+_PULL_PARSERS = threading.local()
+_HTML_PARSERS = threading.local()
+
+
+def pull_parser(encoding):
+    """Return this thread's parser for pages in the encoding.
+
+    Creating a parser costs about as much as parsing a small page, so we
+    keep one for each encoding, and reuse it."""
+    parsers = _PULL_PARSERS.__dict__
+    try:
+        return parsers[encoding]
+    except KeyError:
+        parser = parsers[encoding] = etree.HTMLPullParser(
+            events=("end",), tag=("tr", "head", "script", "style"),
+            encoding=encoding
+        )
+        return parser
+
+
+def html_parser(encoding):
+    """Return this thread's parser for whole pages in the encoding."""
+    parsers = _HTML_PARSERS.__dict__
+    try:
+        return parsers[encoding]
+    except KeyError:
+        parser = parsers[encoding] = etree.HTMLParser(encoding=encoding)
+        return parser
+
+
+def parse_tree(body, encoding, tables):
+    """Parse the page, decoding the data tables row by row as we go.
+
+    Rather than decode the whole page to unicode and build the complete
+    tree before querying it, we feed the body bytes to libxml2 a chunk at a
+    time, and handle the rows as their end tags get parsed.  We decode the
+    cells of each row of a data table (other than the first, which holds
+    the column headers), and drop them from the tree, along with the
+    contents of the scripts and the head.  The rows themselves and the cells
+    before the first decoded one (numbers, row headers and their links)
+    stay, so the xpath queries for the breadcrumbs and headers work on the
+    pruned tree the same as on the full one.
+
+    Pages under STREAM_THRESHOLD bytes are quicker to parse whole, and
+    their trees don't get pruned.
+
+    Returns the root of the pruned tree, and for each of the tables, a
+    dictionary of decoded rows keyed by the zero-based row number, or None
+    if the page doesn't have the table."""
+    if len(body) < STREAM_THRESHOLD:
+        return parse_whole(body, encoding, tables)
+    decoded = [None] * len(tables)
+    found = {}
+    parser = pull_parser(encoding)
+    try:
+        for start in range(0, len(body), PARSE_CHUNK_SIZE):
+            parser.feed(body[start:start + PARSE_CHUNK_SIZE])
+            for _, element in parser.read_events():
+                prune(element, tables, found, decoded)
+    finally:
+        root = parser.close()
+    for _, element in parser.read_events():
+        prune(element, tables, found, decoded)
+    if root is None:
+        raise ValueError("empty page")
+    return root, decoded
+
+
+def parse_whole(body, encoding, tables):
+    """parse_tree for small pages: build the whole tree, then decode each
+    table in a single xpath evaluation, like extract_cells."""
+    root = etree.fromstring(body, html_parser(encoding))
+    if root is None:
+        raise ValueError("empty page")
+    decoded = [None] * len(tables)
+    for index, spec in enumerate(tables):
+        for table in spec.xpath(root):
+            rows = []
+            for node in cell_xpath(spec.path)(table):
+                if node.__class__ is str:
+                    rows[-1][-1].append(node)
+                elif node.tag == "td":
+                    rows[-1].append([])
+                else:
+                    rows.append([])
+            if not rows:
+                continue
+            if decoded[index] is None:
+                decoded[index] = {}
+            columns = range(len(rows[0])) if spec.columns is None \
+                else spec.columns
+            for row_number in range(1, len(rows)):
+                cells = rows[row_number]
+                decoded[index][row_number] = [
+                    spec.decode(cells[column] if column < len(cells) else [])
+                    for column in columns
+                ]
+    return root, decoded
+
+
+def prune(element, tables, found, decoded):
+    """Handle the end of an element for parse_tree."""
+    if element.tag != "tr":
+        element.clear(keep_tail=True)
+        return
+
+    parent = element.getparent()
+    try:
+        table = found[parent]
+    except KeyError:
+        table = found[parent] = find_table(parent, tables)
+        if table is not None and decoded[table[0]] is None:
+            decoded[table[0]] = {}
+    if table is None:
+        return
+    index, widths = table
+    spec = tables[index]
+    row_number = len(widths)
+    if not row_number:
+        widths.append(len(child_elements(element, "td")))
+        return
+
+    cells = []
+    tds = []
+    for node in cell_xpath(spec.path, row=True)(element):
+        if node.__class__ is str:
+            cells[-1].append(node)
+        else:
+            cells.append([])
+            tds.append(node)
+    widths.append(len(tds))
+    columns = range(widths[0]) if spec.columns is None else spec.columns
+    decoded[index][row_number] = [
+        spec.decode(cells[column] if column < len(cells) else [])
+        for column in columns
+    ]
+
+    first = min(columns, default=len(tds))
+    if first:
+        for td in tds[first:]:
+            element.remove(td)
+    else:
+        element.clear(keep_tail=True)
+
+
+def page_root(response):
+    """Return the root of the page, with nothing but the scripts and the
+    head pruned, if anything (see parse_tree).  Cheaper than the Selector,
+    for following links."""
+    return parse_tree(response.body, response.encoding, [])[0]
+
+
+def find_table(element, tables):
+    """Return the index of the StreamedTable that the element is, and a
+    list for the widths of its rows, or None if it isn't one of them."""
+    root = element.getroottree().getroot()
+    for index, table in enumerate(tables):
+        if element in table.xpath(root):
+            return index, []
+    return None
+
+
+def decoded_rows(rows, row_numbers, num_columns):
+    """Return the rows that parse_tree decoded, in the order of row_numbers.
+    Missing rows (and tables) come back as BAD_COLUMN values, like missing
+    cells."""
+    rows = rows or {}
+    return [
+        list(rows.get(row_number, [BAD_COLUMN] * num_columns))
+        for row_number in row_numbers
+    ]
+
+
+Layout = collections.namedtuple(
+    "Layout", "kind tables header_column first_row column_headers data_type"
+)
+"""Where the data is on the pages made from a template, as detect_layout
+found it.
+
+kind is "summary" for the federal and single-mandate tables, which keep the
+row headers and totals in one table and the cells in another, the first
+and second of tables, or "turnout", which keeps everything in one.
+header_column is the index of the cell that holds the row header in each
+row of the first table, and first_row that of the first row with data.
+column_headers are the headers of the columns of the first table that get
+decoded (the headers of the cells of a summary table differ from page to
+page).  data_type is the one in XPATHS that the template is, or None."""
+
+LAYOUT_CACHE_SIZE = 32
+"""How many page templates parse_layout remembers the layouts of."""
+
+LAYOUTS = {}
+"""The Layout of each page template by signature, or None for templates
+without data tables, oldest first."""
+
+_LAYOUT_TABLES = []
+"""The tables of all the LAYOUTS, for parse_layout to decode."""
+
+_TABLE_XPATHS = {}
+
+TIME_REGEX = re.compile(r"^(\d{1,2})\.(\d\d)$")
+"""A time of day in a column header, like "10.00"."""
+
+
+def signature(root):
+    """Return the structural signature of the page: the path to each table.
+
+    Pages made from the same template have the same tables in the same
+    places, however many rows and columns they hold.  parse_tree leaves the
+    tables alone, so a pruned tree has the same signature as the page."""
+    tree = root.getroottree()
+    return tuple(tree.getpath(table) for table in root.iter("table"))
+
+
+def table_xpath(path):
+    """Return the compiled xpath for the absolute path to a table.  Layouts
+    share them, so that their StreamedTables compare equal."""
+    try:
+        return _TABLE_XPATHS[path]
+    except KeyError:
+        xpath = _TABLE_XPATHS[path] = etree.XPath(path, smart_strings=False)
+        return xpath
+
+
+def leaf_tables(root):
+    """Yield the tables that have no tables inside them."""
+    for table in root.iter("table"):
+        if next(table.iterdescendants("table"), None) is None:
+            yield table
+
+
+def grid(row):
+    """Return the td elements of the row, with the column that each starts
+    at and the number of columns it spans."""
+    cells = []
+    start = 0
+    for td in child_elements(row, "td"):
+        span = td.get("colspan", "1")
+        span = int(span) if span.isdigit() and span.isascii() else 1
+        cells.append((td, start, span))
+        start += max(span, 1)
+    return cells
+
+
+def column_header(header_rows, column):
+    """Return the text of the cell that heads the column (by its position
+    in the grid) alone, in the header row closest to the data."""
+    for row in reversed(header_rows):
+        for td, start, span in grid(row):
+            if start == column and span == 1:
+                return join(td.itertext())
+    return ""
+
+
+def header_column(row, first_value):
+    """Return the index of the last cell before the first_value one that
+    holds text rather than a number, or None."""
+    for index in reversed(range(first_value)):
+        text = join(row[index].itertext())
+        if text and not is_decimal(text):
+            return index
+    return None
+
+
+def is_percentage(text):
+    return text.endswith("%") and is_decimal(text[:-1].rstrip())
+
+
+def paired_table(table, num_rows):
+    """Return the table with as many rows in a later cell of the row that
+    the table is in, or None."""
+    cell = next(table.iterancestors("td"), None)
+    if cell is None:
+        return None
+    for sibling in cell.itersiblings("td"):
+        for other in leaf_tables(sibling):
+            if len(child_elements(other, "tr")) == num_rows:
+                return other
+    return None
+
+
+def detect_summary(table):
+    """Return the Layout of a summary table with the totals in the table,
+    or None if it isn't one."""
+    rows = child_elements(table, "tr")
+    for first_row, row in enumerate(rows):
+        tds = child_elements(row, "td")
+        if tds and decode_count(text_nodes(tds[-1])) != BAD_COLUMN:
+            break
+    else:
+        return None
+    header = header_column(tds, len(tds) - 1)
+    cells = paired_table(table, len(rows))
+    if header is None or cells is None:
+        return None
+
+    tree = table.getroottree()
+    total = grid(row)[-1][1]
+    return Layout(
+        "summary",
+        (
+            StreamedTable(
+                table_xpath(tree.getpath(table)), (len(tds) - 1,),
+                ("nobr", "b"), decode_count
+            ),
+            StreamedTable(
+                table_xpath(tree.getpath(cells)), None, ("nobr", "b"),
+                decode_count
+            ),
+        ),
+        header, first_row, (column_header(rows[:first_row], total),), None
+    )
+
+
+def detect_turnout(table):
+    """Return the Layout of a turnout table, or None if it isn't one."""
+    rows = child_elements(table, "tr")
+    for first_row, row in enumerate(rows):
+        tds = child_elements(row, "td")
+        columns = tuple(
+            index for (index, td) in enumerate(tds)
+            if is_percentage(join(td.itertext()))
+        )
+        if columns:
+            break
+    else:
+        return None
+    header = header_column(tds, columns[0])
+    if header is None:
+        return None
+
+    starts = [start for (_, start, _) in grid(row)]
+    column_headers = tuple(
+        TIME_REGEX.sub(r"\1:\2", column_header(rows[:first_row], starts[i]))
+        for i in columns
+    )
+    return Layout(
+        "turnout",
+        (
+            StreamedTable(
+                table_xpath(table.getroottree().getpath(table)), columns,
+                None, decode_percentage
+            ),
+        ),
+        header, first_row, column_headers, None
+    )
+
+
+def detect_layout(root):
+    """Locate the data tables of the page, from its structure alone.
+
+    A summary table is a table whose data rows end with a count in bold,
+    after the row header, next to a table with as many rows of cells.  A
+    turnout table is one with percentages in its data rows.  If the page
+    has several, the one with the most rows wins (the federal pages also
+    have a short table of absentee ballots).  Returns the Layout, or None
+    if the page has no data tables."""
+    best = None
+    best_rows = 0
+    for table in leaf_tables(root):
+        num_rows = len(child_elements(table, "tr"))
+        if num_rows <= best_rows:
+            continue
+        layout = detect_summary(table) or detect_turnout(table)
+        if layout is not None:
+            best, best_rows = layout, num_rows
+    if best is None:
+        return None
+    return best._replace(data_type=known_data_type(best.tables))
+
+
+def known_data_type(tables):
+    """Return the data_type whose XPATHS locate the tables, or None."""
+    paths = [table.xpath.path for table in tables]
+    for data_type in DETECTION_ORDER:
+        xpaths = XPATHS[data_type]
+        if "table" in xpaths:
+            known = [xpaths["table"]]
+        else:
+            known = [xpaths["total_table"], xpaths["cell_table"]]
+        if paths == known:
+            return data_type
+    return None
+
+
+def remember_layout(key, layout):
+    """Cache the layout of the page template, forgetting the oldest if
+    there are too many."""
+    global _LAYOUT_TABLES
+    while len(LAYOUTS) >= LAYOUT_CACHE_SIZE:
+        del LAYOUTS[next(iter(LAYOUTS))]
+    LAYOUTS[key] = layout
+    _LAYOUT_TABLES = list(dict.fromkeys(
+        table for layout in LAYOUTS.values() if layout is not None
+        for table in layout.tables
+    ))
+
+
+def parse_layout(body, encoding):
+    """Parse the page, decoding the data tables of its template.
+
+    The fast path: the page gets streamed through parse_tree with the
+    tables of all the templates seen so far, and if its signature is that
+    of one of them, the tables of that one are its data.  Otherwise, the
+    whole page gets parsed, detect_layout locates its tables, and the page
+    is streamed again with those.
+
+    Returns the root of the pruned tree, the Layout (None if the page has
+    no data tables) and the decoded rows of its tables, as for parse_tree."""
+    tables = _LAYOUT_TABLES
+    root, decoded = parse_tree(body, encoding, tables)
+    key = signature(root)
+    if key in LAYOUTS:
+        layout = LAYOUTS[key]
+        if layout is None:
+            return root, None, []
+        decoded = [
+            decoded[tables.index(table)] if table in tables else None
+            for table in layout.tables
+        ]
+        if all(rows is not None for rows in decoded):
+            return root, layout, decoded
+
+    with instrumentation.phase("parse/layout", len(body)):
+        root = page_root(Page(None, body, encoding))
+        key = signature(root)
+        layout = detect_layout(root)
+        remember_layout(key, layout)
+    if layout is None:
+        LOGGER.debug("no data tables in template %r", key)
+        return root, None, []
+    LOGGER.info(
+        "new %s page template, data tables at %s", layout.kind,
+        ", ".join(table.xpath.path for table in layout.tables)
+    )
+    root, decoded = parse_tree(body, encoding, layout.tables)
+    return root, layout, decoded
+
+
+def data_rows(root, layout):
+    """Return the numbers of the rows of the layout's first table from
+    first_row on, and their row headers."""
+    table = layout.tables[0].xpath(root)[0]
+    row_numbers = []
+    row_headers = []
+    for number, row in enumerate(child_elements(table, "tr")):
+        if number < layout.first_row:
+            continue
+        tds = child_elements(row, "td")
+        row_numbers.append(number)
+        row_headers.append(
+            join(tds[layout.header_column].itertext())
+            if layout.header_column < len(tds) else ""
+        )
+    return row_numbers, row_headers
+
+
+def drop_separators(row_headers, rows):
+    """Drop the rows with neither a header nor any values, like the blank
+    row between the stats and the candidates, and any at the end."""
+    kept = [
+        (header, row) for (header, row) in zip(row_headers, rows)
+        if header or any(value != BAD_COLUMN for value in row)
+    ]
+    return [header for (header, _) in kept], [row for (_, row) in kept]
+
+
+def parse_voting_summary_table(response, data_type="federal", tree=None):
+    """Parse the voting summary table.  Works for federal and single-mandate
+    tables.  tree is what parse_layout returned for the page, if it has been
+    parsed already.  Raises ValueError if the page has no such table."""
+    meth_name = "parse_voting_summary_table"
+
+    url = response.url
+    with instrumentation.phase("parse/md5", len(response.body)):
+        md5 = hashlib.md5(response.body).hexdigest()
+
+    if tree is None:
+        # parse_tree decodes the cells as it builds the tree, so this phase
+        # covers the decoding too.  parse/rows only puts them in order.
+        with instrumentation.phase("parse/tree", len(response.body)):
+            tree = parse_layout(response.body, response.encoding)
+    root, layout, decoded = tree
+    if layout is None or layout.kind != "summary":
+        raise ValueError("no summary table in %r" % url)
+    totals, cells = decoded
+
+    with instrumentation.phase("parse/headers"):
+        if data_type.endswith("_uik"):
+            result = get_name_uik(root)
+        else:
+            result = get_name(root)
+
+        logging.debug("%s: result: %r", meth_name, result)
+
+        row_numbers, row_headers = data_rows(root, layout)
+        logging.debug("%s: row_headers: %r", meth_name, row_headers)
+
+        #
+        # parse_tree leaves the first row of the cells alone, so that's
+        # where their headers have to be.
+        #
+        header_row = child_elements(layout.tables[1].xpath(root)[0], "tr")[:1]
+        column_headers = [
+            join(td.itertext())
+            for row in header_row for td in child_elements(row, "td")
+        ]
+        logging.debug("%s: column_headers: %r", meth_name, column_headers)
+
+    with instrumentation.phase("parse/rows"):
+        totals = decoded_rows(
+            totals, row_numbers, len(layout.tables[0].columns)
+        )
+        cells = decoded_rows(cells, row_numbers, len(column_headers))
+
+        rows = []
+        for total_value, values in zip(totals, cells):
+            LOGGER.debug("%s: total_value: %r", meth_name, total_value)
+            rows.append(total_value + values)
+
+    with instrumentation.phase("parse/assembly"):
+        row_headers, rows = drop_separators(row_headers, rows)
+        column_headers = list(layout.column_headers) + column_headers
+
+        result.update(
+            {
+                "row_headers": row_headers, "column_headers": column_headers,
+                "data": rows, "data_type": data_type,
+                "timestamp": now().isoformat(), "url": url, "md5": md5
+            }
+        )
+    return result
+
+
+def parse_turnout_table(response, data_type="turnout", tree=None):
+    """Pass the voting turnout table.  tree is as for
+    parse_voting_summary_table."""
+    meth_name = "parse_turnout_table"
+
+    url = response.url
+    with instrumentation.phase("parse/md5", len(response.body)):
+        md5 = hashlib.md5(response.body).hexdigest()
+
+    if tree is None:
+        with instrumentation.phase("parse/tree", len(response.body)):
+            tree = parse_layout(response.body, response.encoding)
+    root, layout, decoded = tree
+    if layout is None or layout.kind != "turnout":
+        raise ValueError("no turnout table in %r" % url)
+    (cells,) = decoded
+
+    with instrumentation.phase("parse/headers"):
+        if data_type == "turnout_uik":
+            result = get_name_uik(root)
+        else:
+            result = get_name(root)
+
+        logging.debug("%s: result: %r", meth_name, result)
+
+        row_numbers, row_headers = data_rows(root, layout)
+        logging.debug("%s: row_headers: %r", meth_name, row_headers)
+
+    with instrumentation.phase("parse/rows"):
+        rows = decoded_rows(cells, row_numbers, len(layout.column_headers))
+
+    with instrumentation.phase("parse/assembly"):
+        row_headers, rows = drop_separators(row_headers, rows)
+        result.update(
+            {
+                "md5": md5, "url": url, "data_type": data_type,
+                "timestamp": now().isoformat(),
+                "row_headers": row_headers,
+                "column_headers": list(layout.column_headers),
+                "data": rows
+            }
+        )
+    return result
+
+
+PARSERS = {
+    "federal": parse_voting_summary_table,
+    "federal_uik": parse_voting_summary_table,
+    "single": parse_voting_summary_table,
+    "turnout": parse_turnout_table,
+    "turnout_uik": parse_turnout_table,
+}
+"""The parser for each data_type."""
+
+
+def parse_table(response, data_type):
+    """Parse the table using the appropriate parser for the data_type."""
+    return PARSERS[data_type](response, data_type=data_type)
+
+
+DETECTION_ORDER = [
+    "federal_uik", "turnout_uik", "federal", "single", "turnout"
+]
+"""The order in which known_data_type tries the data_types."""
+
+
+def parse_any(response):
+    """Parse a table page of unknown data_type.
+
+    The page gets parsed with the layout of its template, and the data_type
+    is the one whose XPATHS locate the same tables.  Raises ValueError if
+    the page has no data tables, or they aren't where any of XPATHS put
+    them (pass the data_type to parse_table for those)."""
+    with instrumentation.phase("parse/tree", len(response.body)):
+        tree = parse_layout(response.body, response.encoding)
+    layout = tree[1]
+    if layout is None or layout.data_type is None:
+        raise ValueError("no data tables found")
+    return PARSERS[layout.data_type](
+        response, data_type=layout.data_type, tree=tree
+    )
+
+
+Page = collections.namedtuple("Page", "url body encoding")
+"""The parts of a scrapy Response that the parsers use."""
+
+
+def parse_page(url, body, encoding, data_type):
+    """Parse the table from the raw page.
+
+    Unlike parse_table, this does not need a scrapy Response, so it can run
+    in another process."""
+    return parse_table(Page(url, body, encoding), data_type)
+
+
+#
+# The links that lead from the top page down to the tables, for the crawl.
+#
+TOP_URL = "http://www.vybory.izbirkom.ru/region/\
+izbirkom?action=show&global=1&vrn=100100067795849&region=0&prver=0&pronetvd=0"
+
+TURNOUT_REGEX = re.compile(
+    "Предварительные сведения об участии избирателей в выборах",
+    re.IGNORECASE | re.UNICODE
+)
+FEDERAL_RESULTS_REGEX = re.compile(
+    "Сводная таблица (предварительных )?итогов голосования \
+по федеральному избирательному округу",
+    re.IGNORECASE | re.UNICODE
+)
+SINGLE_RESULTS_REGEX = re.compile(
+    "Сводная таблица результатов выборов по \
+одномандатному избирательному округу",
+    re.IGNORECASE | re.UNICODE
+)
+
+TABLE_LINK_REGEXES = [
+    (FEDERAL_RESULTS_REGEX, "federal"),
+    (SINGLE_RESULTS_REGEX, "single"),
+    (TURNOUT_REGEX, "turnout"),
+]
+"""How to tell the links to the tables on an OIK page, by their text."""
+
+TIK_XPATH = "/html/body/table[2]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[1]/td/nobr/a"  # noqa
+"""Get the territorial electoral committee links."""
+
+UIK_XPATH = "/html/body/table[2]/tr[2]/td/a"
+"""Get the link to the UIK table from a TIK table."""
+
+TURNOUT_TIK_XPATH = "/html/body/table[2]/tr[4]/td/table[4]/tr/td[2]/a"
+"""Get the territorial electoral committee links for turnout pages."""
+
+COMPILED_LINK_XPATHS = compile_xpaths(
+    {
+        "option": "//option/@value",
+        "hyperlink": "//a",
+        "tik": TIK_XPATH + "/@href",
+        "uik": UIK_XPATH + "/@href",
+        "turnout_tik": TURNOUT_TIK_XPATH + "/@href",
+    }
+)
+"""The hyperlinks that the crawl follows."""
+
+
+def get_uik_link(selector):
+    #
+    # Для просмотра данных по участковым избирательным комиссиям перейдите
+    # на сайт избирательной комиссии субъекта Российской Федерации
+    #
+    hrefs = COMPILED_LINK_XPATHS["uik"](lxml_root(selector))
+    return hrefs[0] if hrefs else None
+
+
+def table_links(root):
+    """Yield the href and data_type of each table link on an OIK page."""
+    for hyperlink in COMPILED_LINK_XPATHS["hyperlink"](root):
+        text = join(text_nodes(hyperlink, path=()))
+        for regex, data_type in TABLE_LINK_REGEXES:
+            if regex.search(text):
+                yield hyperlink.get("href"), data_type
+
+
+HTML_SUFFIXES = (".html", ".htm", ".html.gz", ".htm.gz")
+"""The files that iter_saved_pages picks out."""
+
+CHARSET_REGEX = re.compile(
+    rb"""<meta[^>]+charset=["']?([-\w]+)""", re.IGNORECASE
+)
+
+
+def sniff_encoding(body):
+    """Guess the encoding of a saved page: the one that its meta tags
+    declare, or else UTF-8 if it decodes as such, or else windows-1251, like
+    the live site."""
+    match = CHARSET_REGEX.search(body, 0, 4096)
+    if match:
+        return match.group(1).decode("ascii")
+    try:
+        body.decode("utf-8")
+    except UnicodeDecodeError:
+        return "windows-1251"
+    return "utf-8"
+
+
+def iter_saved_pages(path):
+    """Yield the name, body and modification time of each HTML page in the
+    directory or tarball, in order.  Gzipped pages get decompressed."""
+    import gzip
+    import os
+    import tarfile
+
+    def page(name, body, mtime):
+        if name.endswith(".gz"):
+            body = gzip.decompress(body)
+        return name, body, mtime
+
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith(HTML_SUFFIXES):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                with open(full_path, "rb") as fin:
+                    body = fin.read()
+                yield page(
+                    os.path.relpath(full_path, path), body,
+                    os.path.getmtime(full_path)
+                )
+    else:
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(HTML_SUFFIXES):
+                    body = tar.extractfile(member).read()
+                    yield page(member.name, body, member.mtime)
+
+
+def parse_saved_page(name, body, mtime, encoding=None, data_type=None):
+    """Parse a saved page, detecting the encoding and data_type unless
+    given.  The timestamp is the time the page was saved.  Returns None if
+    the page isn't a table page."""
+    page = Page(name, body, encoding or sniff_encoding(body))
+    try:
+        if data_type is None:
+            result = parse_any(page)
+        else:
+            result = parse_table(page, data_type)
+    except ValueError as error:
+        LOGGER.warning("skipping %r: %s", name, error)
+        return None
+    result["timestamp"] = datetime.datetime.fromtimestamp(
+        mtime, datetime.timezone.utc
+    ).isoformat()
+    return result
+
+
+def parse_saved_pages(pages, processes=0, encoding=None, data_type=None):
+    """Parse the (name, body, mtime) pages, yielding the results in order.
+
+    If processes is non-zero, parse in that many worker processes, with a
+    few pages per worker in flight, so that we never hold many pages in
+    memory."""
+    if not processes:
+        for name, body, mtime in pages:
+            yield parse_saved_page(name, body, mtime, encoding, data_type)
+        return
+
+    import concurrent.futures
+
+    in_flight = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for name, body, mtime in pages:
+            in_flight.append(executor.submit(
+                parse_saved_page, name, body, mtime, encoding, data_type
+            ))
+            if len(in_flight) >= 4 * processes:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def main():
+    import argparse
+    import json
+    import os
+    import sys
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", help="a directory or tarball of saved pages")
+    parser.add_argument(
+        "-o", "--output", default="-", help="where to write the JSON lines"
+    )
+    parser.add_argument(
+        "-p", "--processes", type=int, default=os.cpu_count(),
+        help="parse in this many worker processes (default: one per CPU, "
+             "0 for no workers)"
+    )
+    parser.add_argument(
+        "--data-type", choices=sorted(PARSERS),
+        help="the data_type of all the pages (default: detect it)"
+    )
+    parser.add_argument(
+        "--encoding", help="the encoding of all the pages (default: detect it)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fout = sys.stdout.buffer if args.output == "-" else \
+        open(args.output, "wb")
+    count = skipped = 0
+    first_result = None
+    start = time.perf_counter()
+    try:
+        for result in parse_saved_pages(
+                iter_saved_pages(args.path), args.processes, args.encoding,
+                args.data_type):
+            if result is None:
+                skipped += 1
+                continue
+            fout.write(
+                (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+            )
+            if first_result is None:
+                first_result = time.perf_counter() - STARTED
+            count += 1
+    finally:
+        if fout is not sys.stdout.buffer:
+            fout.close()
+    elapsed = time.perf_counter() - start
+
+    LOGGER.info(
+        "parsed %d pages in %.1fs (%.1f pages/s), skipped %d", count,
+        elapsed, count / elapsed if elapsed else 0, skipped
+    )
+    if first_result is not None:
+        LOGGER.info(
+            "first result %.3fs after the parsers started importing",
+            first_result
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,9 @@ SPIDER_MODULES = ['gosduma7.spiders']
 NEWSPIDER_MODULE = 'gosduma7.spiders'
 
 
+# Crawl this instead of vybory.izbirkom.ru, e.g. a gosduma7.mockserver
+#IZBIRKOM_TOP_URL = 'http://127.0.0.1:8000/region/izbirkom'
+
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'gosduma7 (+http://www.yourdomain.com)'
 
@@ -22,7 +25,9 @@ NEWSPIDER_MODULE = 'gosduma7.spiders'
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
+# Keep this above ADAPTIVE_MAX_CONCURRENCY: it also counts the requests that
+# AdaptiveConcurrencyMiddleware holds back
+CONCURRENT_REQUESTS = 16
 
 # Configure a delay for requests for the same website (default: 0)
 # See http://scrapy.readthedocs.org/en/latest/topics/settings.html#download-delay
@@ -46,27 +51,90 @@ ROBOTSTXT_OBEY = False
 
 # Enable or disable spider middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    'gosduma7.middlewares.MyCustomSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    # Closest to the engine, so that it only sees requests and items that
+    # the other middlewares let through
+    'gosduma7.middlewares.CheckpointMiddleware': 10,
+    'gosduma7.middlewares.ShardMiddleware': 20,
+    # Closest to the spider, so that it times nothing but the callbacks
+    'gosduma7.extensions.Instrumentation': 1000,
+}
+
+# Write a report on where the crawl spends its time here (disabled by
+# default), and keep cProfile dumps of this many of the slowest callbacks
+#INSTRUMENT_DIR = 'instrumentation'
+#INSTRUMENT_PROFILE_SLOWEST = 10
+
+# Record the progress of the crawl here, and resume from it when restarted
+# (disabled by default).  Append to the previous results with -o, not -O.
+#CHECKPOINT_PATH = 'crawl.sqlite'
+
+# Share the crawl by region with the other workers that use this database
+# (disabled by default), under this worker name (default: host and pid).
+# See gosduma7.sharding.
+#SHARD_PATH = 'shards.sqlite'
+#SHARD_WORKER = 'worker-0'
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'gosduma7.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'gosduma7.middlewares.IncrementalMiddleware': 543,
+    # After RetryMiddleware, so that it only sees the final outcome
+    'gosduma7.middlewares.CoalescingMiddleware': 545,
+    # Before RetryMiddleware, so that it sees the 5xx responses
+    'gosduma7.middlewares.AdaptiveConcurrencyMiddleware': 560,
+}
+
+# Give each level of the hierarchy its own download slot, and adjust its
+# concurrency to how fast the server answers (see
+# AdaptiveConcurrencyMiddleware).  The politeness budget is the number of
+# requests in flight to the server across all levels.
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_MAX_CONCURRENCY = 8
+ADAPTIVE_START_CONCURRENCY = 2
+ADAPTIVE_TARGET_LATENCY = 1.0
+
+# Download each page once, even if it gets requested under differently
+# ordered query parameters or for different callbacks (see
+# CoalescingMiddleware), and keep this many pages around to serve repeats
+DUPEFILTER_CLASS = 'gosduma7.middlewares.CoalescingDupeFilter'
+COALESCE_ENABLED = True
+#COALESCE_CACHE_SIZE = 100
+
+# Don't wait for the default three minutes on a stuck request, and keep
+# retrying while the server is overloaded on election night
+DOWNLOAD_TIMEOUT = 30
+RETRY_TIMES = 5
+
+# Only write out the tables that changed since a previous crawl, and send
+# conditional requests for the pages that have no links to follow
+# (disabled by default)
+#INCREMENTAL_PREVIOUS = 'results.json'
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'gosduma7.extensions.Progress': 500,
+}
+
+# How often to log the progress and ETA of the crawl, in seconds
+PROGRESS_INTERVAL = 60
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'gosduma7.pipelines.SomePipeline': 300,
-#}
+ITEM_PIPELINES = {
+    'gosduma7.pipelines.ParsePoolPipeline': 100,
+    'gosduma7.pipelines.SQLitePipeline': 300,
+}
+
+# Parse the tables in this many worker processes, so that parsing does not
+# block the downloads (default: 0, parse in the spider callbacks)
+#PARSE_PROCESSES = 4
+
+# Also write the tables to this SQLite database (see gosduma7.database), this
+# many tables per transaction
+#SQLITE_PATH = 'results.sqlite'
+#SQLITE_BATCH_SIZE = 100
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -89,4 +157,21 @@ ROBOTSTXT_OBEY = False
 #HTTPCACHE_IGNORE_HTTP_CODES = []
 #HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
 
-FEED_EXPORTERS = {"lines": "gosduma7.pipelines.LineExporter"}
+# Keep a gzipped copy of the HTML of every parsed table, keyed by its md5, so
+# that the tables can be parsed again offline with
+# "python -m gosduma7.htmlcache replay htmlcache" (disabled by default)
+#HTML_CACHE_DIR = 'htmlcache'
+
+# How the lines and compact exporters buffer and compress their output (see
+# gosduma7.pipelines.LineExporter).  With CHECKPOINT_PATH or SHARD_PATH,
+# every table gets written out straight away, whatever the interval.
+#EXPORT_BUFFER_SIZE = 1048576
+#EXPORT_FLUSH_INTERVAL = 5
+#EXPORT_COMPRESSION = 'gzip'
+#EXPORT_COMPRESSION_LEVEL = 3
+
+FEED_EXPORTERS = {
+    "lines": "gosduma7.pipelines.LineExporter",
+    "compact": "gosduma7.pipelines.CompactLineExporter",
+    "npz": "gosduma7.pipelines.ColumnarExporter",
+}
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""Split the crawl by region between several workers, and merge the results.
+
+Each worker is an ordinary crawl with SHARD_PATH set (see ShardMiddleware),
+which writes its own shard of the results.  To crawl with four workers on
+this machine, and merge their shards into results.json:
+
+    python -m gosduma7.sharding run shards.sqlite -w 4 -o results.json
+
+Workers on other machines run the spider themselves, with the same
+SHARD_PATH on a filesystem with working locks, and a SHARD_WORKER name of
+their own.  Once they are done, merge the shards:
+
+    python -m gosduma7.sharding merge shards.sqlite shard-*.json \\
+        -o results.json
+
+Merging fails if any region was not crawled completely.  Run the same
+command again to retry the failed regions: the tables that were written
+out already are not written out again.
+"""
+import argparse
+import gzip
+import logging
+import os
+import os.path as P
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from gosduma7 import checkpoint
+from gosduma7 import dataset
+
+LOGGER = logging.getLogger(__name__)
+
+PROJECT_DIR = P.dirname(P.dirname(P.abspath(__file__)))
+"""Where scrapy finds the project settings."""
+
+
+def run(store_path, workers, output_dir, settings=None):
+    """Crawl with that many worker processes sharing store_path, each of
+    them writing its shard of the results to output_dir.
+
+    Settings are passed on to the workers.  The workers write each table
+    out as soon as it's scraped (see LineExporter), because the shared items
+    table counts it as written from then on.  Returns the paths to the
+    shards.  Raises CalledProcessError if any of the workers failed."""
+    store = checkpoint.Checkpoint(store_path)
+    retried = store.retry_failed_shards()
+    store.close()
+    if retried:
+        LOGGER.info("retrying %d failed shards", retried)
+
+    processes = []
+    paths = []
+    for number in range(workers):
+        worker = "worker-%d" % number
+        path = P.abspath(P.join(output_dir, "shard-%s.json" % worker))
+        command = [
+            sys.executable, "-m", "scrapy", "runspider",
+            P.join("gosduma7", "spiders", "myspider.py"),
+            "-o", path + ":lines",
+            "-s", "SHARD_PATH=" + P.abspath(store_path),
+            "-s", "SHARD_WORKER=" + worker,
+        ]
+        for name, value in (settings or {}).items():
+            command.extend(["-s", "%s=%s" % (name, value)])
+        processes.append(subprocess.Popen(command, cwd=PROJECT_DIR))
+        paths.append(path)
+
+    for process in processes:
+        if process.wait():
+            raise subprocess.CalledProcessError(
+                process.returncode, process.args
+            )
+    return paths
+
+
+def merge(shard_paths, fout):
+    """Write the tables from the shards to fout, once each.
+
+    A table that was scraped more than once, e.g. by a worker that died and
+    by the one that took over its region, gets written out as it was last
+    scraped (the first of them, if at the same time).  Returns the number
+    of tables written and of duplicates dropped."""
+    latest = {}
+    count = 0
+    for index, path in enumerate(shard_paths):
+        for position, table in enumerate(dataset.iter_tables(path)):
+            count += 1
+            url = table["url"]
+            if url not in latest or table["timestamp"] > latest[url][0]:
+                latest[url] = (table["timestamp"], index, position)
+    keep = set(version[1:] for version in latest.values())
+
+    for index, path in enumerate(shard_paths):
+        for position, table in enumerate(dataset.iter_tables(path)):
+            if (index, position) in keep:
+                fout.write(dataset.dumps(table))
+    return len(keep), count - len(keep)
+
+
+def gaps(store_path):
+    """Return (url, worker, status) for each shard that isn't done."""
+    store = checkpoint.Checkpoint(store_path)
+    try:
+        return [
+            shard for shard in store.shards() if shard[2] != checkpoint.DONE
+        ]
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser(
+        "run", help="crawl with several workers on this machine, and merge"
+    )
+    run_parser.add_argument("store", help="the shared SQLite database")
+    run_parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count(),
+        help="worker processes (default: one per CPU)"
+    )
+    run_parser.add_argument(
+        "-d", "--shard-dir", default=".", help="where to write the shards"
+    )
+    run_parser.add_argument(
+        "-s", "--set", action="append", default=[], metavar="NAME=VALUE",
+        help="a setting for the workers, as for scrapy"
+    )
+    run_parser.add_argument(
+        "-o", "--output", default="results.json",
+        help="where to write the merged results"
+    )
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="merge the shards that the workers wrote"
+    )
+    merge_parser.add_argument("store", help="the shared SQLite database")
+    merge_parser.add_argument("shards", nargs="+")
+    merge_parser.add_argument(
+        "-o", "--output", default="-", help="where to write the results"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "run":
+        start = time.time()
+        shards = run(
+            args.store, args.workers, args.shard_dir,
+            dict(setting.split("=", 1) for setting in args.set)
+        )
+        LOGGER.info(
+            "%d workers crawled in %.1fs", args.workers, time.time() - start
+        )
+    else:
+        shards = args.shards
+
+    if args.output == "-":
+        count, duplicates = merge(shards, sys.stdout.buffer)
+    else:
+        with open(args.output, "wb") as fout:
+            count, duplicates = merge(shards, fout)
+    LOGGER.info(
+        "merged %d tables from %d shards, dropped %d duplicates",
+        count, len(shards), duplicates
+    )
+
+    missing = gaps(args.store)
+    for url, worker, status in missing:
+        LOGGER.error("region %s (%s): %r", status, worker, url)
+    if missing:
+        sys.exit("%d regions were not crawled completely" % len(missing))
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, filename, tables):
+        path = P.join(self.path, filename)
+        with (gzip.open if filename.endswith(".gz") else open)(
+                path, "wb") as fout:
+            for table in tables:
+                fout.write(dataset.dumps(table))
+        return path
+
+    def test_merge(self):
+        shards = [
+            self.write("shard-0.json", [
+                {"url": "a", "timestamp": "1", "data": [1]},
+                {"url": "b", "timestamp": "1", "data": [2]},
+            ]),
+            self.write("shard-1.json.gz", [
+                {"url": "b", "timestamp": "2", "data": [3]},
+                {"url": "c", "timestamp": "1", "data": [4]},
+                {"url": "c", "timestamp": "1", "data": [5]},
+            ]),
+        ]
+        fout = open(P.join(self.path, "results.json"), "wb")
+        with fout:
+            self.assertEqual(merge(shards, fout), (3, 2))
+        self.assertEqual(
+            [t["data"] for t in dataset.iter_tables(fout.name)],
+            [[1], [3], [4]]
+        )
+
+    def test_gaps(self):
+        path = P.join(self.path, "shards.sqlite")
+        store = checkpoint.Checkpoint(path)
+        for url in ["a", "b"]:
+            store.add_shard(url, "parse_level1", 50)
+        store.claim_shard("w")
+        store.finish_shard("a", checkpoint.DONE)
+        store.claim_shard("w")
+        store.close()
+        self.assertEqual(gaps(path), [("b", "w", checkpoint.CLAIMED)])
+
+
+if __name__ == "__main__":
+    main()
@@ -3,33 +3,28 @@ import re
 import unittest
 import logging
 import os.path as P
-import datetime
 import hashlib
+import urllib.parse
 
 import mock
-import pytz
 import scrapy
+from lxml import etree
+
+from gosduma7 import htmlcache
+from gosduma7 import instrumentation
+from gosduma7 import parsing
+from gosduma7.items import PageItem
+from gosduma7.parsing import (
+    BAD_COLUMN, COMPILED_LINK_XPATHS, COMPILED_XPATHS, FEDERAL_RESULTS_REGEX,
+    SINGLE_RESULTS_REGEX, TIK_XPATH, TOP_URL, TURNOUT_REGEX, TURNOUT_TIK_XPATH,
+    StreamedTable, decode_count, decode_percentage, decoded_rows,
+    extract_cells, get_name_uik, get_uik_link, join, now, page_root,
+    parse_table, parse_tree, parse_turnout_table, parse_voting_summary_table,
+    table_links,
+)
 
 LOGGER = logging.getLogger(__name__)
 
-TOP_URL = "http://www.vybory.izbirkom.ru/region/\
-izbirkom?action=show&global=1&vrn=100100067795849&region=0&prver=0&pronetvd=0"
-
-TURNOUT_REGEX = re.compile(
-    "Предварительные сведения об участии избирателей в выборах",
-    re.IGNORECASE | re.UNICODE
-)
-FEDERAL_RESULTS_REGEX = re.compile(
-    "Сводная таблица (предварительных )?итогов голосования \
-по федеральному избирательному округу",
-    re.IGNORECASE | re.UNICODE
-)
-SINGLE_RESULTS_REGEX = re.compile(
-    "Сводная таблица результатов выборов по \
-одномандатному избирательному округу",
-    re.IGNORECASE | re.UNICODE
-)
-
 #
 # My understanding of the hierarchy is as follows.
 # At the top you have the central IK (центральная избирательная комиссия).
@@ -45,23 +40,20 @@ SINGLE_RESULTS_REGEX = re.compile(
 #
 TEST = False
 
-TIK_XPATH = "/html/body/table[2]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[1]/td/nobr/a"  # noqa
-"""Get the territorial electoral committee links."""
-
-UIK_XPATH = "/html/body/table[2]/tr[2]/td/a"
-"""Get the link to the UIK table from a TIK table."""
-
-TURNOUT_TIK_XPATH = "/html/body/table[2]/tr[4]/td/table[4]/tr/td[2]/a"
-"""Get the territorial electoral committee links for turnout pages."""
-
-
-def get_uik_link(selector):
-    #
-    # Для просмотра данных по участковым избирательным комиссиям перейдите
-    # на сайт избирательной комиссии субъекта Российской Федерации
-    #
-    uik_link = selector.xpath(UIK_XPATH)
-    return uik_link.xpath("./@href").extract_first()
+PRIORITIES = {
+    "region": 50,
+    "area": 40,
+    "federal": 32,
+    "single": 31,
+    "turnout": 30,
+    "federal_ik": 20,
+    "turnout_ik": 10,
+    "federal_uik": 5,
+    "turnout_uik": 0,
+}
+"""Request priorities, so that the crawl is breadth-first.  The OIK tables
+(which add up to the national picture) come before the TIK pages, and those
+before the UIK tables.  Higher priorities get downloaded first."""
 
 
 class MyspiderSpider(scrapy.Spider):
@@ -69,15 +61,65 @@ class MyspiderSpider(scrapy.Spider):
     allowed_domains = ["vybory.izbirkom.ru"]
     start_urls = (TOP_URL,)
 
+    html_cache = None
+    """Where to keep the raw HTML of the tables.  See HTML_CACHE_DIR."""
+
+    parse_processes = 0
+    """If non-zero, leave the parsing to ParsePoolPipeline.  See
+    PARSE_PROCESSES."""
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(MyspiderSpider, cls).from_crawler(
+            crawler, *args, **kwargs
+        )
+        top_url = crawler.settings.get("IZBIRKOM_TOP_URL")
+        if top_url:
+            spider.start_urls = (top_url,)
+            spider.allowed_domains = [urllib.parse.urlsplit(top_url).hostname]
+        cache_dir = crawler.settings.get("HTML_CACHE_DIR")
+        if cache_dir:
+            spider.html_cache = htmlcache.HtmlCache(cache_dir)
+        spider.parse_processes = crawler.settings.getint("PARSE_PROCESSES")
+        return spider
+
+    def _parse_table(self, response, data_type):
+        """Parse the table and keep a copy of the page, if so configured.
+
+        If we're parsing in a process pool, yield a PageItem for the
+        pipeline to parse instead of the parsed table.  If the table hasn't
+        changed since the previous crawl, yield nothing.
+        See IncrementalMiddleware."""
+        if response.meta.get("unchanged"):
+            self.logger.debug("skipping unchanged table: %r", response.url)
+            return
+        if self.html_cache is not None:
+            with instrumentation.phase("cache", len(response.body)):
+                self.html_cache.put(
+                    response.url, response.body,
+                    hashlib.md5(response.body).hexdigest(), data_type,
+                    response.encoding, now().isoformat()
+                )
+        if self.parse_processes:
+            yield PageItem(
+                url=response.url, body=response.body,
+                encoding=response.encoding, data_type=data_type
+            )
+        else:
+            yield parse_table(response, data_type)
+
     def parse(self, response):
         meth_name = "parse"
         self.logger.debug(
             "%s: handling reponse from url: %r", meth_name, response.url
         )
 
-        for value in response.xpath("//option/@value").extract():
+        for value in COMPILED_LINK_XPATHS["option"](page_root(response)):
             self.logger.debug("%s: extracted value: %r", meth_name, value)
-            yield scrapy.Request(value, callback=self.__parse_level1)
+            yield scrapy.Request(
+                value, callback=self.__parse_level1,
+                priority=PRIORITIES["region"]
+            )
             if TEST:
                 break
 
@@ -87,9 +129,12 @@ class MyspiderSpider(scrapy.Spider):
             "%s: handling reponse from url: %r", meth_name, response.url
         )
 
-        for value in response.xpath("//option/@value").extract():
+        for value in COMPILED_LINK_XPATHS["option"](page_root(response)):
             self.logger.debug("%s: extracted value: %r", meth_name, value)
-            yield scrapy.Request(value, callback=self.__parse_level2)
+            yield scrapy.Request(
+                value, callback=self.__parse_level2,
+                priority=PRIORITIES["area"]
+            )
             if TEST:
                 break
 
@@ -100,299 +145,82 @@ class MyspiderSpider(scrapy.Spider):
         )
 
         callbacks = {
-            FEDERAL_RESULTS_REGEX: self.__parse_federal_table,
-            SINGLE_RESULTS_REGEX: self.__parse_single_table,
-            TURNOUT_REGEX: self.__parse_turnout_table
+            "federal": self.__parse_federal_table,
+            "single": self.__parse_single_table,
+            "turnout": self.__parse_turnout_table,
         }
-        matched_regexes = set()
-
-        for hyperlink in response.xpath("//a"):
-            text = join(hyperlink.xpath("./text()").extract())
-            self.logger.debug("%s: text: %r", meth_name, text)
+        matched_data_types = set()
 
-            for regex, callback in callbacks.items():
-                if regex.search(text):
-                    matched_regexes.add(regex)
-                    href = hyperlink.xpath("./@href").extract_first()
-                    self.logger.debug(
-                        "%s: extracted href: %r", meth_name, href
-                    )
-                    yield scrapy.Request(href, callback=callback)
+        for href, data_type in table_links(page_root(response)):
+            matched_data_types.add(data_type)
+            self.logger.debug(
+                "%s: extracted %s href: %r", meth_name, data_type, href
+            )
+            #
+            # The single-mandate table has no links that we need to
+            # follow, so we can skip downloading it if unchanged.
+            #
+            yield scrapy.Request(
+                href, callback=callbacks[data_type],
+                priority=PRIORITIES[data_type],
+                meta={"conditional": data_type == "single"}
+            )
 
         # Make sure we've got all the data for this region
-        assert len(matched_regexes) == 3
+        assert len(matched_data_types) == 3
 
     def __parse_federal_table(self, response):
         #
         # Link to each individual electoral commission
         #
-        ik_links = response.selector.xpath(TIK_XPATH)
-        for link in ik_links:
-            href = link.xpath("./@href").extract_first()
-            yield scrapy.Request(href, callback=self.__parse_federal_table_ik)
-        yield parse_voting_summary_table(response)
+        for href in COMPILED_LINK_XPATHS["tik"](page_root(response)):
+            yield scrapy.Request(
+                href, callback=self.__parse_federal_table_ik,
+                priority=PRIORITIES["federal_ik"]
+            )
+        yield from self._parse_table(response, "federal")
 
     def __parse_federal_table_ik(self, response):
-        uik_link = get_uik_link(response.selector)
+        uik_link = get_uik_link(page_root(response))
         assert uik_link, "unable to get_uik_link"
-        yield scrapy.Request(uik_link, callback=self.__parse_federal_table_uik)
+        yield scrapy.Request(
+            uik_link, callback=self.__parse_federal_table_uik,
+            priority=PRIORITIES["federal_uik"], meta={"conditional": True}
+        )
 
     def __parse_federal_table_uik(self, response):
-        yield parse_voting_summary_table(response, data_type="federal_uik")
+        yield from self._parse_table(response, "federal_uik")
 
     def __parse_single_table(self, response):
-        yield parse_voting_summary_table(response, data_type="single")
+        yield from self._parse_table(response, "single")
 
     def __parse_turnout_table(self, response):
         meth_name = "__parse_turnout_table"
-        ik_links = response.selector.xpath(TURNOUT_TIK_XPATH)
+        ik_links = COMPILED_LINK_XPATHS["turnout_tik"](page_root(response))
         self.logger.debug("%s: len(ik_links): %d", meth_name, len(ik_links))
-        for link in ik_links:
-            href = link.xpath("./@href").extract_first()
-            yield scrapy.Request(href, callback=self.__parse_turnout_table_ik)
-        yield parse_turnout_table(response)
+        for href in ik_links:
+            yield scrapy.Request(
+                href, callback=self.__parse_turnout_table_ik,
+                priority=PRIORITIES["turnout_ik"]
+            )
+        yield from self._parse_table(response, "turnout")
 
     def __parse_turnout_table_ik(self, response):
         meth_name = "__parse_turnout_table_ik"
-        uik_link = get_uik_link(response.selector)
+        uik_link = get_uik_link(page_root(response))
         self.logger.debug("%s: uik_link: %r", meth_name, uik_link)
         if uik_link:
             yield scrapy.Request(
-                uik_link, callback=self.__parse_turnout_table_uik
+                uik_link, callback=self.__parse_turnout_table_uik,
+                priority=PRIORITIES["turnout_uik"], meta={"conditional": True}
             )
 
     def __parse_turnout_table_uik(self, response):
         meth_name = "__parse_turnout_table_uik"
         self.logger.debug("%s: url: %r", meth_name, response.url)
-        yield parse_turnout_table(response, data_type="turnout_uik")
+        yield from self._parse_table(response, "turnout_uik")
 
 
-def join(list_of_strings):
-    return " ".join(list_of_strings).strip()
-
-#
-# While the content and layouts for the federal and single-mandate pages are
-# approximately the same, the xpath selectors are slightly different.
-#
-XPATHS = {
-    "federal": {
-        "row_header": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[1]/table/tr/td[2]",  # noqa
-        "col_header": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[1]/td",  # noqa
-        "total": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[1]/table/tr[%d]/td[3]/nobr/b/text()",  # noqa
-        "cell": "/html/body/table[2]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[%d]/td[%d]/nobr/b/text()"  # noqa
-    },
-    "federal_uik": {
-        "row_header": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[1]/table/tr/td[2]",  # noqa
-        "col_header": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[1]/td",  # noqa
-        "total": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[1]/table/tr[%d]/td[3]/nobr/b/text()",  # noqa
-        "cell": "/html/body/table[3]/tr[4]/td/table[5]/tr/td[2]/div/table/tr[%d]/td[%d]/nobr/b/text()"  # noqa
-    },
-    "single": {
-        "row_header": "/html/body/table[2]/tr[4]/td/div/table/tr/td[1]/table/tr/td[2]",  # noqa
-        "col_header": "/html/body/table[2]/tr[4]/td/div/table/tr/td[2]/div/table/tr[1]/td",  # noqa
-        "total": "/html/body/table[2]/tr[4]/td/div/table/tr/td[1]/table/tr[%d]/td[3]/nobr/b/text()",  # noqa
-        "cell": "/html/body/table[2]/tr[4]/td/div/table/tr/td[2]/div/table/tr[%d]/td[%d]/nobr/b/text()",  # noqa
-    },
-    "turnout": {
-        "row_header": "/html/body/table[2]/tr[4]/td/table[4]/tr/td[2]",
-        "cell": "/html/body/table[2]/tr[4]/td/table[4]/tr[%d]/td[%d]//text()"
-    },
-    "turnout_uik": {
-        "row_header": "/html/body/table[3]/tr[4]/td/table[4]/tr/td[2]",
-        "cell": "/html/body/table[3]/tr[4]/td/table[4]/tr[%d]/td[%d]//text()"
-    }
-}
-
-#
-# The 1st row is the header.
-# The next rows are the stats.
-# The 20th row is blank.
-# The remaining rows are the candidates (parties and people in federal and
-# single-mandate elections, respectively).
-#
-FIRST_STAT = 1
-LAST_STAT = 19
-FIRST_CANDIDATE = 20
-
-
-def now():
-    """Return the current UTC datetime (time-zone aware)."""
-    #
-    # http://stackoverflow.com/questions/2331592/datetime-datetime-utcnow-why-no-tzinfo
-    #
-    return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-
-
-def get_name(root):
-    """Return the electorate region, committee number and name."""
-    region = join(
-        root.xpath("/html/body/table[2]/tr[1]/td/a[2]/text()").extract()
-    )
-    area_ik = join(
-        root.xpath("/html/body/table[2]/tr[1]/td/a[3]/text()").extract()
-    )
-    #
-    # Наименование избирательной комиссии
-    #
-    area_ik_long = join(
-        root.xpath(
-            "/html/body/table[2]/tr[4]/td/table[3]/tr[2]/td[2]/text()"
-        ).extract()
-    )
-    del root
-    return locals()
-
-
-def get_name_uik(root):
-    region = join(
-        root.xpath("/html/body/table[3]/tr[1]/td/a[1]/text()").extract()
-    )
-    area_ik = join(
-        root.xpath("/html/body/table[3]/tr[1]/td/a[2]/text()").extract()
-    )
-    territory_ik = join(
-        root.xpath("/html/body/table[3]/tr[1]/td/a[3]/text()").extract()
-    )
-    del root
-    return locals()
-
-
-BAD_COLUMN = -1
-"""Sometimes values are just plain missing.  We can't really skip them,
-since our stuff depends on the order of rows and columns, so let's have
-a dummy value that we use to signify something went wrong."""
-#
-# noqa e.g. http://www.vybory.izbirkom.ru/region/izbirkom?action=show&global=true&root=772000043&tvd=27720001659726&vrn=100100067795849&prver=0&pronetvd=0&region=77&sub_region=77&type=453&vibid=27720001659726
-# there's a blank row at the end of the column
-#
-
-
-def myfloat(value):
-    try:
-        return float(value)
-    except ValueError:
-        return BAD_COLUMN
-
-
-def parse_voting_summary_table(response, data_type="federal"):
-    """Parse the voting summary table.  Works for federal and single-mandate
-    tables."""
-    meth_name = "parse_voting_summary_table"
-
-    root = response.selector
-    url = response.url
-    md5 = hashlib.md5(response.body).hexdigest()
-
-    if data_type.endswith("_uik"):
-        result = get_name_uik(root)
-    else:
-        result = get_name(root)
-
-    logging.debug("%s: result: %r", meth_name, result)
-
-    row_headers = [
-        join(td.xpath(".//text()").extract())
-        for td in root.xpath(XPATHS[data_type]["row_header"])
-    ]
-    logging.debug("%s: row_headers: %r", meth_name, row_headers)
-
-    column_headers = [
-        join(td.xpath(".//text()").extract())
-        for td in root.xpath(XPATHS[data_type]["col_header"])
-    ]
-    logging.debug("%s: column_headers: %r", meth_name, column_headers)
-
-    stats_rows = list(range(FIRST_STAT, LAST_STAT))
-    votes_rows = list(range(FIRST_CANDIDATE, len(row_headers)))
-    important_rows = stats_rows + votes_rows
-
-    rows = []
-    for row_number in important_rows:
-        #
-        # xpath rows use 1-based indexing
-        #
-        total_value = join(
-            root.xpath(XPATHS[data_type]["total"] % (row_number + 1)).extract()
-        )
-        LOGGER.debug(
-            "%s: row: %r total_value: %r", meth_name, row_number, total_value
-        )
-
-        columns = [myfloat(total_value)]
-
-        for col_number, _ in enumerate(column_headers, 1):
-            value = join(
-                root.xpath(
-                    XPATHS[data_type]["cell"] % (row_number + 1, col_number)
-                ).extract()
-            )
-            columns.append(myfloat(value))
-
-        rows.append(columns)
-
-    row_headers = [
-        rh for (i, rh) in enumerate(row_headers)
-        if i in important_rows
-    ]
-    column_headers.insert(0, "Сумма")
-
-    result.update(
-        {
-            "row_headers": row_headers, "column_headers": column_headers,
-            "data": rows, "data_type": data_type,
-            "timestamp": now().isoformat(), "url": url, "md5": md5
-        }
-    )
-    return result
-
-
-def parse_turnout_table(response, data_type="turnout"):
-    """Pass the voting turnout table."""
-    meth_name = "parse_turnout_table"
-
-    root = response.selector
-    url = response.url
-    md5 = hashlib.md5(response.body).hexdigest()
-
-    if data_type == "turnout_uik":
-        result = get_name_uik(root)
-    else:
-        result = get_name(root)
-
-    logging.debug("%s: result: %r", meth_name, result)
-
-    row_headers = [
-        join(row.xpath(".//text()").extract())
-        for row in root.xpath(XPATHS[data_type]["row_header"])
-    ]
-    logging.debug("%s: row_headers: %r", meth_name, row_headers)
-
-    important_rows = range(2, len(row_headers))
-    important_cols = [2, 3, 4, 5]
-
-    rows = []
-    for row_num in important_rows:
-        xp = XPATHS[data_type]["cell"]
-        cols = [
-            myfloat(
-                join(
-                    root.xpath(xp % (row_num + 1, col_num + 1)).extract()
-                ).rstrip("%")
-            )
-            for col_num in important_cols
-        ]
-        rows.append(cols)
-
-    result.update(
-        {
-            "md5": md5, "url": url, "data_type": data_type,
-            "timestamp": now().isoformat(), "row_headers": row_headers[2:],
-            "column_headers": ["10:00", "12:00", "15:00", "18:00"],
-            "data": rows
-        }
-    )
-    return result
-
 CURR_DIR = P.dirname(P.abspath(__file__))
 
 
@@ -400,6 +228,7 @@ def mock_response(filename):
     """Let's pretend we have a scrapy Response object for testing."""
     response = mock.Mock()
     response.url = P.join(CURR_DIR, filename)
+    response.encoding = "utf-8"
     with open(response.url, "rb") as fin:
         response.body = fin.read()
         response.selector = scrapy.Selector(text=response.body)
@@ -570,6 +399,216 @@ class ParseTurnoutTableTest(unittest.TestCase):
         self.assertEqual(result["data_type"], "turnout_uik")
 
 
+class DecodeTest(unittest.TestCase):
+
+    def test_count(self):
+        self.assertEqual(decode_count(["12345"]), 12345)
+        self.assertIsInstance(decode_count([" 12", "3 "]), int)
+        self.assertEqual(decode_count(["0.5"]), 0.5)
+        for texts in [[], [""], ["  "], ["-"], ["12a"], ["١٢"], ["1.2.3"]]:
+            self.assertEqual(decode_count(texts), BAD_COLUMN, texts)
+
+    def test_percentage(self):
+        self.assertEqual(decode_percentage(["7.04%"]), 7.04)
+        self.assertEqual(decode_percentage(["100", "%"]), 100.0)
+        self.assertIsInstance(decode_percentage(["100%"]), float)
+        self.assertEqual(decode_percentage([]), BAD_COLUMN)
+
+    def test_extract_cells(self):
+        table = etree.fromstring(
+            "<table><tr><td><nobr><b>1</b></nobr></td><td/></tr>"
+            "<tr><td><nobr><b>2</b></nobr><b>9</b></td></tr></table>"
+        )
+        self.assertEqual(
+            extract_cells([table], [0, 1, 2], [0, 1], decode=decode_count),
+            [[1, BAD_COLUMN], [2, BAD_COLUMN], [BAD_COLUMN, BAD_COLUMN]]
+        )
+        self.assertEqual(
+            extract_cells([table], [1], [0], path=None), [["2 9"]]
+        )
+
+
+class ParseTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        response = mock_response("test_parse_federal_uik.html")
+        self.body = response.body
+        self.full = response.selector.root
+        self.xpaths = COMPILED_XPATHS["federal_uik"]
+
+    def parse(self, threshold=0):
+        with mock.patch("gosduma7.parsing.STREAM_THRESHOLD", threshold):
+            return parse_tree(self.body, "utf-8", [
+                StreamedTable(
+                    self.xpaths["cell_table"], None, ("nobr", "b"),
+                    decode_count
+                ),
+            ])
+
+    def test_pruned(self):
+        root, (rows,) = self.parse()
+        num_rows = len(self.xpaths["row_header"](self.full))
+        self.assertEqual(
+            decoded_rows(rows, range(1, num_rows), 6),
+            extract_cells(
+                self.xpaths["cell_table"](self.full), range(1, num_rows),
+                range(6), decode=decode_count
+            )
+        )
+        self.assertEqual(get_name_uik(root), get_name_uik(self.full))
+        table = self.xpaths["cell_table"](root)[0]
+        self.assertEqual(len(table), num_rows)
+        self.assertEqual(len(table[0]), 6)
+        self.assertEqual(len(table[1]), 0)
+        self.assertEqual(root.xpath("//script/text()"), [])
+
+    def test_chunks(self):
+        _, expected = self.parse()
+        with mock.patch("gosduma7.parsing.PARSE_CHUNK_SIZE", 100):
+            self.assertEqual(self.parse()[1], expected)
+
+    def test_whole(self):
+        _, expected = self.parse()
+        root, decoded = self.parse(threshold=len(self.body) + 1)
+        self.assertEqual(decoded, expected)
+        self.assertEqual(get_name_uik(root), get_name_uik(self.full))
+        self.assertEqual(
+            len(root.xpath("//script")), len(self.full.xpath("//script"))
+        )
+
+
+class LayoutTest(unittest.TestCase):
+
+    #
+    # Not a template in XPATHS, with blank rows after the stats and at the
+    # end.
+    #
+    PAGE = """<html><body><div><table><tr><td><table>
+<tr><td colspan="2"></td><td><nobr><b>Сумма</b></nobr></td></tr>
+<tr><td>1</td><td>Voters</td><td><nobr><b>10</b></nobr></td></tr>
+<tr><td></td><td colspan="2"> </td></tr>
+<tr><td>2</td><td>Party</td><td><nobr><b>7</b></nobr></td></tr>
+<tr><td></td><td colspan="2"> </td></tr>
+</table></td><td><div><table>
+<tr><td>UIK 1</td><td>UIK 2</td></tr>
+<tr><td><nobr><b>4</b></nobr></td><td><nobr><b>6</b></nobr></td></tr>
+<tr><td></td><td></td></tr>
+<tr><td><nobr><b>3</b></nobr></td><td><nobr><b>4</b></nobr></td></tr>
+<tr><td></td><td></td></tr>
+</table></div></td></tr></table></div></body></html>"""
+
+    def setUp(self):
+        mock.patch.dict("gosduma7.parsing.LAYOUTS", clear=True).start()
+        mock.patch("gosduma7.parsing._LAYOUT_TABLES", []).start()
+        self.detect = mock.patch(
+            "gosduma7.parsing.detect_layout", wraps=parsing.detect_layout
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_cached(self):
+        """Pages of a template seen before should not be detected again."""
+        for filename in ["test_parse.html", "test_parse_tik.html"] * 2:
+            response = mock_response(filename)
+            parsing.parse_layout(response.body, response.encoding)
+        self.assertEqual(self.detect.call_count, 2)
+
+        response = mock_response("test_parse.html")
+        root, layout, _ = parsing.parse_layout(response.body, "utf-8")
+        self.assertEqual(layout.data_type, "federal")
+        self.assertEqual(layout.first_row, 1)
+        self.assertEqual(layout.column_headers, ("Сумма",))
+        self.assertEqual(
+            parsing.signature(root),
+            parsing.signature(response.selector.root)
+        )
+
+        response = mock_response("test_parse_turnout.html")
+        _, layout, _ = parsing.parse_layout(response.body, "utf-8")
+        self.assertEqual(layout.data_type, "turnout")
+        self.assertEqual(
+            layout.column_headers, ("10:00", "12:00", "15:00", "18:00")
+        )
+
+    def test_unknown_template(self):
+        page = parsing.Page("http://a/", self.PAGE.encode(), "utf-8")
+        result = parse_table(page, "federal")
+        self.assertEqual(result["row_headers"], ["Voters", "Party"])
+        self.assertEqual(
+            result["column_headers"], ["Сумма", "UIK 1", "UIK 2"]
+        )
+        self.assertEqual(result["data"], [[10, 4, 6], [7, 3, 4]])
+        with self.assertRaises(ValueError):
+            parsing.parse_any(page)
+        with self.assertRaises(ValueError):
+            parse_turnout_table(page)
+        self.assertEqual(self.detect.call_count, 1)
+
+
+class SavedPageTest(unittest.TestCase):
+
+    FIXTURES = [
+        ("test_parse.html", "federal"),
+        ("test_parse_single.html", "single"),
+        ("test_parse_federal_uik.html", "federal_uik"),
+        ("test_parse_turnout.html", "turnout"),
+        ("test_parse_turnout_uik.html", "turnout_uik"),
+        ("test_parse_turnout_uik2.html", "turnout_uik"),
+    ]
+
+    def test_detect(self):
+        """parse_any should parse each page like the parser for its
+        data_type."""
+        for filename, data_type in self.FIXTURES:
+            response = mock_response(filename)
+            actual = parsing.parse_any(response)
+            expected = parse_table(response, data_type)
+            del actual["timestamp"], expected["timestamp"]
+            self.assertEqual(actual, expected, filename)
+
+    def test_not_a_table(self):
+        with self.assertRaises(ValueError):
+            parsing.parse_any(mock_response("test_parse_tik.html"))
+
+    def test_sniff_encoding(self):
+        self.assertEqual(parsing.sniff_encoding(
+            b'<meta http-equiv="Content-Type" '
+            b'content="text/html; charset=windows-1251">'
+        ), "windows-1251")
+        self.assertEqual(parsing.sniff_encoding("Адыгея".encode()), "utf-8")
+        self.assertEqual(
+            parsing.sniff_encoding("Адыгея".encode("cp1251")), "windows-1251"
+        )
+
+    def test_saved_pages(self):
+        import gzip
+        import shutil
+        import tempfile
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for filename in ["test_parse_tik.html", "test_parse.html"]:
+            with open(P.join(CURR_DIR, filename), "rb") as fin:
+                body = fin.read()
+            with open(P.join(path, filename), "wb") as fout:
+                fout.write(body)
+        with open(P.join(path, "federal.html.gz"), "wb") as fout:
+            fout.write(gzip.compress(body))
+        with open(P.join(path, "notes.txt"), "w") as fout:
+            fout.write("not a page")
+
+        pages = list(parsing.iter_saved_pages(path))
+        self.assertEqual(
+            [name for (name, _, _) in pages],
+            ["federal.html.gz", "test_parse.html", "test_parse_tik.html"]
+        )
+        results = list(parsing.parse_saved_pages(pages))
+        self.assertEqual(results[0]["data"], results[1]["data"])
+        self.assertIsNone(results[2])
+        self.assertEqual(results[1]["data_type"], "federal")
+        self.assertEqual(results[1]["url"], "test_parse.html")
+        self.assertTrue(results[1]["timestamp"].endswith("+00:00"))
+
+
 class RegexTest(unittest.TestCase):
 
     def test_final(self):
@@ -626,3 +665,18 @@ class XpathTest(unittest.TestCase):
                 "Тахтамукайская", "Теучежская", "Шовгеновская"
             ]
         )
+
+
+class PriorityTest(unittest.TestCase):
+
+    def test_breadth_first(self):
+        spider = MyspiderSpider()
+        response = mock_response("test_parse.html")
+        response.meta = {}
+        results = list(spider._MyspiderSpider__parse_federal_table(response))
+        requests = [r for r in results if isinstance(r, scrapy.Request)]
+        self.assertEqual(len(requests), 9)
+        for request in requests:
+            self.assertEqual(request.priority, PRIORITIES["federal_ik"])
+            self.assertLess(request.priority, PRIORITIES["turnout"])
+        self.assertEqual(results[-1]["data_type"], "federal")
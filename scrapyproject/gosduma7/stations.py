@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Per-station (UIK) arrays for plotting and analysis.
+
+Builds dense NumPy arrays from the federal_uik tables in one pass, so that
+binning ~95k polling stations is a handful of vectorized operations:
+
+    tables = dataset.iter_tables("results.json", "federal_uik")
+    stations = station_matrix(tables)
+    party = stations.parties.index(EDINAYA_ROSSIYA)
+    x, y = votes_by_share(stations, party)
+    plt.plot(x, y)
+"""
+import collections
+import unittest
+
+import numpy
+
+ELIGIBLE_VOTERS = "Число избирателей, внесенных в список избирателей на \
+момент окончания голосования"
+VALID_BALLOTS = "Число действительных избирательных бюллетеней"
+EDINAYA_ROSSIYA = '4. Всероссийская политическая партия "ЕДИНАЯ РОССИЯ"'
+
+FIRST_PARTY = 18
+"""The row of the first party in the federal tables.  The rows before it are
+the ballot statistics."""
+
+BIN_WIDTH = 0.002
+"""The default bin width for binning shares and turnout."""
+
+Stations = collections.namedtuple(
+    "Stations",
+    [
+        "parties", "regions", "areas", "territories", "names",
+        "region_index", "area_index", "territory_index",
+        "votes", "eligible_voters", "valid_ballots", "turnout", "fraction"
+    ]
+)
+"""Arrays describing the polling stations.
+
+parties, regions, areas and territories are lists of names.  region_index,
+area_index and territory_index are int32 arrays that index into these lists,
+one element per station, and names holds the name of each station.  votes
+and fraction are stations x parties float64 matrices, with the number of
+votes and the proportion of valid ballots for each party.  eligible_voters,
+valid_ballots and turnout have one element per station."""
+
+
+def station_matrix(tables):
+    """Build the Stations arrays from the federal_uik tables.
+
+    Stations without any eligible voters or valid ballots are left out,
+    since we can't calculate their turnout or vote fractions."""
+    parties = None
+    labels = {"region": {}, "area_ik": {}, "territory_ik": {}}
+    blocks = collections.defaultdict(list)
+
+    for table in tables:
+        if table["data_type"] != "federal_uik":
+            continue
+
+        row_headers = table["row_headers"]
+        if parties is None:
+            parties = row_headers[FIRST_PARTY:]
+        assert row_headers[FIRST_PARTY:] == parties, \
+            "unexpected parties in %r" % table["url"]
+
+        #
+        # Skip the zeroth column: it's the total across all stations.
+        #
+        data = numpy.array(table["data"], dtype=numpy.float64)[:, 1:]
+        eligible_voters = data[row_headers.index(ELIGIBLE_VOTERS)]
+        valid_ballots = data[row_headers.index(VALID_BALLOTS)]
+        keep = (eligible_voters > 0) & (valid_ballots > 0)
+        num_stations = int(keep.sum())
+
+        blocks["votes"].append(data[FIRST_PARTY:, keep].T)
+        blocks["eligible_voters"].append(eligible_voters[keep])
+        blocks["valid_ballots"].append(valid_ballots[keep])
+        blocks["names"].extend(
+            name for (name, k) in zip(table["column_headers"][1:], keep) if k
+        )
+        for field, index in labels.items():
+            code = index.setdefault(table.get(field, ""), len(index))
+            blocks[field].append(
+                numpy.full(num_stations, code, dtype=numpy.int32)
+            )
+
+    def concatenate(field, shape):
+        if blocks[field]:
+            return numpy.concatenate(blocks[field])
+        return numpy.zeros(shape)
+
+    parties = parties or []
+    votes = concatenate("votes", (0, len(parties)))
+    eligible_voters = concatenate("eligible_voters", 0)
+    valid_ballots = concatenate("valid_ballots", 0)
+    return Stations(
+        parties=parties,
+        regions=list(labels["region"]),
+        areas=list(labels["area_ik"]),
+        territories=list(labels["territory_ik"]),
+        names=blocks["names"],
+        region_index=concatenate("region", 0).astype(numpy.int32),
+        area_index=concatenate("area_ik", 0).astype(numpy.int32),
+        territory_index=concatenate("territory_ik", 0).astype(numpy.int32),
+        votes=votes,
+        eligible_voters=eligible_voters,
+        valid_ballots=valid_ballots,
+        turnout=valid_ballots / eligible_voters,
+        fraction=votes / valid_ballots[:, numpy.newaxis],
+    )
+
+
+def select(stations, mask):
+    """Return the Stations for which the boolean mask is True."""
+    per_station = {
+        "region_index", "area_index", "territory_index", "votes",
+        "eligible_voters", "valid_ballots", "turnout", "fraction"
+    }
+    fields = stations._asdict()
+    for field in per_station:
+        fields[field] = fields[field][mask]
+    fields["names"] = [n for (n, m) in zip(stations.names, mask) if m]
+    return Stations(**fields)
+
+
+def bin_sum(x, weights, width=BIN_WIDTH):
+    """Round x to the nearest multiple of width, and sum the weights per bin.
+
+    Returns the non-empty bins (in increasing order) and their sums.  This
+    is the vectorized equivalent of grouping stations with round_nearest and
+    summing over each group."""
+    bins = numpy.rint(numpy.asarray(x) / width).astype(numpy.int64)
+    offset = bins.min() if len(bins) else 0
+    sums = numpy.bincount(bins - offset, weights=weights)
+    counts = numpy.bincount(bins - offset)
+    nonempty = numpy.flatnonzero(counts)
+    return (nonempty + offset) * width, sums[nonempty]
+
+
+def votes_by_share(stations, party, width=BIN_WIDTH):
+    """Total votes for the party at stations with that share of the vote."""
+    return bin_sum(
+        stations.fraction[:, party], stations.votes[:, party], width
+    )
+
+
+def votes_by_turnout(stations, party, width=BIN_WIDTH):
+    """Total votes for the party at stations with that turnout."""
+    return bin_sum(stations.turnout, stations.votes[:, party], width)
+
+
+def share_histogram(stations, party, decimals=0):
+    """Count the stations by percentage of votes for the party.
+
+    Returns the percentages (rounded to decimals) and the number of stations
+    that showed each one."""
+    percentages = numpy.round(stations.fraction[:, party] * 100, decimals)
+    return numpy.unique(percentages, return_counts=True)
+
+
+class StationMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        row_headers = ["stat"] * FIRST_PARTY + ["A", "B"]
+        row_headers[0] = ELIGIBLE_VOTERS
+        row_headers[1] = VALID_BALLOTS
+        data = [[0.0] * 4 for _ in row_headers]
+        #
+        # Three stations, the last of which has no valid ballots.
+        #
+        data[0] = [300.0, 100.0, 200.0, 50.0]
+        data[1] = [150.0, 50.0, 100.0, 0.0]
+        data[FIRST_PARTY] = [110.0, 10.0, 100.0, 0.0]
+        data[FIRST_PARTY + 1] = [40.0, 40.0, 0.0, 0.0]
+        self.table = {
+            "data_type": "federal_uik", "region": "R", "area_ik": "O",
+            "territory_ik": "T", "url": "", "row_headers": row_headers,
+            "column_headers": ["Сумма", "1", "2", "3"], "data": data
+        }
+
+    def test_station_matrix(self):
+        other = dict(self.table, data_type="federal")
+        stations = station_matrix([self.table, other])
+        self.assertEqual(stations.parties, ["A", "B"])
+        self.assertEqual(stations.names, ["1", "2"])
+        self.assertEqual(stations.regions, ["R"])
+        self.assertEqual(stations.votes.tolist(), [[10, 40], [100, 0]])
+        self.assertEqual(stations.turnout.tolist(), [0.5, 0.5])
+        self.assertEqual(stations.fraction.tolist(), [[0.2, 0.8], [1.0, 0.0]])
+        self.assertEqual(list(stations.region_index), [0, 0])
+
+    def test_bins(self):
+        stations = station_matrix([self.table])
+        x, y = votes_by_turnout(stations, 0)
+        self.assertEqual(x.tolist(), [0.5])
+        self.assertEqual(y.tolist(), [110])
+
+        x, y = votes_by_share(stations, 0, width=0.1)
+        self.assertEqual(x.tolist(), [0.2, 1.0])
+        self.assertEqual(y.tolist(), [10, 100])
+
+        percentages, counts = share_histogram(stations, 1)
+        self.assertEqual(percentages.tolist(), [0, 80])
+        self.assertEqual(counts.tolist(), [1, 1])